@@ -2,20 +2,31 @@ import os
 import pathlib
 import json
 import glob
+import inspect
 import re
+import threading
 from typing import Optional
 from collections import namedtuple
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 # import copy
 
+import numpy as np
 import pandas as pd
 import SimpleITK as sitk
 from pydicom import dcmread
+from pydicom.datadict import tag_for_keyword
+from pydicom.tag import Tag
 
 # from joblib import Parallel, delayed
 # from tqdm.auto import tqdm
 
 from ..modules import StructureSet, Dose, PET, Scan, Segmentation
+from ..utils.archive import is_archive_path, list_archive_dir, read_archive_series, read_dataset
 from ..utils.crawl import *
+from ..utils.header_cache import read_header
+from ..utils.crawl_index import CrawlIndex
+from ..utils.crawl_tree import CrawlTree
 from ..utils.dicomutils import *
 
 
@@ -23,10 +34,84 @@ def read_image(path):
     return sitk.ReadImage(path)
 
 
+class SeriesMetadata(Mapping):
+    """DICOM tags of a series, parsed from the header of one representative
+    slice (the first one) the first time they are accessed.
+
+    Like the metadata dictionaries of SimpleITK, the keys are "gggg|eeee"
+    tags and the values are strings, with multiple values separated by
+    backslashes. Tags can also be looked up by keyword, e.g. "PatientID".
+    Sequences and binary values are left out, the pydicom dataset of the
+    slice is the `header` attribute.
+
+    Parameters
+    ----------
+    path
+       Path to directory containing the DICOM series.
+
+    series_id, optional
+       Specifies the DICOM series if multiple series are present in the
+       directory, see `read_dicom_series`.
+
+    file_names, optional
+        Files of the series in slice order, in which case the directory is
+        not scanned.
+    """
+    def __init__(self,
+                 path: Optional[str] = None,
+                 series_id: Optional[str] = None,
+                 file_names: Optional[list] = None):
+        self.path = path
+        self.series_id = series_id
+        self.file_names = file_names
+        self._header = None
+        self._tags = None
+
+    @property
+    def file_name(self):
+        if self.file_names:
+            return self.file_names[0]
+        if is_archive_path(self.path):
+            return list_archive_dir(self.path)[0]
+        return sitk.ImageSeriesReader.GetGDCMSeriesFileNames(self.path, seriesID=self.series_id if self.series_id else "")[0]
+
+    @property
+    def header(self):
+        if self._header is None:
+            self._header = read_header(self.file_name)
+        return self._header
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            self._tags = {}
+            for element in self.header.iterall():
+                if element.VR == "SQ" or isinstance(element.value, bytes) or element.tag.group == 0xfffe:
+                    continue
+                if element.VM > 1:
+                    value = "\\".join(str(value) for value in element.value)
+                else:
+                    value = "" if element.value is None else str(element.value)
+                self._tags[f"{element.tag.group:04x}|{element.tag.element:04x}"] = value
+        return self._tags
+
+    def __getitem__(self, key):
+        if key not in self.tags and tag_for_keyword(key) is not None:
+            tag = Tag(tag_for_keyword(key))
+            key = f"{tag.group:04x}|{tag.element:04x}"
+        return self.tags[key]
+
+    def __iter__(self):
+        return iter(self.tags)
+
+    def __len__(self):
+        return len(self.tags)
+
+
 def read_dicom_series(path: str,
                       series_id: Optional[str] = None,
                       recursive: bool = False, 
-                      file_names: list = None):
+                      file_names: list = None) -> sitk.Image:
     """Read DICOM series as SimpleITK Image.
 
     Parameters
@@ -46,12 +131,50 @@ def read_dicom_series(path: str,
     file_names, optional
         If there are multiple acquisitions/"subseries" for an individual series,
         use the provided list of file_names to set the ImageSeriesReader.
+        The files must be in slice order, e.g. from `sorted_instances` on the
+        crawler output, in which case the directory is not scanned again.
+        Series inside archives (<archive>!/<member> paths) are decoded
+        straight from the archive with read_archive_series.
 
     Returns
     -------
-    The loaded image.
+    The loaded image. The tags of the slices are not loaded, see
+    `SeriesMetadata` for the tags shared by the slices and
+    `read_dicom_series_with_metadata` for the tags of every slice.
+
+    """
+    image, _ = _read_series(path, series_id, recursive, file_names, slice_metadata=False)
+    return image
+
+
+def read_dicom_series_with_metadata(path: str,
+                                    series_id: Optional[str] = None,
+                                    recursive: bool = False,
+                                    file_names: list = None):
+    """Read DICOM series as SimpleITK Image, with the tags of every slice,
+    private ones included. This is slow for long series; if only the tags
+    shared by the slices are needed, use `read_dicom_series` and
+    `SeriesMetadata` instead.
+
+    The parameters are those of `read_dicom_series`.
+
+    Returns
+    -------
+    The loaded image and the list of the tag dictionaries of its slices.
 
     """
+    return _read_series(path, series_id, recursive, file_names, slice_metadata=True)
+
+
+def _read_series(path, series_id, recursive, file_names, slice_metadata):
+    if file_names is None and is_archive_path(path):
+        file_names = list_archive_dir(path)
+    if file_names and is_archive_path(file_names[0]):
+        image = read_archive_series(file_names)
+        if slice_metadata:
+            return image, [dict(SeriesMetadata(file_names=[file_name])) for file_name in file_names]
+        return image, None
+
     reader = sitk.ImageSeriesReader()
     if file_names is None:
         file_names = reader.GetGDCMSeriesFileNames(path,
@@ -61,17 +184,102 @@ def read_dicom_series(path: str,
     
     reader.SetFileNames(file_names)
     
-    # Configure the reader to load all of the DICOM tags (public+private):
-    # By default tags are not loaded (saves time).
-    # By default if tags are loaded, the private tags are not loaded.
-    # We explicitly configure the reader to load tags, including the
-    # private ones.
-    reader.MetaDataDictionaryArrayUpdateOn()
-    reader.LoadPrivateTagsOn()
+    # By default the tags of the slices are not loaded (saves time), and if
+    # they are, the private tags are not. Both are only loaded on request.
+    if slice_metadata:
+        reader.MetaDataDictionaryArrayUpdateOn()
+        reader.LoadPrivateTagsOn()
+        image = reader.Execute()
+        return image, [{key: reader.GetMetaData(i, key) for key in reader.GetMetaDataKeys(i)} for i in range(len(file_names))]
+
+    return reader.Execute(), None
+
+
+def read_dicom_series_threaded(file_names: list,
+                               n_threads: Optional[int] = None,
+                               subseries: Optional[dict] = None) -> sitk.Image:
+    """Read DICOM series as SimpleITK Image, decoding its slices in parallel.
+
+    Every file is decoded by GDCM in a pool of threads (SimpleITK releases
+    the GIL while reading) and copied into one preallocated 3D array, which
+    is then wrapped as the image. The pixel type is the one of the first
+    slice, unless other slices decode to another type (e.g. they have another
+    rescale slope), in which case the array is converted to a type that holds
+    all of them. ImageSeriesReader casts them to the type of the first slice.
+
+    Parameters
+    ----------
+    file_names
+        Files of the series, one slice each, in slice order, e.g. from
+        `sorted_instances` on the crawler output.
+
+    n_threads, optional
+        Number of decoding threads, by default the number of CPUs.
+
+    subseries, optional
+        Subseries entry of the crawled database the files are from. If given,
+        the origin, direction and slice spacing are taken from the positions
+        and orientation it recorded instead of the decoded slices.
+
+    Returns
+    -------
+    The loaded image.
+
+    """
+    readers = threading.local()  # one reader per thread, they are not thread safe
+
+    def read_slice(file_name):
+        if not hasattr(readers, "reader"):
+            readers.reader = sitk.ImageFileReader()
+            readers.reader.SetImageIO("GDCMImageIO")
+        readers.reader.SetFileName(file_name)
+        return readers.reader.Execute()
+
+    first = read_slice(file_names[0])
+    pixels = sitk.GetArrayViewFromImage(first)
+    if pixels.ndim != 3 or pixels.shape[0] != 1 or first.GetNumberOfComponentsPerPixel() != 1:
+        raise ValueError(f"Expected single frame, single channel slices, {file_names[0]} is not.")
+    array = np.empty((len(file_names), *pixels.shape[1:]), dtype=pixels.dtype)
+    array[0] = pixels[0]
+
+    def decode(index):
+        image = read_slice(file_names[index])
+        pixels = sitk.GetArrayViewFromImage(image)
+        if pixels.shape[1:] != array.shape[1:] or pixels.shape[0] != 1:
+            raise ValueError(f"Slice {file_names[index]} does not have the shape of the first slice of the series.")
+        if pixels.dtype != array.dtype:
+            return image.GetOrigin(), pixels[0].copy()  # copied in once the array holds its type
+        array[index] = pixels[0]
+        return image.GetOrigin(), None
+
+    with ThreadPoolExecutor(max_workers=n_threads or os.cpu_count()) as pool:
+        decoded = list(pool.map(decode, range(1, len(file_names))))
+    origins = [first.GetOrigin()] + [origin for origin, _ in decoded]
+    other_types = {index: pixels for index, (_, pixels) in enumerate(decoded, start=1) if pixels is not None}
+    if other_types:
+        array = array.astype(np.result_type(array.dtype, *(pixels.dtype for pixels in other_types.values())))
+        for index, pixels in other_types.items():
+            array[index] = pixels
+
+    geometry = sorted_geometry(subseries) if subseries is not None else None
+    if geometry is not None:
+        orientation, origins = geometry
+        normal = np.cross(orientation[:3], orientation[3:])
+        direction = [orientation[0], orientation[3], normal[0],
+                     orientation[1], orientation[4], normal[1],
+                     orientation[2], orientation[5], normal[2]]
+    else:
+        direction = first.GetDirection()
+        normal = np.array(direction).reshape(3, 3)[:, 2]
+    spacing_slice = abs(float(np.dot(normal, np.subtract(origins[1], origins[0])))) if len(origins) > 1 else first.GetSpacing()[2]
+
+    image = sitk.GetImageFromArray(array)
+    image.SetOrigin([float(value) for value in origins[0]])
+    image.SetSpacing([*first.GetSpacing()[:2], spacing_slice or 1.])
+    image.SetDirection([float(value) for value in direction])
+    return image
 
-    return reader.Execute()
 
-    
 def read_dicom_scan(path, series_id=None, recursive: bool=False, file_names=None) -> Scan:
     image = read_dicom_series(path, series_id=series_id, recursive=recursive, file_names=file_names)
     return Scan(image, {})
@@ -81,53 +289,115 @@ def read_dicom_rtstruct(path):
     return StructureSet.from_dicom_rtstruct(path)
 
 
-def read_dicom_rtdose(path):
-    return Dose.from_dicom_rtdose(path)
+def read_dicom_rtdose(path, header=None):
+    return Dose.from_dicom_rtdose(path, header=header)
 
 
-def read_dicom_pet(path, series=None):
-    return PET.from_dicom_pet(path, series, "SUV")
+def read_dicom_pet(path, series=None, file_names=None, header=None):
+    return PET.from_dicom_pet(path, series, "SUV", file_names=file_names, header=header)
 
 
-def read_dicom_seg(path, meta, series=None):
-    seg_img = read_dicom_series(path, series)
+def read_dicom_seg(path, meta, series=None, file_names=None):
+    seg_img = read_dicom_series(path, series, file_names=file_names)
     return Segmentation.from_dicom_seg(seg_img, meta)
 
 
-def read_dicom_auto(path, series=None, file_names=None):
+# modalities read_dicom_auto has a reader for
+AUTO_MODALITIES = ['CT', 'MR', 'PT', 'RTSTRUCT', 'RTDOSE', 'SEG']
+
+
+def read_dicom_modality(path, dcm, meta, modality, series=None, file_names=None):
+    """Reads a series of a known modality, given the header `meta` of one of its files `dcm`,
+    which is also the metadata of the returned object.
+    """
+    if modality in ['CT', 'MR']:
+        obj = read_dicom_scan(path, series, file_names=file_names)
+    elif modality == 'PT':
+        obj = read_dicom_pet(path, series, file_names=file_names, header=meta)
+    elif modality == 'RTSTRUCT':
+        obj = read_dicom_rtstruct(dcm)
+    elif modality == 'RTDOSE':
+        obj = read_dicom_rtdose(dcm, header=meta)
+    elif modality == 'SEG':
+        obj = read_dicom_seg(path, meta, series, file_names=file_names)
+    else:
+        print(modality, 'at', dcm, 'is NOT implemented yet.')
+        raise NotImplementedError
+
+    obj.metadata.update(get_modality_metadata(meta, modality))
+    return obj
+
+
+def read_dicom_auto(path, series=None, file_names=None, modality=None):
+    """Reads the DICOM series in path, with the reader of its modality.
+
+    If the modality and the (slice ordered) file_names of the series are given, e.g. from the
+    crawler index, the directory is not scanned and only the header of the first file is read,
+    for the metadata. Otherwise the headers of the files in path are read until one belongs to
+    the series.
+    """
     if path is None:
         return None
+    if modality is not None and file_names:
+        if modality not in AUTO_MODALITIES:
+            print(modality, 'at', path, 'is NOT implemented yet.')
+            return None
+        return read_dicom_modality(path, file_names[0], read_header(file_names[0]), modality, series, file_names)
+
     if path.endswith(".dcm"):
         dcms = [path]
+    elif is_archive_path(path):
+        dcms = list_archive_dir(path)
     else:
         dcms = glob.glob(pathlib.Path(path, "*.dcm").as_posix())
         
     for dcm in dcms:
-        meta = dcmread(dcm)
+        meta = read_header(dcm)
         if meta.SeriesInstanceUID != series and series is not None:
             continue
         
         modality = meta.Modality
-        if modality in ['CT', 'MR']:
-            obj = read_dicom_scan(path, series, file_names=file_names)
-        elif modality == 'PT':
-            obj = read_dicom_pet(path, series)
-        elif modality == 'RTSTRUCT':
-            obj = read_dicom_rtstruct(dcm)
-        elif modality == 'RTDOSE':
-            obj = read_dicom_rtdose(dcm)
-        elif modality == 'SEG':
-            obj = read_dicom_seg(path, meta, series)
-        else:
-            if len(dcms) == 1:
-                print(modality, 'at', dcms[0], 'is NOT implemented yet.')
-                raise NotImplementedError
-            else:
-                print("There were no dicoms in this path.")
-                return None
-        
-        obj.metadata.update(get_modality_metadata(meta, modality))
-        return obj
+        if modality not in AUTO_MODALITIES and len(dcms) != 1:
+            print("There were no dicoms in this path.")
+            return None
+        return read_dicom_modality(path, dcm, meta, modality, series, file_names)
+
+
+def load_tree(json_path):
+    """Returns the crawled database (patient -> study -> series -> subseries) saved
+    at json_path, which can be a .json/.tree file or a crawl index (.db), or the
+    database itself if it is already a mapping.
+    """
+    if isinstance(json_path, str) and json_path.endswith(".db"):
+        return CrawlIndex(json_path).tree()  # patients are loaded from the index on access
+    elif isinstance(json_path, str) and json_path.endswith(".tree"):
+        return CrawlTree(json_path)  # patients are decoded from the memory-mapped file on access
+    elif isinstance(json_path, str):
+        with open(json_path, 'r') as f:
+            return json.load(f)
+    elif isinstance(json_path, Mapping):
+        return json_path
+    raise ValueError(f"Expected a path to a json/tree file or crawl index, not {type(json_path)}.")
+
+
+def call_reader(reader, path, series, **kwargs):
+    """Calls reader(path, series, **kwargs) with only the arguments the reader accepts, so that the
+    loaders can pass what they know about a series (e.g. file_names and modality from the crawler)
+    to read_dicom_auto without breaking read_image or the readers of a single modality.
+    """
+    try:
+        parameters = inspect.signature(reader).parameters.values()
+    except (TypeError, ValueError):  # builtins without a signature get the arguments of the legacy loaders
+        return reader(path, series)
+    if any(parameter.kind == parameter.VAR_KEYWORD for parameter in parameters):
+        accepted = kwargs
+    else:
+        names = {parameter.name for parameter in parameters if parameter.kind in (parameter.POSITIONAL_OR_KEYWORD, parameter.KEYWORD_ONLY)}
+        accepted = {key: value for key, value in kwargs.items() if key in names}
+    positional = [parameter for parameter in parameters if parameter.kind in (parameter.POSITIONAL_ONLY, parameter.POSITIONAL_OR_KEYWORD)]
+    if len(positional) > 1 or any(parameter.kind == parameter.VAR_POSITIONAL for parameter in parameters):
+        return reader(path, series, **accepted)
+    return reader(path, **accepted)
 
 
 class BaseLoader:
@@ -163,13 +433,17 @@ class ImageTreeLoader(BaseLoader):
                  subseries_names=[],
                  id_column=None,
                  expand_paths=False,
-                 readers=None):
+                 readers=None,
+                 root_directory=None):
 
         if readers is None:
             readers = [read_image]  # no mutable defaults https://florimond.dev/en/posts/2018/08/python-mutable-defaults-are-the-source-of-all-evil/
 
+        # the crawled file paths are relative to the directory containing both the dataset and .imgtools
+        if root_directory is None and isinstance(json_path, str):
+            root_directory = os.path.dirname(os.path.dirname(os.path.abspath(json_path)))
+        self.root_directory = root_directory
         self.expand_paths = expand_paths
-        self.readers = readers
         self.colnames = col_names
         self.studynames = study_names
         self.seriesnames = series_names
@@ -189,14 +463,11 @@ class ImageTreeLoader(BaseLoader):
         else:
             raise ValueError(f"Expected a path to csv file or pd.DataFrame, not {type(csv_path_or_dataframe)}.")
         
-        if isinstance(json_path, str):
-            with open(json_path, 'r') as f:
-                self.tree = json.load(f)
-        else:
-            raise ValueError(f"Expected a path to a json file, not {type(json_path)}.")
+        self.tree = load_tree(json_path)
 
         if not isinstance(readers, list):
             readers = [readers] * len(self.colnames)
+        self.readers = readers
 
         self.output_tuple = namedtuple("Output", self.colnames)
 
@@ -212,10 +483,13 @@ class ImageTreeLoader(BaseLoader):
             # paths = {col: glob.glob(path)[0] for col, path in paths.items()}
             paths = {col: glob.glob(path)[0] if pd.notna(path) else None for col, path in paths.items()}
         
+        outputs = {}
         for i, (col, path) in enumerate(paths.items()):
-            files = self.tree[subject_id][study["study_"+("_").join(col.split("_")[1:])]][series["series_"+("_").join(col.split("_")[1:])]][subseries["subseries_"+("_").join(col.split("_")[1:])]]
-            self.readers[i](path, series["series_"+("_").join(col.split("_")[1:])])
-        outputs = {col: self.readers[i](path, series["series_"+("_").join(col.split("_")[1:])], file_names=files) for i, (col, path) in enumerate(paths.items())}
+            suffix = ("_").join(col.split("_")[1:])
+            entry = self.tree[subject_id][study["study_"+suffix]][series["series_"+suffix]][subseries["subseries_"+suffix]]
+            # slice ordered file list and modality from the crawler, so the readers don't have to scan the directory again
+            files = sorted_instances(entry, self.root_directory)
+            outputs[col] = call_reader(self.readers[i], path, series["series_"+suffix], file_names=files, modality=entry['modality'])
         return self.output_tuple(**outputs)
 
     def keys(self):
@@ -232,13 +506,21 @@ class ImageCSVLoader(BaseLoader):
                  seriesnames=[],
                  id_column=None,
                  expand_paths=False,
-                 readers=None):
+                 readers=None,
+                 tree=None,
+                 root_directory=None):
+        """
+        If the crawled database (tree, see load_tree) is given, the readers that accept them also get the modality
+        and the slice ordered files of every series from it (as in ImageTreeLoader, see call_reader), so that read_dicom_auto does not scan the
+        series directories. The crawled paths are relative to root_directory, one level above the dataset.
+        """
 
         if readers is None:
             readers = [read_image]  # no mutable defaults https://florimond.dev/en/posts/2018/08/python-mutable-defaults-are-the-source-of-all-evil/
 
         self.expand_paths = expand_paths
-        self.readers = readers
+        self.tree = load_tree(tree) if tree is not None else None
+        self.root_directory = root_directory
 
         self.colnames = colnames
         self.seriesnames = seriesnames
@@ -258,6 +540,7 @@ class ImageCSVLoader(BaseLoader):
 
         if not isinstance(readers, list):
             readers = [readers] * len(self.colnames)
+        self.readers = readers
 
         self.output_tuple = namedtuple("Output", self.colnames)
 
@@ -270,9 +553,30 @@ class ImageCSVLoader(BaseLoader):
             # paths = {col: glob.glob(path)[0] for col, path in paths.items()}
             paths = {col: glob.glob(path)[0] if pd.notna(path) else None for col, path in paths.items()}
         
-        outputs = {col: self.readers[i](path,series["series_"+("_").join(col.split("_")[1:])]) for i, (col, path) in enumerate(paths.items())}
+        outputs = {}
+        for i, (col, path) in enumerate(paths.items()):
+            series_uid = series["series_"+("_").join(col.split("_")[1:])]
+            entry = self._crawled_subseries(row, series_uid) if path is not None else None
+            if entry is None:
+                outputs[col] = call_reader(self.readers[i], path, series_uid)
+            else:
+                # slice ordered file list and modality from the crawler, so the readers don't have to scan the directory again
+                outputs[col] = call_reader(self.readers[i], path, series_uid, file_names=sorted_instances(entry, self.root_directory),
+                                           modality=entry['modality'])
         return self.output_tuple(**outputs)
 
+    def _crawled_subseries(self, row, series_uid):
+        """Crawled entry of the series, or None without a tree or if the series has several subseries."""
+        if self.tree is None or 'patient_ID' not in row:
+            return None
+        for study in self.tree.get(str(row['patient_ID']), {}).values():
+            subseries = study.get(series_uid) if isinstance(study, Mapping) else None
+            if subseries is not None:
+                entries = [entry for key, entry in subseries.items() if key != 'description']
+                # a series read by GDCM includes all of its subseries, their files are only sorted separately
+                return entries[0] if len(entries) == 1 else None
+        return None
+
     def keys(self):
         return list(self.paths.index)
 
@@ -2,6 +2,8 @@ from .segmentation import *
 from .structureset import *
 from .pet import *
 from .dose import *
+from .graph_engine import *
 from .datagraph import *
+from .graph_view import *
 from .sparsemask import *
 from .scan import *
@@ -1,10 +1,23 @@
+import hashlib
+import io
 import os
 import time
 import pathlib
-from typing import List
+from typing import Dict, List, Optional
+from collections import OrderedDict
 from functools import reduce
 import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
+
+from ..utils.crawl_index import CrawlIndex
+from .graph_engine import GraphEngine, StudyIndex, regex_to_masks, file_hash, save_edge_cache, load_edge_cache
+from .graph_view import graph_view, write_graph_view
+
+
+# crawl columns the graph is formed and queried on
+GRAPH_COLUMNS = ['patient_ID', 'study', 'series', 'subseries', 'modality', 'instance_uid',
+                 'reference_ct', 'reference_rs', 'reference_pl', 'folder']
 
 
 class DataGraph:
@@ -25,81 +38,241 @@ class DataGraph:
     For ex:
     query = ["CT","RTDOSE","RTSTRUCT","PT], will return interconnected studies containing the listed DICOM modalities. The interconnected studies for example may look like 
     (RTDOSE->RTSTRUCT->CT<-PT<-RTSTRUCT)
+    The studies matching a query are selected on a StudyIndex (bitsets of the modalities and edge types of every study), which also
+    answers count(query) without forming the sub-dataset, e.g. for cohort sizing.
     '''
+    # results of parser per (crawl hash, dataset directory, query), shared by the DataGraphs of a process
+    _query_memo = OrderedDict()
+    memo_size = 32
+
     def __init__(self,
                  path_crawl: str,
                  edge_path: str = "./patient_id_full_edges.csv",
-                 visualize: bool = False) -> None:
+                 visualize: bool = False,
+                 columns: Optional[List[str]] = None) -> None:
         '''
         Parameters
         ----------
         path_crawl
-            The csv returned by the crawler
+            The csv returned by the crawler, or its SQLite index (.db, see CrawlIndex)
 
         edge_path
-            This path denotes where the graph in the form of edge table is stored or to be stored
+            This path denotes where the graph in the form of edge table is stored or to be stored. The edge table is also
+            cached in an .npz next to it (see _save_edges), and formed again if the crawl changed since it was saved
+
+        columns
+            Crawl columns to load and keep in the edge table besides GRAPH_COLUMNS, e.g. ["series_description"], or
+            CRAWL_COLUMNS for all of them
         '''
-        self.df = pd.read_csv(path_crawl, index_col=0)
+        self.path_crawl = path_crawl
+        self.columns = GRAPH_COLUMNS + [column for column in columns or [] if column not in GRAPH_COLUMNS]
+        self.df = self._read_crawl(path_crawl, self.columns)
         self.edge_path = edge_path
+        self.cache_path = pathlib.Path(edge_path).with_suffix(".npz").as_posix()
+        self.crawl_hash = file_hash(path_crawl)
         self.df_new = None
-        if os.path.exists(self.edge_path):
+        df_edges = load_edge_cache(self.cache_path, self._cache_stamp())
+        if df_edges is not None and os.path.exists(self.edge_path):
             print("Edge table is already present. Loading the data...")
-            self.df_edges = pd.read_csv(self.edge_path)
+            self.df_edges = df_edges
+            self.study_index = StudyIndex(self.df, self.df_edges)
+        elif os.path.exists(self.edge_path):
+            print("Edge table was not formed from this crawl. Forming the edge table again...")
+            self.form_graph()
         else:
             print("Edge table not present. Forming the edge table based on the crawl data...")
             self.form_graph()
         if visualize:
             self.visualize_graph()
     
+    @staticmethod
+    def _read_crawl(path_crawl: str, columns: List[str]) -> pd.DataFrame:
+        '''
+        Reads the given columns of the crawl as categoricals of the strings of their values (see _string_categories)
+        '''
+        if path_crawl.endswith(".db"):
+            # empty strings as missing values, like read_csv does
+            df = CrawlIndex(path_crawl).to_df()
+            df = df[[column for column in df.columns if column in columns]]
+            df = df.mask(df == "")
+        else:
+            df = pd.read_csv(path_crawl, index_col=0, usecols=lambda column: column in columns or column == "" or column.startswith("Unnamed: 0"))
+        for col in df:
+            df[col] = DataGraph._string_categories(df[col])
+        return df
+
+    @staticmethod
+    def _string_categories(values: pd.Series) -> pd.Series:
+        '''
+        Returns values.astype(str) (with missing values as "nan") as a categorical, without creating a string for
+        every row. Repeated UIDs, modalities and folders are then stored once.
+        '''
+        codes, uniques = pd.factorize(values, use_na_sentinel=False)
+        # different values can have the same string, e.g. 1 and "1" in a column of mixed types
+        string_codes, strings = pd.factorize(pd.Index(uniques).astype(str))
+        return pd.Series(pd.Categorical.from_codes(string_codes[codes], categories=strings), index=values.index, name=values.name)
+
+    def _cache_stamp(self) -> str:
+        # the edge table depends on the crawl and on its columns
+        return f"{self.crawl_hash}:{','.join(self.columns)}"
+
     def form_graph(self):
         '''
         Forms edge table based on the crawled data
         '''
-        # enforce string type to all columns to prevent dtype merge errors for empty columns
-        for col in self.df:
-            self.df[col] = self.df[col].astype(str)
-        
-        #Get reference_rs information from RTDOSE-RTPLAN connections    
-        df_filter = pd.merge(self.df, self.df[["instance_uid","reference_rs"]].apply(lambda x: x.astype(str), axis=1), 
-                             left_on="reference_pl", 
-                             right_on="instance_uid", 
-                             how="left")
-        
-        df_filter.loc[(df_filter.reference_rs_x.isna()) & (~df_filter.reference_rs_y.isna()),"reference_rs_x"] = df_filter.loc[(df_filter.reference_rs_x.isna()) & (~df_filter.reference_rs_y.isna()),"reference_rs_y"].values
-        df_filter.drop(columns=["reference_rs_y", "instance_uid_y"], inplace=True)
-        df_filter.rename(columns={"reference_rs_x":"reference_rs", "instance_uid_x":"instance_uid"}, inplace=True)
-        
-        # Remove entries with no RTDOSE reference, for extra check, such cases are mostprobably removed in the earlier step
-        df_filter = df_filter.loc[~((df_filter["modality"] == "RTDOSE") & (df_filter["reference_ct"].isna()) & (df_filter["reference_rs"].isna()))]
+        # all columns are strings (see _read_crawl) to prevent dtype merge errors for empty columns
+        self.df_edges = self._form_edge_table(self.df)
+        self.study_index = StudyIndex(self.df, self.df_edges)
+        self._save_edges()
 
-        # Get all study ids
-        # all_study = df_filter.study.unique()
-        start = time.time()
+    def update_patients(self, patient_ids: List[str], df_patients: Optional[pd.DataFrame] = None, save: bool = True):
+        '''
+        Re-forms the edges of the given patients after their crawl data changed (e.g. new files of these
+        patients were crawled, see CrawlWatcher), keeping the edges of all other patients. The crawl is read
+        again from path_crawl, unless the new crawl rows of the patients are given. DICOM references are assumed
+        to stay within a patient, so the edges of a patient only depend on its own rows of the crawl. The edge table
+        is then the same as the one form_graph forms from the new crawl, in the same order; if the kept edges are not
+        in the new crawl or not in its order (e.g. a reference across patients, or rows of other patients moved), the
+        whole edge table is formed again.
+
+        Parameters
+        ----------
+        patient_ids
+            Patients whose crawl data changed
 
-        # Defining Master df to store all the Edge dataframes
-        # self.df_master = []
+        df_patients, optional
+            All the crawl rows of these patients (e.g. to_df of their crawled database), replacing their rows of the
+            crawl in memory. The rows of new patients are added after the others.
 
-        # for i in tqdm(range(len(all_study))):
-        #     self._form_edge_study(df_filter, all_study, i)
+        save, optional
+            Whether to save the edge table. Without saving, the edge table is only updated in memory, e.g. while the
+            crawl files are not written again yet.
+        '''
+        patient_ids = {str(patient_id) for patient_id in patient_ids}
+        if df_patients is None:
+            self.df = self._read_crawl(self.path_crawl, self.columns)
+            self.crawl_hash = file_hash(self.path_crawl)
+        else:
+            self.df = self._replace_rows(patient_ids, df_patients)
+        self.df_new = None  # aggregates of the old edges
+
+        df_keep  = self.df_edges.loc[~self.df_edges.patient_ID_x.astype(str).isin(patient_ids)]
+        df_edges = self._form_edge_table(self.df.loc[self.df.patient_ID.isin(patient_ids)])
+        df_edges = pd.concat([df_keep, df_edges], ignore_index=True)
+        keys = self._edge_keys(df_edges)
+        # which RTDOSE edge of an RTSTRUCT is kept depends on the crawl order, so the kept edges have to stay in order
+        if keys is None or not self._sorted([key[:len(df_keep)] for key in keys]):
+            print("Crawl of other patients changed. Forming the edge table again...")
+            df_edges = self._form_edge_table(self.df)
+        else:
+            df_edges = df_edges.iloc[np.lexsort(keys[::-1])].reset_index(drop=True)
+        self.df_edges = df_edges
+        self.study_index = StudyIndex(self.df, self.df_edges)
+        if save:
+            self._save_edges()
 
-        # df_edge_patient = form_edge_study(df,all_study,i)
-        
-        self.df_edges = self._form_edges(self.df)  # pd.concat(self.df_master, axis=0, ignore_index=True)
-        end = time.time()
-        print(f"\nTotal time taken: {end - start}")
+    def _replace_rows(self, patient_ids, df_patients):
+        '''
+        Returns the crawl in memory with the rows of the given patients replaced by df_patients, read as by _read_crawl.
+        The new rows of a patient take the place of its old ones. The crawl hash becomes a hash of the update, so
+        that neither the edge cache nor the memoized queries of the crawl file are used for the crawl in memory.
+        '''
+        replaced = self.df.patient_ID.isin(patient_ids).to_numpy()
+        df_keep = self.df.loc[~replaced]
+        csv = df_patients.to_csv() if len(df_patients) > 0 else ""
+        if csv:
+            # written and read back like the crawl CSV, so the values are the same strings
+            df_new = pd.read_csv(io.StringIO(csv), index_col=0, usecols=lambda column: column in self.columns or column == "" or column.startswith("Unnamed: 0"))
+            first_rows = pd.Series(np.flatnonzero(replaced), index=self.df.patient_ID[replaced].astype(str).to_numpy()).groupby(level=0).min()
+            ranks = np.concatenate([np.flatnonzero(~replaced),
+                                    df_new.patient_ID.astype(str).map(first_rows).fillna(len(self.df)).to_numpy()])
+            order = np.argsort(ranks, kind="stable")
+            # the categories of the kept rows are extended, their strings are not created again
+            df = pd.DataFrame({col: pd.Series(union_categoricals([df_keep[col].array, self._string_categories(df_new[col]).array]))
+                               .iloc[order].reset_index(drop=True) for col in self.df.columns})
+        else:
+            df = df_keep.reset_index(drop=True)
 
+        self.crawl_hash = hashlib.sha1(f"{self.crawl_hash}:{','.join(sorted(patient_ids))}:{csv}".encode()).hexdigest()
+        return df
 
-        self.df_edges.loc[self.df_edges.study_x.isna(),"study_x"] = self.df_edges.loc[self.df_edges.study_x.isna(), "study"]
-        # dropping some columns
-        self.df_edges.drop(columns=["study_y", "patient_ID_y", "series_description_y", "study_description_y", "study"],inplace=True)
-        self.df_edges.sort_values(by="patient_ID_x", ascending=True)
+    def _edge_keys(self, df_edges):
+        '''
+        Returns the keys that _form_edge_table orders the edges of df_edges by for the crawl in self.df: the edge type,
+        the join forming the edge (see EDGE_JOINS), and the crawl rows of the referenced and the referencing series.
+        Returns None if the series of an edge are not in the crawl.
+        '''
+        # crawl rows are identified by their series and subseries, hashed into integers once
+        n = [len(self.df), len(df_edges), len(df_edges)]
+        series, _    = pd.factorize(np.concatenate([self.df.series, df_edges.series_x, df_edges.series_y]))
+        subseries, _ = pd.factorize(np.concatenate([self.df.subseries, df_edges.subseries_x, df_edges.subseries_y]))
+        crawl, dst, src = np.split(series.astype(np.int64) * (subseries.max(initial=0) + 1) + subseries, np.cumsum(n)[:-1])
+        crawl = pd.Index(crawl)
+        if not crawl.is_unique:
+            return None
+        dst, src = crawl.get_indexer(dst), crawl.get_indexer(src)
+        if (dst < 0).any() or (src < 0).any():
+            return None
+
+        # RTSTRUCTs referenced by series instead of instance, MR instead of CT series
+        join = (((df_edges.edge_type == 0) & (df_edges.reference_rs_y != df_edges.instance_uid_x)) |
+                ((df_edges.edge_type == 2) & (df_edges.modality_x == "MR")))
+        return [df_edges.edge_type.to_numpy(), join.to_numpy(), dst, src]
+
+    @staticmethod
+    def _sorted(keys):
+        '''
+        Whether the rows of the key arrays are in ascending lexicographic order
+        '''
+        if len(keys[0]) < 2:
+            return True
+        ascending, tied = np.zeros(len(keys[0]) - 1, dtype=bool), np.ones(len(keys[0]) - 1, dtype=bool)
+        for key in keys:
+            ascending |= tied & (key[1:] > key[:-1])
+            tied &= key[1:] == key[:-1]
+        return bool(np.all(ascending | tied))
+
+    def _save_edges(self):
+        '''
+        Saves the edge table as CSV in edge_path and as typed arrays, stamped with the hash of the crawl, in cache_path
+        (the .npz next to it). DataGraph loads the .npz if it was formed from the same crawl and forms the edges again otherwise.
+        '''
         print(f"Saving edge table in {self.edge_path}")
-        self.df_edges.to_csv(self.edge_path, index=False)
+        # missing values as written by form_graph, whose edges are all strings
+        self.df_edges.to_csv(self.edge_path, index=False, na_rep="nan")
+        save_edge_cache(self.cache_path, self.df_edges, self._cache_stamp())
 
-    def visualize_graph(self):
+    def _form_edge_table(self, df):
+        '''
+        Forms the edge table of the crawled data (with all columns as strings), as saved by form_graph
+        '''
+        start = time.time()
+        engine = GraphEngine(df)
+        edges  = self._form_edges(df, engine)
+        end = time.time()
+        print(f"\nTotal time taken: {end - start}")
+
+        # the study is the same on both ends of an edge
+        return engine.materialize(edges, drop=["study_y", "patient_ID_y", "series_description_y", "study_description_y"])
+
+    def visualize_graph(self, level: Optional[str] = None, max_nodes: int = 5000, seed: int = 0) -> str:
         """
         Generates visualization using Pyviz, a wrapper around visJS. The visualization can be found at datanet.html
+
+        With a level ("series", "study" or "patient", see graph_view), or for graphs with more series than max_nodes,
+        writes a static view of the graph instead, sampled to max_nodes nodes, in datanet_<level>.html and .json.
+        Returns the path of the page.
         """
+        if level is None:
+            series = pd.unique(np.concatenate([self.df_edges["series_x"].to_numpy(dtype=object), self.df_edges["series_y"].to_numpy(dtype=object)]))
+            if len(series) > max_nodes:
+                print(f"The graph has {len(series)} series, viewing it at the study level instead...")
+                level = "study"
+        if level is not None:
+            print("Generating visualizations...")
+            view = graph_view(self.df_edges, level=level, max_nodes=max_nodes, seed=seed)
+            return write_graph_view(view, pathlib.Path(os.path.dirname(self.edge_path), f"datanet_{level}.html").as_posix())
+
         from pyvis.network import Network  # type: ignore (PyLance)
         print("Generating visualizations...")
         data_net = Network(height='100%', width='100%', bgcolor='#222222', font_color='white')
@@ -130,62 +303,15 @@ class DataGraph:
 
         vis_path = pathlib.Path(os.path.dirname(self.edge_path),"datanet.html").as_posix()
         data_net.show(vis_path)
+        return vis_path
 
-    def _form_edges(self, df):
+    def _form_edges(self, df, engine=None):
         '''
-        For a given study id forms edge table
+        Forms the edges of the crawled data as integer arrays of crawl rows (see GraphEngine), ordered by edge type
         '''
-
-        df_list = []
-
-        # Split into each modality
-        plan = df[df["modality"] == "RTPLAN"]
-        dose = df[df["modality"] == "RTDOSE"]
-        struct = df[df["modality"] == "RTSTRUCT"]
-        seg = df[df["modality"] == "SEG"]
-        ct = df[df["modality"] == "CT"]
-        mr = df[df["modality"] == "MR"]
-        pet = df[df["modality"] == "PT"]
-
-        edge_types = np.arange(7)
-        for edge in edge_types:
-            if edge==0:    # FORMS RTDOSE->RTSTRUCT, can be formed on both series and instance uid
-                df_comb1    = pd.merge(struct, dose, left_on="instance_uid", right_on="reference_rs")
-                df_comb2    = pd.merge(struct, dose, left_on="series", right_on="reference_rs")
-                df_combined = pd.concat([df_comb1, df_comb2])
-                # Cases where both series and instance_uid are the same for struct
-                df_combined = df_combined.drop_duplicates(subset=["instance_uid_x"])
-
-            elif edge==1:  # FORMS RTDOSE->CT 
-                df_combined = pd.merge(ct, dose, left_on="series", right_on="reference_ct")
-
-            elif edge==2:  # FORMS RTSTRUCT->CT on ref_ct to series
-                df_ct = pd.merge(ct, struct, left_on="series", right_on="reference_ct")
-                df_mr = pd.merge(mr, struct, left_on="series", right_on="reference_ct")
-                df_combined = pd.concat([df_ct, df_mr])
-
-            elif edge==3:  # FORMS RTSTRUCT->PET on ref_ct to series
-                df_combined = pd.merge(pet, struct, left_on="series", right_on="reference_ct")
-
-            elif edge==4:  # FORMS PET->CT on study
-                df_combined = pd.merge(ct, pet, left_on="study", right_on="study")
-
-            elif edge==5:  # FORMS RTPLAN->RTDOSE on ref_pl
-                df_combined = pd.merge(plan, dose, left_on="instance_uid", right_on="reference_pl")
-
-            elif edge==7:
-                df_ct = pd.merge(ct, seg, left_on="series", right_on="reference_ct")
-                df_mr = pd.merge(mr, seg, left_on="series", right_on="reference_ct")
-                df_combined = pd.concat([df_ct, df_mr])
-
-            else:
-                df_combined = pd.merge(struct, plan, left_on="instance_uid", right_on="reference_rs")
-
-            df_combined["edge_type"] = edge
-            df_list.append(df_combined)
-
-        df_edges = pd.concat(df_list, axis=0, ignore_index=True)
-        return df_edges
+        if engine is None:
+            engine = GraphEngine(df)
+        return engine.edges()
 
     def _form_edge_study(self, df, all_study, study_id):
         '''
@@ -272,23 +398,157 @@ class DataGraph:
         11) RTSTRUCT,CT,PT
         12) RTDOSE,RTSTRUCT,CT,PT
         '''
-        # Basic processing of just one modality
-        supp_mods   = ["RTDOSE", "RTSTRUCT", "CT", "PT", 'MR', 'SEG']
-        edge_def    = {"RTSTRUCT,RTDOSE" : 0, "CT,RTDOSE" : 1, "CT,RTSTRUCT" : 2, "PET,RTSTRUCT" : 3, "CT,PT" : 4, 'MR,RTSTRUCT': 2, "RTPLAN,RTSTRUCT": 6, "RTPLAN,RTDOSE": 5, "CT,SEG": 7, "MR,SEG": 7}
         self.mods   = query_string.split(",")
         self.mods_n = len(self.mods)
+        final_df = self._memo_get(query_string)
+        if final_df is not None:
+            return final_df
+        plan = self._query_plan(query_string)
 
         # Deals with single node queries
-        if query_string in supp_mods:
-            final_df = self.df.loc[self.df.modality == query_string, ["study", "patient_ID", "series", "folder", "subseries"]]
+        if plan[0] == "modality":
+            final_df = self.df.loc[self.df.modality == query_string, ["study", "patient_ID", "series", "folder", "subseries"]].astype(object)
             final_df.rename(columns = {"series": f"series_{query_string}", 
                                        "study": f"study_{query_string}", 
                                        "folder": f"folder_{query_string}",
                                        "subseries": f"subseries_{query_string}", }, inplace=True)
+
+        elif plan[0] == "edge":
+            _, edge_type, valid = plan
+            final_df = self.df_edges.loc[self.df_edges.edge_type == edge_type, ["study","patient_ID_x", "study_x", "study_y", "series_x","folder_x","series_y","folder_y", "subseries_x", "subseries_y"]]
+            node_dest = valid.split(",")[0]
+            node_origin = valid.split(",")[1]
+            final_df.rename(columns={"study": "study", 
+                                     "patient_ID_x": "patient_ID",
+                                     "series_x": f"series_{node_dest}", 
+                                     "series_y": f"series_{node_origin}", 
+                                     
+                                     "study_x": f"study_{node_dest}", 
+                                     "study_y": f"study_{node_origin}", 
+                                     "folder_x": f"folder_{node_dest}", 
+                                     "folder_y": f"folder_{node_origin}",
+                                     
+                                     "subseries_x": f"subseries_{node_dest}", 
+                                     "subseries_y": f"subseries_{node_origin}", }, inplace=True)
+
+        else:
+            _, regex_term, edge_list, change_df = plan
+            final_df = self.graph_query(regex_term, edge_list, change_df)
         
-        elif self.mods_n == 2:
+        final_df = self._finalize(final_df)
+        self._memo_put(query_string, final_df, self.final_dict if plan[0] == "graph" else None)
+        return final_df
+
+    def parse_queries(self, query_strings: List[str]) -> Dict[str, pd.DataFrame]:
+        '''
+        Answers several queries (see parser) at once, returning the dataframe of every query. The queries on the same
+        edge types share one pass over the components of all the studies any of them selects, after which every query
+        keeps the components of its own studies with all of its modalities. Results are memoized like those of parser.
+        '''
+        results, graph_queries = {}, {}
+        for query_string in dict.fromkeys(query_strings):
+            plan = self._query_plan(query_string)
+            if plan[0] != "graph" or self._memo_key(query_string) in self._query_memo:
+                results[query_string] = self.parser(query_string)
+            else:
+                graph_queries.setdefault(tuple(plan[2]), []).append((query_string, plan))
+
+        for edge_list, queries in graph_queries.items():
+            selections = [self._select_studies(plan[1]) for _, plan in queries]
+            studies = pd.Index(np.concatenate(selections)).unique().sort_values()
+            df_processed = self.df_edges.loc[self.df_edges.study_x.isin(studies) & (self.df_edges.edge_type.isin(edge_list))]
+            components = self._components(df_processed, studies)
+            for (query_string, plan), selected in zip(queries, selections):
+                self.mods   = query_string.split(",")
+                self.mods_n = len(self.mods)
+                selected, mods_wanted = set(selected), set(self.mods)
+                kept = [component for component in components if component[0] in selected and mods_wanted.issubset(component[3])]
+                self.final_dict = [component[1] for component in kept]
+                final_df = self._remove_columns(pd.DataFrame([component[2] for component in kept]), plan[3])
+                final_df = self._finalize(final_df)
+                self._memo_put(query_string, final_df, self.final_dict)
+                results[query_string] = final_df
+        return {query_string: results[query_string] for query_string in query_strings}
+
+    def _finalize(self, final_df):
+        '''
+        Indexes the dataframe of a query by row and patient, and makes its folders absolute
+        '''
+        final_df.reset_index(drop=True, inplace=True)
+        final_df["index_chng"] = final_df.index.astype(str) + "_" + final_df["patient_ID"].astype(str)
+        final_df.set_index("index_chng", inplace=True)
+        final_df.rename_axis(None, inplace=True)
+        # change relative paths to absolute paths
+        parent = os.path.split(os.path.dirname(self.edge_path))[0]
+        for col in final_df.columns:
+            if col.startswith("folder"):
+                final_df[col] = self._join_folders(parent, final_df[col])  # input folder joined with the rel path
+        return final_df
+
+    @staticmethod
+    def _join_folders(parent: str, folders: pd.Series) -> pd.Series:
+        '''
+        Returns pathlib.Path(parent, folder).as_posix() for the string folders, keeping other values. Plain relative
+        folders (as saved by the crawler) are joined as strings, the others with pathlib.
+        '''
+        values = folders.to_numpy(dtype=object).copy()
+        is_str = np.fromiter((isinstance(value, str) for value in values), dtype=bool, count=len(values))
+        if not is_str.any():
+            return folders
+        parent = pathlib.Path(parent).as_posix()
+        prefix = "" if parent == "." else parent if parent.endswith("/") else f"{parent}/"
+        # no absolute paths, drives, backslashes, empty or "." parts that pathlib would change
+        plain = pd.Series(values[is_str]).str.match(r"^(?!/)(?!\.(?:/|$))(?!.*//)(?!.*/\.(?:/|$))[^\\:]*[^/]$").to_numpy(dtype=bool)
+        rows = np.flatnonzero(is_str)
+        values[rows[plain]] = prefix + pd.Series(values[rows[plain]], dtype=object)
+        values[rows[~plain]] = [pathlib.Path(parent, value).as_posix() for value in values[rows[~plain]]]
+        return pd.Series(values, index=folders.index, name=folders.name)
+
+    def _memo_key(self, query_string: str):
+        return (self.crawl_hash, os.path.abspath(os.path.dirname(self.edge_path)), query_string)
+
+    def _memo_get(self, query_string: str):
+        key = self._memo_key(query_string)
+        if key not in self._query_memo:
+            return None
+        self._query_memo.move_to_end(key)
+        final_df, final_dict = self._query_memo[key]
+        if final_dict is not None:
+            self.final_dict = list(final_dict)
+        return final_df.copy()
+
+    def _memo_put(self, query_string: str, final_df, final_dict) -> None:
+        self._query_memo[self._memo_key(query_string)] = (final_df.copy(), None if final_dict is None else list(final_dict))
+        while len(self._query_memo) > self.memo_size:
+            self._query_memo.popitem(last=False)
+
+    @classmethod
+    def clear_memo(cls) -> None:
+        '''
+        Forgets the memoized results of parser, e.g. after the data of a dataset changed without being crawled again
+        '''
+        cls._query_memo.clear()
+    
+    def _query_plan(self, query_string: str):
+        '''
+        Decides how a query (see parser) is answered:
+        1) ("modality", modality): the series of one modality
+        2) ("edge", edge type, pair): the edges of one type
+        3) ("graph", regex, edge list, columns to remove): the components of the studies whose edge types match the
+           regex, see graph_query
+        '''
+        # Basic processing of just one modality
+        supp_mods   = ["RTDOSE", "RTSTRUCT", "CT", "PT", 'MR', 'SEG']
+        edge_def    = {"RTSTRUCT,RTDOSE" : 0, "CT,RTDOSE" : 1, "CT,RTSTRUCT" : 2, "PET,RTSTRUCT" : 3, "CT,PT" : 4, 'MR,RTSTRUCT': 2, "RTPLAN,RTSTRUCT": 6, "RTPLAN,RTDOSE": 5, "CT,SEG": 7, "MR,SEG": 7}
+        mods   = query_string.split(",")
+        mods_n = len(mods)
+
+        if query_string in supp_mods:
+            return ("modality", query_string)
+
+        elif mods_n == 2:
             # Reverse the query string
-            query_string_rev = (",").join(self.mods[::-1])
+            query_string_rev = (",").join(mods[::-1])
             if query_string in edge_def.keys():
                 edge_type = edge_def[query_string]
                 valid = query_string
@@ -304,34 +564,19 @@ class DataGraph:
                 if edge_type==0:
                     # Search for subgraphs with edges 0 or (1 and 2)
                     regex_term = '(((?=.*0)|(?=.*5)(?=.*6))|((?=.*1)(?=.*2)))'
-                    mod = [i for i in self.mods if i in ['CT', 'MR']][0]  # making folder_mod CT/MR agnostic <-- still needs testing
-                    final_df = self.graph_query(regex_term, edge_list, f"folder_{mod}")
+                    mod = [i for i in mods if i in ['CT', 'MR']][0]  # making folder_mod CT/MR agnostic <-- still needs testing
+                    return ("graph", regex_term, edge_list, f"folder_{mod}")
                 elif edge_type==1:
                     # Search for subgraphs with edges 1 or (0 and 2)
                     regex_term = '((?=.*1)|(((?=.*0)|(?=.*5)(?=.*6))(?=.*2)))'
-                    final_df = self.graph_query(regex_term, edge_list, "RTSTRUCT")
-                elif edge_type==2:
+                    return ("graph", regex_term, edge_list, "RTSTRUCT")
+                else:
                     #Search for subgraphs with edges 2 or (1 and 0)
                     regex_term = '((?=.*2)|(((?=.*0)|(?=.*5)(?=.*6))(?=.*1)))'
-                    final_df = self.graph_query(regex_term, edge_list, "RTDOSE") 
-            else:
-                final_df = self.df_edges.loc[self.df_edges.edge_type == edge_type, ["study","patient_ID_x", "study_x", "study_y", "series_x","folder_x","series_y","folder_y", "subseries_x", "subseries_y"]]
-                node_dest = valid.split(",")[0]
-                node_origin = valid.split(",")[1]
-                final_df.rename(columns={"study": "study", 
-                                         "patient_ID_x": "patient_ID",
-                                         "series_x": f"series_{node_dest}", 
-                                         "series_y": f"series_{node_origin}", 
-                                         
-                                         "study_x": f"study_{node_dest}", 
-                                         "study_y": f"study_{node_origin}", 
-                                         "folder_x": f"folder_{node_dest}", 
-                                         "folder_y": f"folder_{node_origin}",
-                                         
-                                         "subseries_x": f"subseries_{node_dest}", 
-                                         "subseries_y": f"subseries_{node_origin}", }, inplace=True)
-
-        elif self.mods_n > 2:
+                    return ("graph", regex_term, edge_list, "RTDOSE")
+            return ("edge", edge_type, valid)
+
+        elif mods_n > 2:
             # Processing of combinations of modality
             bads = ["RTPLAN"]
             # CT/MR,RTSTRUCT,RTDOSE
@@ -357,22 +602,33 @@ class DataGraph:
                 bads.append("RTSTRUCT")
             else:
                 raise ValueError("Please enter the correct query")
-            
-            final_df = self.graph_query(regex_term, edge_list, bads)
+            return ("graph", regex_term, edge_list, bads)
         else:
             raise ValueError("Please enter the correct query")
-        
-        final_df.reset_index(drop=True, inplace=True)
-        final_df["index_chng"] = final_df.index.astype(str) + "_" + final_df["patient_ID"].astype(str)
-        final_df.set_index("index_chng", inplace=True)
-        final_df.rename_axis(None, inplace=True)
-        # change relative paths to absolute paths
-        for col in final_df.columns:
-            if col.startswith("folder"):
-                # print(self.edge_path, os.path.dirname(self.edge_path))
-                final_df[col] = final_df[col].apply(lambda x: pathlib.Path(os.path.split(os.path.dirname(self.edge_path))[0], x).as_posix() if isinstance(x, str) else x)  # input folder joined with the rel path
-        return final_df
-    
+
+    def count(self, query_string: str) -> int:
+        '''
+        Returns the number of studies with all the modalities of a query (see parser) and, for queries of several
+        modalities, the edges the parser looks for. Only the study index is used, so this is cheap enough to size
+        cohorts for many queries.
+        '''
+        return int(np.count_nonzero(self._match_studies(query_string)))
+
+    def studies(self, query_string: str) -> np.ndarray:
+        '''
+        Returns the study UIDs counted by count, in sorted order
+        '''
+        return self.study_index.studies.to_numpy()[self._match_studies(query_string)]
+
+    def _match_studies(self, query_string: str) -> np.ndarray:
+        plan = self._query_plan(query_string)
+        modality_mask = StudyIndex.modality_mask(query_string.split(",")) if plan[0] != "edge" else 0
+        if plan[0] == "modality":
+            return self.study_index.match(None, modality_mask)
+        if plan[0] == "edge":
+            return self.study_index.match([1 << plan[1]])
+        return self.study_index.match(regex_to_masks(plan[1]), modality_mask)
+
     def graph_query(self, 
                     regex_term: str,
                     edge_list: List[int],
@@ -404,28 +660,40 @@ class DataGraph:
         remove_less_comp
             False when you want to keep components with modalities less than the modalitiy listed in the query
         '''
-        if self.df_new is None:
-            self._form_agg()  # Form aggregates
-        
         # Fetch the required data. Checks whether each study has edge 4 and (1 or (2 and 0)). Can remove later
-        relevant_study_id = self.df_new.loc[(self.df_new.edge_type.str.contains(regex_term)), "study_x"].unique()
+        relevant_study_id = self._select_studies(regex_term)
         
         # Based on the correct study ids, fetches the relevant edges
         df_processed = self.df_edges.loc[self.df_edges.study_x.isin(relevant_study_id) & (self.df_edges.edge_type.isin(edge_list))]
         
         # The components are deleted if it has less number of nodes than the passed modalities, change this so as to alter that condition
         final_df = self._get_df(df_processed, relevant_study_id, remove_less_comp)
+        final_df = self._remove_columns(final_df, change_df)
+        
+        if return_components:
+            return self.final_dict
+        else:
+            return final_df
+
+    def _select_studies(self, regex_term: str):
+        '''
+        Returns the studies whose edge types match the regex, in sorted order
+        '''
+        try:  # the regexes of parser are combinations of edge types, which are matched on the study index
+            return self.study_index.select(regex_to_masks(regex_term))
+        except ValueError:
+            if self.df_new is None:
+                self._form_agg()  # Form aggregates
+            return self.df_new.loc[(self.df_new.edge_type.str.contains(regex_term)), "study_x"].unique()
 
+    @staticmethod
+    def _remove_columns(final_df, change_df):
         # Removing columns
         for bad in change_df:
             # Find columns with change_df string present
             col_ids = [cols for cols in list(final_df.columns)[1:] if bad != cols.split("_")[1]]
             final_df = final_df[[*list(final_df.columns)[:1], *col_ids]]
-        
-        if return_components:
-            return self.final_dict
-        else:
-            return final_df
+        return final_df
 
     def _form_agg(self):
         '''
@@ -469,100 +737,100 @@ class DataGraph:
         ---------
         * June 14th, 2022: Changing from studyID-based to sample-based for loop
         * Oct 11th, 2022: Reverted to studyID-based loop + improved readability and make CT,RTSTRUCT,RTDOSE mode pass tests
+        * Components and their connections are found with integer group IDs over all the studies at once, instead of
+          filtering the edges of every study and walking them with .iloc
         '''
-        # Storing all the components across all the studies
-        self.final_dict = []
-        final_df = []
-        # For checking later if all the required modalities are present in a component or not
+        components = self._components(df_edges_processed, rel_studyids)
+
+        # Check if all the queried modalities are present in a component, if not remove it
         mods_wanted = set(self.mods)
-        
-        # Determine the number of components
-        for i, study in enumerate(rel_studyids): # per study_id
-            df_temp   = df_edges_processed.loc[df_edges_processed.study_x == study]
-            CT_locs   = df_temp.loc[df_temp.modality_x.isin(['CT', 'MR'])]
-            CT_series = CT_locs.series_x.unique()
-            A = []
-            save_folder_comp = []
-            
-            # Initialization. For each component intialize a dictionary with the CTs and their connections
-            for ct in CT_series:
-                df_connections = CT_locs.loc[CT_locs.series_x == ct]
-                
-                if len(df_connections) > 0:
-                    row = df_connections.iloc[0]
-                else:
-                    row = df_connections
-                    
-                series   = row.series_x
-                modality = row.modality_x
-                folder   = row.folder_x
-                
-                # For each component, this loop stores the CT and its connections
-                temp = {"study": study,
-                          ct: {"modality": modality,
-                               "folder": folder}}
-                
-                # For saving the components in a format easier for the main pipeline
-                folder_save = {"study": study,
-                               'patient_ID': row.patient_ID_x,
-                                f'series_{modality}': series,
-                                f'folder_{modality}': folder}
-                
-                # This loop stores connection of the CT
-                for k in range(len(df_connections)):
-                    row_y      = df_connections.iloc[k]
-                    series_y   = row_y.series_y
-                    folder_y   = row_y.folder_y
-                    modality_y = row_y.modality_y
-                    
-                    temp[row.series_y] = {"modality": modality_y,
-                                          "folder": folder_y,
-                                          "conn_to": modality}
-
-                    # Checks if there is already existing connection
-                    key, key_series = self._check_save(folder_save, modality_y, modality) #CT/MR                    
-                    folder_save[key_series] = series_y
-                    folder_save[key] = folder_y
-                
-                A.append(temp)
-                save_folder_comp.append(folder_save)
-                       
-            # For rest of the edges left out, the connections are formed by going through the dictionary. For cases such as RTstruct-RTDose and PET-RTstruct
-            rest_locs = df_temp.loc[~df_temp.modality_x.isin(['CT', 'MR']), ["series_x", "modality_x","folder_x", "series_y", "modality_y", "folder_y"]]            
-            for j in range(len(rest_locs)):
-                edge = rest_locs.iloc[j]
-                for k in range(len(CT_series)):
-                    A[k][edge['series_y']] = {"modality": edge['modality_y'], 
-                                              "folder": edge['folder_y'], 
-                                              "conn_to": edge['modality_x']}
-                    modality_origin = edge['modality_x']
-
-                    # RTDOSE is connected via either RTstruct or/and CT, but we usually don't care, so naming it commonly
-                    if edge['modality_y'] == "RTDOSE":
-                        modality_origin = "CT"
-
-                    key, key_series = self._check_save(save_folder_comp[k], edge['modality_y'], modality_origin)
-                    save_folder_comp[k][key_series] = edge['series_y']
-                    save_folder_comp[k][key] = edge['folder_y']
-                    # flag = False
-
-            remove_index = []
-            if remove_less_comp:
-                for j in range(len(CT_series)):
-                    # Check if the number of nodes in a components isn't less than the query nodes, if yes then remove that component
-                    mods_present = set([items.split("_")[1] for items in save_folder_comp[j].keys() if items.split("_")[0] == "folder"])
-                    # Checking if all the read modalities are present in a component
-                    if mods_wanted.issubset(mods_present):
-                        remove_index.append(j)
-                save_folder_comp = [save_folder_comp[idx] for idx in remove_index]        
-                A = [A[idx] for idx in remove_index]    
-
-            self.final_dict.extend(A)
-            final_df.extend(save_folder_comp)
-        
-        final_df = pd.DataFrame(final_df)
+        if remove_less_comp:
+            components = [component for component in components if mods_wanted.issubset(component[3])]
+
+        # Storing all the components across all the studies
+        self.final_dict = [component[1] for component in components]
+        final_df = pd.DataFrame([component[2] for component in components])
         return final_df
-    
+
+    def _components(self, df_edges_processed, rel_studyids):
+        '''
+        Returns the components of the studies (see _get_df) as (study, component, its folders as saved by _get_df,
+        its modalities), in order of the studies
+        '''
+        components = []
+
+        # Edges of the relevant studies, in study order and then in edge table order
+        study_rank = pd.Index(rel_studyids).get_indexer(df_edges_processed.study_x)
+        order = np.flatnonzero(study_rank >= 0)
+        order = order[np.argsort(study_rank[order], kind="stable")]
+        rank  = study_rank[order]
+        study, patient, series_x, modality_x, folder_x, series_y, modality_y, folder_y = (
+            df_edges_processed[column].to_numpy()[order]
+            for column in ["study_x", "patient_ID_x", "series_x", "modality_x", "folder_x", "series_y", "modality_y", "folder_y"])
+
+        # One component per CT/MR series of a study, numbered in order of appearance. Components of the same study
+        # are consecutive, since the edges are sorted by study.
+        is_ct   = np.isin(modality_x, ['CT', 'MR'])
+        ct_rows = np.flatnonzero(is_ct)
+        series_codes = pd.factorize(series_x[ct_rows])[0]
+        ct_comp   = pd.factorize(rank[ct_rows].astype(np.int64) * (len(ct_rows) + 1) + series_codes)[0]
+        first_row = ct_rows[np.unique(ct_comp, return_index=True)[1]]  # first edge of every component
+        comp_rank = rank[first_row]
+        comp_modality = modality_x[first_row]
+
+        # The other edges (e.g. RTSTRUCT-RTDOSE, RTSTRUCT-PT) are added to every component of their study
+        rest_rows  = np.flatnonzero(~is_ct)
+        comp_start = np.searchsorted(comp_rank, rank[rest_rows], side="left")
+        comp_count = np.searchsorted(comp_rank, rank[rest_rows], side="right") - comp_start
+        rest_comp  = np.repeat(comp_start, comp_count) + np.arange(comp_count.sum()) - np.repeat(np.cumsum(comp_count) - comp_count, comp_count)
+        rest_rows  = np.repeat(rest_rows, comp_count)
+        rest_dest  = np.where(modality_y[rest_rows] == "RTDOSE", "CT", modality_x[rest_rows]).astype(object)
+
+        # Connections of every component: first the edges of its CT/MR, then the other edges of its study. The n-th
+        # connection between the same pair of modalities is saved with the suffix _n (see _check_save).
+        conn_comp = np.concatenate([ct_comp, rest_comp]).astype(np.int64)
+        conn_rest = np.concatenate([np.zeros(len(ct_rows), dtype=bool), np.ones(len(rest_rows), dtype=bool)])
+        conn_row  = np.concatenate([ct_rows, rest_rows]).astype(np.int64)
+        conn_dest = np.concatenate([comp_modality[ct_comp], rest_dest])
+        conn_order = np.lexsort((conn_row, conn_rest, conn_comp))
+        conn_comp, conn_rest, conn_row, conn_dest = conn_comp[conn_order], conn_rest[conn_order], conn_row[conn_order], conn_dest[conn_order]
+        conn_node = modality_y[conn_row]
+        conn_n = pd.DataFrame({"comp": conn_comp, "node": conn_node, "dest": conn_dest}).groupby(["comp", "node", "dest"], sort=False, dropna=False).cumcount().to_numpy()
+        conn_bounds = np.searchsorted(conn_comp, np.arange(len(first_row) + 1))
+
+        study, patient, series_x, modality_x, folder_x, series_y, modality_y, folder_y = (
+            array.tolist() for array in [study, patient, series_x, modality_x, folder_x, series_y, modality_y, folder_y])
+        conn_rest, conn_row, conn_node, conn_dest, conn_n = (
+            array.tolist() for array in [conn_rest, conn_row, conn_node, conn_dest, conn_n])
+        for comp, row in enumerate(first_row.tolist()):
+            modality = modality_x[row]
+
+            # For each component, this stores the CT and its connections
+            temp = {"study": study[row],
+                    series_x[row]: {"modality": modality,
+                                    "folder": folder_x[row]}}
+
+            # For saving the components in a format easier for the main pipeline
+            folder_save = {"study": study[row],
+                           'patient_ID': patient[row],
+                           f'series_{modality}': series_x[row],
+                           f'folder_{modality}': folder_x[row]}
+
+            mods_present = {modality}
+            for i in range(conn_bounds[comp], conn_bounds[comp + 1]):
+                conn = conn_row[i]
+                suffix = f"_{conn_n[i]}" if conn_n[i] > 0 else ""
+                folder_save[f"series_{conn_node[i]}_{conn_dest[i]}{suffix}"] = series_y[conn]
+                folder_save[f"folder_{conn_node[i]}_{conn_dest[i]}{suffix}"] = folder_y[conn]
+                mods_present.add(conn_node[i])
+                if conn_rest[i]:
+                    temp[series_y[conn]] = {"modality": modality_y[conn], "folder": folder_y[conn], "conn_to": modality_x[conn]}
+                else:
+                    temp[series_y[row]] = {"modality": modality_y[conn], "folder": folder_y[conn], "conn_to": modality}
+
+            components.append((study[row], temp, folder_save, mods_present))
+        return components
+
     @staticmethod
     def _check_save(save_dict,node,dest):
         key = f"folder_{node}_{dest}"
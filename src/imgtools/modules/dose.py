@@ -7,6 +7,9 @@ from matplotlib import pyplot as plt
 import SimpleITK as sitk
 from pydicom import dcmread
 
+from ..utils.archive import is_archive_path, read_archive_series
+from ..utils.header_cache import read_header
+
 T = TypeVar('T')
 
 
@@ -31,12 +34,15 @@ class Dose(sitk.Image):
             self.metadata = {}
         
     @classmethod
-    def from_dicom_rtdose(cls, path):
+    def from_dicom_rtdose(cls, path, header=None):
         '''
-        Reads the data and returns the data frame and the image dosage in SITK format
+        Reads the data and returns the data frame and the image dosage in SITK format.
+        header can be the header of the file, if it was already read.
         '''
         # change log (2022-10-12)
-        if ".dcm" in path:
+        if is_archive_path(path):
+            dose = read_archive_series([path])
+        elif ".dcm" in path:
             dose = sitk.ReadImage(path)
         else:
             dose = read_image(path) 
@@ -46,7 +52,7 @@ class Dose(sitk.Image):
             dose = dose[:,:,:,0]
         
         # Get the metadata
-        df = dcmread(path)
+        df = header if header is not None else read_header(path)
 
         # Convert to SUV
         factor = float(df.DoseGridScaling)
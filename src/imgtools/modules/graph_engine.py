@@ -0,0 +1,306 @@
+import hashlib
+import os
+from collections import namedtuple
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+# edges of the DataGraph as parallel integer arrays: the crawl rows of the referencing (src, "_y" in the edge table)
+# and referenced (dst, "_x") series of every edge, and its edge type
+Edges = namedtuple("Edges", ["src", "dst", "edge_type"])
+
+# crawl columns holding UIDs that edges are formed on
+UID_COLUMNS = ['instance_uid', 'series', 'study', 'reference_ct', 'reference_rs', 'reference_pl']
+
+# edge type -> joins forming it, as (dst modality, dst column, src modality, src column), see DataGraph
+EDGE_JOINS = {0: [("RTSTRUCT", "instance_uid", "RTDOSE", "reference_rs"),
+                  ("RTSTRUCT", "series", "RTDOSE", "reference_rs")],
+              1: [("CT", "series", "RTDOSE", "reference_ct")],
+              2: [("CT", "series", "RTSTRUCT", "reference_ct"),
+                  ("MR", "series", "RTSTRUCT", "reference_ct")],
+              3: [("PT", "series", "RTSTRUCT", "reference_ct")],
+              4: [("CT", "study", "PT", "study")],
+              5: [("RTPLAN", "instance_uid", "RTDOSE", "reference_pl")],
+              6: [("RTSTRUCT", "instance_uid", "RTPLAN", "reference_rs")]}
+
+
+def _is_categorical(values: pd.Series) -> bool:
+    return isinstance(values.dtype, pd.CategoricalDtype)
+
+
+def _categories(values: pd.Series) -> np.ndarray:
+    # the categories, followed by NaN for the missing values (code -1)
+    return np.append(np.asarray(values.cat.categories, dtype=object), np.nan)
+
+
+class GraphEngine:
+    '''
+    Forms the edges of the DataGraph from the crawl DataFrame without merging DataFrames.
+
+    The UID columns are hashed into one integer code space once (pd.factorize), after which every edge type is an
+    integer join of the codes of two modalities. Edges are kept as integer arrays of crawl rows (see Edges), and
+    columns are only gathered from the crawl for the edges (and columns) that are asked for.
+
+    The joins reproduce pd.merge(dst, src, left_on=..., right_on=...): edges are ordered by dst row, then by src row,
+    and equal values match (also the "nan" of missing references, as in the all-string crawl DataGraph uses).
+    '''
+    def __init__(self, df: pd.DataFrame) -> None:
+        '''
+        Parameters
+        ----------
+        df
+            Crawl DataFrame, as read from the crawl CSV
+        '''
+        self.df = df
+        # categorical columns are hashed once per category instead of once per row
+        parts = [_categories(df[column]) if _is_categorical(df[column]) else df[column].to_numpy(dtype=object) for column in UID_COLUMNS]
+        codes, _ = pd.factorize(np.concatenate(parts), use_na_sentinel=False)
+        self.codes = {}
+        for column, part_codes in zip(UID_COLUMNS, np.split(codes, np.cumsum([len(part) for part in parts])[:-1])):
+            self.codes[column] = part_codes[df[column].cat.codes.to_numpy()] if _is_categorical(df[column]) else part_codes
+
+        modality = df["modality"].to_numpy(dtype=object)
+        self.rows = {name: np.flatnonzero(modality == name) for name in pd.unique(modality)}
+
+    def _modality_rows(self, modality: str) -> np.ndarray:
+        return self.rows.get(modality, np.empty(0, dtype=np.intp))
+
+    def join(self, dst_rows: np.ndarray, dst_column: str, src_rows: np.ndarray, src_column: str):
+        '''
+        Returns the (dst, src) row pairs with equal dst_column and src_column values, in pd.merge order
+        '''
+        dst_codes = self.codes[dst_column][dst_rows]
+        src_codes = self.codes[src_column][src_rows]
+        order  = np.argsort(src_codes, kind="stable")
+        sorted_codes = src_codes[order]
+        start  = np.searchsorted(sorted_codes, dst_codes, side="left")
+        counts = np.searchsorted(sorted_codes, dst_codes, side="right") - start
+
+        # for every dst row, the positions start ... start + count - 1 of its matches in sorted_codes
+        total   = int(counts.sum())
+        offsets = np.repeat(start - (np.cumsum(counts) - counts), counts) + np.arange(total)
+        return np.repeat(dst_rows, counts), src_rows[order[offsets]]
+
+    def edges(self, edge_types: Optional[List[int]] = None) -> Edges:
+        '''
+        Forms the edges of the given edge types (default: all), ordered by edge type
+        '''
+        src, dst, types = [], [], []
+        for edge_type, joins in EDGE_JOINS.items():
+            if edge_types is not None and edge_type not in edge_types:
+                continue
+            pairs = [self.join(self._modality_rows(dst_modality), dst_column, self._modality_rows(src_modality), src_column)
+                     for dst_modality, dst_column, src_modality, src_column in joins]
+            edge_dst = np.concatenate([pair[0] for pair in pairs])
+            edge_src = np.concatenate([pair[1] for pair in pairs])
+            if edge_type == 0:
+                # RTSTRUCTs referenced by both their series and instance UID, or by several RTDOSEs, keep their first edge
+                _, first = np.unique(self.codes["instance_uid"][edge_dst], return_index=True)
+                first = np.sort(first)
+                edge_dst, edge_src = edge_dst[first], edge_src[first]
+            dst.append(edge_dst)
+            src.append(edge_src)
+            types.append(np.full(len(edge_dst), edge_type, dtype=np.int64))
+        return Edges(np.concatenate(src).astype(np.intp), np.concatenate(dst).astype(np.intp), np.concatenate(types))
+
+    def materialize(self, edges: Edges, columns: Optional[List[str]] = None, drop: Optional[List[str]] = None) -> pd.DataFrame:
+        '''
+        Gathers the crawl columns of the edges into an edge table, with the columns of the referenced series suffixed
+        with "_x", those of the referencing series with "_y" and the edge types in "edge_type".
+
+        Parameters
+        ----------
+        edges
+            Edges to materialize, e.g. a subset of the edges from GraphEngine.edges
+
+        columns, optional
+            Crawl columns to gather, by default all of them
+
+        drop, optional
+            Suffixed columns to leave out, e.g. ["patient_ID_y"]
+        '''
+        columns = list(self.df.columns) if columns is None else columns
+        drop = set(drop or [])
+        table = {}
+        for suffix, rows in [("_x", edges.dst), ("_y", edges.src)]:
+            for column in columns:
+                if f"{column}{suffix}" not in drop:
+                    values = self.df[column]
+                    if _is_categorical(values):
+                        table[f"{column}{suffix}"] = _categories(values)[values.cat.codes.to_numpy()[rows]]
+                    else:
+                        table[f"{column}{suffix}"] = values.to_numpy()[rows]
+        table["edge_type"] = edges.edge_type
+        return pd.DataFrame(table)
+
+
+# modalities with a bit in the StudyIndex
+INDEX_MODALITIES = ["CT", "MR", "PT", "RTSTRUCT", "RTDOSE", "RTPLAN", "SEG"]
+
+
+def regex_to_masks(regex: str) -> List[int]:
+    '''
+    Converts a regex over the edge types of a study (as used by DataGraph.graph_query) into bitmasks of edge types.
+    The regex has to consist of lookaheads for single edge types, (?=.*<edge type>), combined by concatenation (and),
+    alternation (or) and groups. It then matches a study if, for any of the returned masks, the study has all the
+    edge types of the mask. Raises ValueError for other regexes.
+    '''
+    position = 0
+
+    def alternation():
+        nonlocal position
+        masks = sequence()
+        while position < len(regex) and regex[position] == "|":
+            position += 1
+            masks += sequence()
+        return masks
+
+    def sequence():
+        masks = [0]
+        while position < len(regex) and regex[position] not in "|)":
+            others = atom()
+            masks = [mask | other for mask in masks for other in others]
+        return masks
+
+    def atom():
+        nonlocal position
+        if regex.startswith("(?=.*", position) and regex[position + 5:position + 6].isdigit() and regex[position + 6:position + 7] == ")":
+            edge_type = int(regex[position + 5])
+            position += 7
+            return [1 << edge_type]
+        if regex.startswith("(", position) and not regex.startswith("(?", position):
+            position += 1
+            masks = alternation()
+            if not regex.startswith(")", position):
+                raise ValueError(f"Unbalanced parentheses in {regex}.")
+            position += 1
+            return masks
+        raise ValueError(f"Unsupported regex {regex}, expected edge type lookaheads such as (?=.*2).")
+
+    masks = alternation()
+    if position != len(regex):
+        raise ValueError(f"Unsupported regex {regex}, expected edge type lookaheads such as (?=.*2).")
+    return list(dict.fromkeys(masks))
+
+
+class StudyIndex:
+    '''
+    Bitsets of the modalities and the edge types present in every study of the DataGraph, so that the studies
+    matching a query are found with bitwise operations over numpy arrays instead of regexes over strings.
+    '''
+    def __init__(self, df: pd.DataFrame, df_edges: pd.DataFrame) -> None:
+        '''
+        Parameters
+        ----------
+        df
+            Crawl DataFrame
+
+        df_edges
+            Edge table of the DataGraph
+        '''
+        studies = pd.concat([df_edges["study_x"], df["study"]], ignore_index=True).dropna()
+        self.studies = pd.Index(studies.unique()).sort_values()
+
+        self.edge_bits = np.zeros(len(self.studies), dtype=np.uint32)
+        np.bitwise_or.at(self.edge_bits, self.studies.get_indexer(df_edges["study_x"].dropna()),
+                         (1 << df_edges.loc[df_edges["study_x"].notna(), "edge_type"].to_numpy(dtype=np.int64)).astype(np.uint32))
+
+        self.modality_bits = np.zeros(len(self.studies), dtype=np.uint32)
+        modality_codes = pd.Index(INDEX_MODALITIES).get_indexer(df["modality"])
+        known = (modality_codes >= 0) & df["study"].notna().to_numpy()
+        np.bitwise_or.at(self.modality_bits, self.studies.get_indexer(df.loc[known, "study"]),
+                         (1 << modality_codes[known]).astype(np.uint32))
+
+    @staticmethod
+    def modality_mask(modalities: List[str]) -> int:
+        mask = 0
+        for modality in modalities:
+            if modality not in INDEX_MODALITIES:
+                raise ValueError(f"Unknown modality {modality}, expected any of {INDEX_MODALITIES}.")
+            mask |= 1 << INDEX_MODALITIES.index(modality)
+        return mask
+
+    def match(self, edge_masks: Optional[List[int]] = None, modality_mask: int = 0) -> np.ndarray:
+        '''
+        Returns a boolean array over the studies: whether a study has all the modalities of modality_mask and all
+        the edge types of any of the edge_masks (see regex_to_masks)
+        '''
+        matches = (self.modality_bits & modality_mask) == modality_mask
+        if edge_masks is not None:
+            edges = np.zeros(len(self.studies), dtype=bool)
+            for mask in edge_masks:
+                edges |= (self.edge_bits & mask) == mask
+            matches &= edges
+        return matches
+
+    def select(self, edge_masks: Optional[List[int]] = None, modality_mask: int = 0) -> np.ndarray:
+        '''
+        Returns the studies that match (see match), in sorted order
+        '''
+        return self.studies.to_numpy()[self.match(edge_masks, modality_mask)]
+
+    def count(self, edge_masks: Optional[List[int]] = None, modality_mask: int = 0) -> int:
+        return int(np.count_nonzero(self.match(edge_masks, modality_mask)))
+
+
+# version of the edge table cache format, tables saved with another version are formed again
+EDGE_CACHE_VERSION = 1
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    '''
+    SHA-1 of the contents of a file, e.g. the crawl that an edge table was formed from
+    '''
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_edge_cache(path: str, df_edges: pd.DataFrame, crawl_hash: str) -> None:
+    '''
+    Saves an edge table as an .npz of typed arrays, stamped with the hash of the crawl it was formed from.
+    String columns are stored as integer codes into their unique values, so loading them needs no parsing.
+    '''
+    arrays = {"version": np.array(EDGE_CACHE_VERSION), "crawl_hash": np.array(crawl_hash),
+              "columns": np.array(list(df_edges.columns), dtype=str)}
+    for i, column in enumerate(df_edges.columns):
+        values = df_edges[column]
+        if values.dtype == object:
+            if not all(isinstance(value, str) for value in pd.unique(values)):
+                values = values.astype(str)  # stored as strings, like form_graph casts the crawl
+            codes, uniques = pd.factorize(values)
+            arrays[f"codes_{i}"] = codes.astype(np.int32)
+            arrays[f"uniques_{i}"] = np.array(uniques, dtype=str)
+        else:
+            arrays[f"values_{i}"] = values.to_numpy()
+
+    # written next to the table first, so that readers never see a partially written cache
+    tmp_path = f"{path}.tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_edge_cache(path: str, crawl_hash: str) -> Optional[pd.DataFrame]:
+    '''
+    Loads an edge table saved by save_edge_cache. Returns None if there is no cache, or if it was formed from another
+    crawl (or with another cache format) and has to be formed again.
+    '''
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as arrays:
+            if int(arrays["version"]) != EDGE_CACHE_VERSION or str(arrays["crawl_hash"]) != crawl_hash:
+                return None
+            table = {}
+            for i, column in enumerate(arrays["columns"]):
+                if f"values_{i}" in arrays:
+                    table[str(column)] = arrays[f"values_{i}"]
+                else:
+                    table[str(column)] = arrays[f"uniques_{i}"].astype(object)[arrays[f"codes_{i}"]]
+    except (OSError, ValueError, KeyError):  # unreadable caches are formed again
+        return None
+    return pd.DataFrame(table)
@@ -0,0 +1,183 @@
+import json
+import pathlib
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+
+# levels the edge table of a DataGraph can be viewed at: every series, or the series of every modality of a
+# study or patient as one node
+GRAPH_VIEW_LEVELS = ["series", "study", "patient"]
+
+# vis-network (9.1.2, standalone build) shipped with the package and embedded in the pages, so that they render
+# on machines without network access
+VIS_NETWORK_JS = pathlib.Path(__file__).with_name("static") / "vis-network.min.js"
+
+# vis.js page of a graph view, with the positions of the nodes computed beforehand instead of by the browser
+GRAPH_VIEW_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<script>
+{vis_network}
+</script>
+<style>
+  html, body {{ margin: 0; height: 100%; background: #222222; color: white; font-family: sans-serif; }}
+  #graph {{ width: 100%; height: calc(100% - 2em); }}
+  #info {{ height: 2em; line-height: 2em; padding: 0 1em; }}
+</style>
+</head>
+<body>
+<div id="info">{title}</div>
+<div id="graph"></div>
+<script>
+  var view = {data};
+  var tooltip = function (text) {{ var element = document.createElement("div"); element.innerHTML = text; return element; }};
+  view.nodes.forEach(function (node) {{ node.title = tooltip(node.title); }});
+  view.edges.forEach(function (edge) {{ edge.title = tooltip(edge.title); }});
+  new vis.Network(document.getElementById("graph"),
+                  {{nodes: new vis.DataSet(view.nodes), edges: new vis.DataSet(view.edges)}},
+                  {{physics: false, layout: {{improvedLayout: false}},
+                    nodes: {{shape: "dot", font: {{color: "white"}}, scaling: {{min: 5, max: 30}}}},
+                    edges: {{smooth: false, arrows: "to", color: {{opacity: 0.5}}, scaling: {{min: 1, max: 8}}}},
+                    interaction: {{hideEdgesOnDrag: true, tooltipDelay: 100}}}});
+</script>
+</body>
+</html>
+"""
+
+
+def graph_view(df_edges: pd.DataFrame, level: str = "study", max_nodes: int = 5000, seed: int = 0) -> dict:
+    '''
+    Summarizes the edge table of a DataGraph as a graph of at most max_nodes nodes, in time linear in the edges.
+
+    At the study or patient level, the series of every modality of a study (or patient) are one node, and the edges
+    between two nodes are one edge weighted by their number. If there are more nodes than max_nodes, whole patients
+    (studies at the study level) are sampled at random until the budget is used. Nodes are laid out on a grid with
+    one cell per patient (or study), so the browser does not have to simulate the layout.
+
+    Parameters
+    ----------
+    df_edges
+        Edge table of a DataGraph
+
+    level, optional
+        "series", "study" or "patient", see GRAPH_VIEW_LEVELS
+
+    max_nodes, optional
+        Number of nodes to sample up to
+
+    seed, optional
+        Seed of the sampling
+
+    Returns
+    -------
+    The view as a dict with its nodes and edges as lists of vis.js nodes and edges, and the numbers of nodes,
+    edges and groups (patients or studies) shown and in total.
+    '''
+    if level not in GRAPH_VIEW_LEVELS:
+        raise ValueError(f"Unknown level {level}, expected any of {GRAPH_VIEW_LEVELS}.")
+    n_edges = len(df_edges)
+
+    # both ends of every edge: first the referencing series (_y), then the referenced ones (_x)
+    groups, group_names = pd.factorize(df_edges["study_x" if level == "study" else "patient_ID_x"].to_numpy(dtype=object), use_na_sentinel=False)
+    patients = df_edges["patient_ID_x"].to_numpy(dtype=object)
+    series, series_names = pd.factorize(np.concatenate([df_edges["series_y"].to_numpy(dtype=object), df_edges["series_x"].to_numpy(dtype=object)]), use_na_sentinel=False)
+    modalities, modality_names = pd.factorize(np.concatenate([df_edges["modality_y"].to_numpy(dtype=object), df_edges["modality_x"].to_numpy(dtype=object)]), use_na_sentinel=False)
+    end_groups = np.concatenate([groups, groups])
+    if level == "series":
+        ends = series
+    else:
+        ends = pd.factorize(end_groups.astype(np.int64) * max(len(modality_names), 1) + modalities)[0]
+    n_nodes = int(ends.max(initial=-1)) + 1
+
+    # the group, modality and series of every node, from its first end
+    first = np.unique(ends, return_index=True)[1]
+    node_group, node_modality = end_groups[first], modalities[first]
+    node_series = np.bincount(pd.unique(ends.astype(np.int64) * (len(series_names) + 1) + series) // (len(series_names) + 1),
+                              minlength=n_nodes) if n_nodes else np.zeros(0, dtype=np.int64)
+
+    # whole groups are sampled in random order until the node budget is used
+    group_nodes = np.bincount(node_group, minlength=len(group_names))
+    if n_nodes > max_nodes:
+        order = np.random.default_rng(seed).permutation(len(group_names))
+        kept_groups = order[np.cumsum(group_nodes[order]) <= max_nodes]
+        if len(kept_groups) == 0:
+            kept_groups = order[:1]
+    else:
+        kept_groups = np.arange(len(group_names))
+    kept_group = np.zeros(len(group_names), dtype=bool)
+    kept_group[kept_groups] = True
+    nodes = np.flatnonzero(kept_group[node_group])
+
+    # edges between the same nodes are counted together, by edge type
+    src, dst = ends[:n_edges], ends[n_edges:]
+    kept_edges = np.flatnonzero(kept_group[groups])
+    edge_types = df_edges["edge_type"].to_numpy()
+    edge_counts = pd.DataFrame({"src": src[kept_edges], "dst": dst[kept_edges], "edge_type": edge_types[kept_edges]}
+                               ).groupby(["src", "dst", "edge_type"], sort=True).size()
+
+    # grid of groups, with the nodes of a group on a circle
+    cell_of_group = np.full(len(group_names), -1, dtype=np.int64)
+    cell_of_group[np.sort(kept_groups)] = np.arange(len(kept_groups))
+    columns = max(int(np.ceil(np.sqrt(len(kept_groups)))), 1)
+    spacing = 40. * np.sqrt(max(int(group_nodes[kept_groups].max(initial=1)), 1)) + 100.
+    order = nodes[np.argsort(node_group[nodes], kind="stable")]
+    rank = pd.Series(node_group[order]).groupby(node_group[order]).cumcount().to_numpy()
+    size = group_nodes[node_group[order]]
+    radius = np.where(size > 1, 20. * np.sqrt(size), 0.)
+    angle = 2 * np.pi * rank / np.maximum(size, 1)
+    cell = cell_of_group[node_group[order]]
+    x = (cell % columns) * spacing + radius * np.cos(angle)
+    y = (cell // columns) * spacing + radius * np.sin(angle)
+
+    # labels, tooltips and edges for the nodes shown only
+    degree = np.bincount(np.concatenate([edge_counts.index.get_level_values("src"), edge_counts.index.get_level_values("dst")]), minlength=n_nodes)
+    group_patient = pd.Series(patients).groupby(groups).first().to_numpy() if n_edges else np.zeros(0, dtype=object)
+    view_nodes = []
+    for node, node_x, node_y in zip(order.tolist(), x.tolist(), y.tolist()):
+        modality, group = modality_names[node_modality[node]], node_group[node]
+        if level == "series":
+            label, title = modality, f"Patient_id: {group_patient[group]}<br>Series: {series_names[series[first[node]]]}"
+        else:
+            label = f"{modality} ({node_series[node]})"
+            title = f"Patient_id: {group_patient[group]}<br>{'Study: ' + str(group_names[group]) + '<br>' if level == 'study' else ''}Series: {node_series[node]} {modality}"
+        view_nodes.append({"id": node, "label": label, "group": modality, "x": round(node_x, 1), "y": round(node_y, 1),
+                           "value": int(node_series[node]) if level != "series" else int(degree[node]),
+                           "title": f"{title}<br>Number of connections: {degree[node]}"})
+
+    view_edges = []
+    for edge_src, edge_dst, edge_type, count in zip(*[edge_counts.index.get_level_values(name).tolist() for name in ["src", "dst", "edge_type"]],
+                                                    edge_counts.tolist()):
+        # the counts of the same nodes are consecutive
+        if view_edges and view_edges[-1]["from"] == edge_src and view_edges[-1]["to"] == edge_dst:
+            view_edges[-1]["value"] += count
+            view_edges[-1]["title"] += f"<br>edge_type {edge_type}: {count}"
+        else:
+            view_edges.append({"from": edge_src, "to": edge_dst, "value": count, "title": f"edge_type {edge_type}: {count}"})
+
+    return {"level": level, "nodes": view_nodes, "edges": view_edges,
+            "nodes_shown": len(view_nodes), "nodes_total": n_nodes,
+            "edges_shown": int(len(kept_edges)), "edges_total": n_edges,
+            "groups_shown": int(len(kept_groups)), "groups_total": len(group_names)}
+
+
+def write_graph_view(view: dict, path: str, title: Optional[str] = None) -> str:
+    '''
+    Writes a graph view (see graph_view) as JSON and as a static HTML page next to it, which opens without a server
+    or network access (vis-network is embedded in it). Returns the path of the HTML page.
+    '''
+    path = pathlib.Path(path)
+    data = json.dumps(view, default=str)
+    path.with_suffix(".json").write_text(data)
+    if title is None:
+        group = "studies" if view["level"] == "study" else "patients"
+        title = (f"{view['nodes_shown']} of {view['nodes_total']} nodes ({view['level']} level), "
+                 f"{view['edges_shown']} of {view['edges_total']} edges, {view['groups_shown']} of {view['groups_total']} {group}")
+    html_path = path.with_suffix(".html")
+    # the JSON is embedded as well, browsers do not load local files from a page opened from disk
+    html_path.write_text(GRAPH_VIEW_HTML.format(title=title, data=data.replace("</", "<\\/"),
+                                                vis_network=VIS_NETWORK_JS.read_text(encoding="utf-8")), encoding="utf-8")
+    return html_path.as_posix()
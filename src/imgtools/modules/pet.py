@@ -8,16 +8,25 @@ from matplotlib import pyplot as plt
 import SimpleITK as sitk
 from pydicom import dcmread
 
+from ..utils.archive import is_archive_path, list_archive_dir, read_archive_series
+from ..utils.header_cache import read_header
+
 T = TypeVar('T')
 
 
-def read_image(path:str,series_id: Optional[str]=None):
+def read_image(path:str,series_id: Optional[str]=None, file_names: Optional[list]=None):
+    if file_names is None and is_archive_path(path):
+        file_names = list_archive_dir(path)
+    if file_names and is_archive_path(file_names[0]):
+        return read_archive_series(file_names)
+
     reader = sitk.ImageSeriesReader()
-    dicom_names = reader.GetGDCMSeriesFileNames(path,seriesID=series_id if series_id else "")
+    if file_names is None:
+        dicom_names = reader.GetGDCMSeriesFileNames(path,seriesID=series_id if series_id else "")
+    else:
+        dicom_names = file_names
     reader.SetFileNames(dicom_names)
-    reader.MetaDataDictionaryArrayUpdateOn()
-    reader.LoadPrivateTagsOn()
-
+    # the tags are read from the header of one slice (see from_dicom_pet), not from every slice
     return reader.Execute()
 
 
@@ -34,7 +43,7 @@ class PET(sitk.Image):
             self.metadata = {}
     
     @classmethod
-    def from_dicom_pet(cls, path,series_id=None,type="SUV"):
+    def from_dicom_pet(cls, path,series_id=None,type="SUV",file_names=None,header=None):
         '''
         Reads the PET scan and returns the data frame and the image dosage in SITK format
         There are two types of existing formats which has to be mentioned in the type
@@ -46,10 +55,21 @@ class PET(sitk.Image):
         Please refer to the pseudocode: https://qibawiki.rsna.org/index.php/Standardized_Uptake_Value_(SUV) 
         If there is no data on SUV/ACT then backup calculation is done based on the formula in the documentation, although, it may
         have some error.
+
+        file_names can be the slice ordered list of files of the series (e.g. from the crawler index), so that
+        the directory is not scanned again. header can be the header of one of its files, if it was already read.
         '''
-        pet      = read_image(path,series_id)
-        path_one = pathlib.Path(path,os.listdir(path)[0]).as_posix()
-        df       = dcmread(path_one)
+        pet      = read_image(path,series_id,file_names)
+        if header is not None:
+            df = header
+        else:
+            if file_names:
+                path_one = file_names[0]
+            elif is_archive_path(path):
+                path_one = list_archive_dir(path)[0]
+            else:
+                path_one = pathlib.Path(path,os.listdir(path)[0]).as_posix()
+            df = read_header(path_one)
         calc     = False
         try:
             if type=="SUV":
@@ -10,6 +10,7 @@ from skimage.draw import polygon2mask
 
 from .segmentation import Segmentation
 from ..utils import physical_points_to_idxs
+from ..utils.archive import read_dataset
 
 T = TypeVar('T')
 
@@ -38,7 +39,7 @@ class StructureSet:
 
     @classmethod
     def from_dicom_rtstruct(cls, rtstruct_path: str) -> 'StructureSet':
-        rtstruct = dcmread(rtstruct_path, force=True)
+        rtstruct = read_dataset(rtstruct_path, force=True)
         roi_names = [roi.ROIName for roi in rtstruct.StructureSetROISequence]
         roi_points = {}
         for i, name in enumerate(roi_names):
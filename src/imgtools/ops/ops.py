@@ -5,7 +5,7 @@ import SimpleITK as sitk
 
 from .functional import *
 from ..io import *
-from ..utils import image_to_array, array_to_image, crawl, physical_points_to_idxs
+from ..utils import image_to_array, array_to_image, crawl, physical_points_to_idxs, CrawlTree
 from ..modules import map_over_labels
 from ..modules import DataGraph
 
@@ -89,7 +89,7 @@ class BetaAutoInput(BaseInput):
         # Checks if dataset has already been indexed
         # To be changed later
         df_crawl_path   = pathlib.Path(self.parent, ".imgtools", f"imgtools_{self.dataset_name}.csv").as_posix()
-        tree_crawl_path = pathlib.Path(self.parent, ".imgtools", f"imgtools_{self.dataset_name}.json").as_posix()
+        tree_crawl_path = pathlib.Path(self.parent, ".imgtools", f"imgtools_{self.dataset_name}.tree").as_posix()
 
         if not os.path.exists(df_crawl_path) or update:
             print("Indexing the dataset...")
@@ -98,10 +98,14 @@ class BetaAutoInput(BaseInput):
         else:
             print("The dataset has already been indexed.")
 
-        import json
-        with open(tree_crawl_path, 'r') as f:
-            tree_db = json.load(f)  # currently unused, TO BE implemented in the future
-            assert tree_db is not None, "There was no crawler output" # dodging linter
+        # patients are only decoded from the tree when accessed, instead of loading the full JSON in every worker
+        if os.path.exists(tree_crawl_path):
+            tree_db = CrawlTree(tree_crawl_path)  # currently unused, TO BE implemented in the future
+        else:  # indexed before the binary tree was saved
+            import json
+            with open(tree_crawl_path.replace(".tree", ".json"), 'r') as f:
+                tree_db = json.load(f)
+        assert tree_db is not None, "There was no crawler output" # dodging linter
 
         # GRAPH
         # -----
@@ -165,6 +169,7 @@ class ImageAutoInput(BaseInput):
         # Checks if dataset has already been indexed
         # To be changed later
         path_crawl = pathlib.Path(self.parent, ".imgtools", f"imgtools_{self.dataset_name}.csv").as_posix()
+        tree_crawl_path = pathlib.Path(self.parent, ".imgtools", f"imgtools_{self.dataset_name}.tree").as_posix()
         if not os.path.exists(path_crawl) or update:
             print("Indexing the dataset...")
             db = crawl(self.dir_path, n_jobs=n_jobs)
@@ -186,12 +191,17 @@ class ImageAutoInput(BaseInput):
 
         self.readers = [read_dicom_auto for _ in range(len(self.output_streams))]
 
+        # the modality and files of every series are taken from the crawl instead of scanning the series directories
+        if not os.path.exists(tree_crawl_path):  # indexed before the binary tree was saved
+            tree_crawl_path = tree_crawl_path.replace(".tree", ".json")
         loader = ImageCSVLoader(self.df_combined,
                                 colnames=self.column_names,
                                 seriesnames=self.series_names,
                                 id_column=None,
                                 expand_paths=False,
-                                readers=self.readers)
+                                readers=self.readers,
+                                tree=tree_crawl_path,
+                                root_directory=self.parent)
         
         super().__init__(loader)
 
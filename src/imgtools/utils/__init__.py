@@ -1,6 +1,11 @@
 from .imageutils import *
 from .arrayutils import *
+from .archive import *
+from .header_cache import *
 from .crawl import *
+from .crawl_index import *
+from .crawl_tree import *
+from .crawl_watch import *
 from .dicomutils import *
 from .args import *
 from .nnunet import *
@@ -0,0 +1,413 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import struct
+import tarfile
+import threading
+import zipfile
+from collections import namedtuple
+
+import numpy as np
+import SimpleITK as sitk
+from pydicom import dcmread
+
+
+# files inside archives are addressed as <path to archive>!/<member name>, e.g. data/cohort.tar!/P1/CT/1.dcm
+ARCHIVE_SEP = "!/"
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+# where the data of a member starts in the archive and its size; for compressed tarballs
+# the offset is into the decompressed stream. name is the member name as it is stored in
+# the archive, and compressed whether its data is compressed on its own (deflated zip members)
+ArchiveMember = namedtuple("ArchiveMember", ["offset", "size", "name", "compressed"], defaults=[None, False])
+
+# decompressed streams of the compressed tarballs, by extension
+_DECOMPRESSORS = {'.tar.gz': gzip.open, '.tgz': gzip.open, '.tar.bz2': bz2.open, '.tbz2': bz2.open,
+                  '.tar.xz': lzma.open, '.txz': lzma.open}
+
+
+def is_archive(path) -> bool:
+    return str(path).lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def split_archive_path(path):
+    '''
+    Splits <archive>!/<member> into (archive, member). Returns (path, None) for paths outside of archives.
+    '''
+    path = str(path)
+    if ARCHIVE_SEP in path:
+        archive, member = path.split(ARCHIVE_SEP, 1)
+        if is_archive(archive):
+            return archive, member
+    return path, None
+
+
+def is_archive_path(path) -> bool:
+    return path is not None and split_archive_path(path)[1] is not None
+
+
+def _normalize(name):
+    name = name.replace("\\", "/")
+    while name.startswith("./"):
+        name = name[2:]
+    return name
+
+
+def _zip_data_offset(f, info):
+    '''
+    Offset of the data of a zip member: its local header has its own (variable) name and extra field lengths
+    '''
+    f.seek(info.header_offset)
+    header = f.read(30)
+    if len(header) != 30 or header[:4] != b"PK\x03\x04":
+        raise zipfile.BadZipFile(f"Bad local header of {info.filename}.")
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    return info.header_offset + 30 + name_length + extra_length
+
+
+class MemberFile(io.RawIOBase):
+    '''
+    Read-only, seekable view of one archive member that keeps track of the number of bytes read from it.
+    Members of uncompressed tarballs and stored zip members are read with os.pread at their offset in the
+    archive, so several views (and threads) can share the file descriptor of the archive.
+    '''
+    def __init__(self, name, size, fd=None, offset=0, fileobj=None):
+        super().__init__()
+        self.name = name
+        self.size = size
+        self.bytes_read = 0
+        self._fd = fd
+        self._offset = offset
+        self._fileobj = fileobj
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}.")
+        self._pos = max(self._pos, 0)
+        return self._pos
+
+    def readinto(self, buffer):
+        n = min(len(buffer), self.size - self._pos)
+        if n <= 0:
+            return 0
+        if self._fileobj is None:
+            data = os.pread(self._fd, n, self._offset + self._pos)
+        else:
+            self._fileobj.seek(self._pos)
+            data = self._fileobj.read(n)
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        self.bytes_read += len(data)
+        return len(data)
+
+    def close(self):
+        if self._fileobj is not None:
+            self._fileobj.close()
+        super().close()
+
+
+class Archive:
+    '''
+    Member index of a .zip or .tar(.gz/.bz2/.xz) archive, {member name: ArchiveMember}, from which the
+    members are opened without extracting the archive. Uncompressed tarballs and zip files give random
+    access to every member; compressed tarballs have to be decompressed up to the member that is read,
+    so their members are best read in archive order (see read_order).
+
+    Members can be opened from several threads: the stored members are read with os.pread from one shared
+    file descriptor, and every thread opens its own zipfile or decompressed stream for the others.
+    '''
+    def __init__(self, path: str, members: dict = None) -> None:
+        '''
+        Parameters
+        ----------
+        path
+            Path to the archive
+
+        members, optional
+            Part of the member index that is already known (e.g. listed by another process), the
+            archive is only listed again if a member that is not in it is opened.
+        '''
+        self.path = path
+        stat = os.stat(path)
+        self.signature = (stat.st_size, stat.st_mtime_ns)
+        self.is_zip = path.lower().endswith('.zip')
+        self.is_compressed = not self.is_zip and not path.lower().endswith('.tar')
+        self._members = dict(members) if members else None
+        self._complete = False
+        self._init_handles()
+
+    def _init_handles(self):
+        self._fd = None
+        self._local = threading.local()
+        self._handles = []
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # open files can not be pickled, each process opens the archive again
+        state = self.__dict__.copy()
+        for key in ['_fd', '_local', '_handles', '_lock']:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_handles()
+
+    def _list(self):
+        members = {}
+        if self.is_zip:
+            with open(self.path, 'rb') as f, zipfile.ZipFile(f) as zf:
+                for info in zf.infolist():
+                    if not info.is_dir():
+                        compressed = info.compress_type != zipfile.ZIP_STORED or bool(info.flag_bits & 0x1)
+                        members[_normalize(info.filename)] = ArchiveMember(_zip_data_offset(f, info), info.file_size,
+                                                                           info.filename, compressed)
+        else:
+            with tarfile.open(self.path, 'r:*') as tf:
+                for info in tf:
+                    if info.isreg():
+                        members[_normalize(info.name)] = ArchiveMember(info.offset_data, info.size, info.name)
+        self._members = members
+        self._complete = True
+
+    @property
+    def members(self) -> dict:
+        if not self._complete:
+            self._list()
+        return self._members
+
+    def member(self, name) -> ArchiveMember:
+        if self._members is None or (name not in self._members and not self._complete):
+            self._list()
+        return self._members[name]
+
+    def add_members(self, members: dict) -> None:
+        if not self._complete:
+            self._members = {**(self._members or {}), **members}
+
+    def listdir(self, folder: str = "") -> list:
+        '''
+        Returns the names of the members directly inside folder, in name order
+        '''
+        prefix = f"{folder.rstrip('/')}/" if folder else ""
+        return sorted(name for name in self.members if name.startswith(prefix) and "/" not in name[len(prefix):])
+
+    def _file_descriptor(self):
+        with self._lock:
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_RDONLY)
+            return self._fd
+
+    def _thread_handle(self):
+        # zipfile objects and decompressed streams keep a position, so every thread has its own
+        handle = getattr(self._local, 'handle', None)
+        if handle is None:
+            if self.is_zip:
+                handle = zipfile.ZipFile(self.path)
+            else:
+                decompress = next(decompress for ext, decompress in _DECOMPRESSORS.items() if self.path.lower().endswith(ext))
+                handle = decompress(self.path, 'rb')
+            self._local.handle = handle
+            with self._lock:
+                self._handles.append(handle)
+        return handle
+
+    def open(self, name: str) -> MemberFile:
+        member = self.member(name)
+        if self.is_zip and member.compressed:
+            return MemberFile(name, member.size, fileobj=self._thread_handle().open(member.name or name))
+        if self.is_compressed:
+            # the whole member is decompressed at once, going back in the stream would decompress it again from the start
+            stream = self._thread_handle()
+            stream.seek(member.offset)
+            return MemberFile(name, member.size, fileobj=io.BytesIO(stream.read(member.size)))
+        return MemberFile(name, member.size, fd=self._file_descriptor(), offset=member.offset)
+
+    def read_key(self, name: str):
+        '''
+        Sort key of the members in the order they are best read in: archive order for compressed tarballs
+        '''
+        return self.member(name).offset if self.is_compressed else 0
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+            for handle in self._handles:
+                handle.close()
+            self._fd, self._handles = None, []
+        self._local = threading.local()
+
+
+# archives opened in this process, so that each of them is only listed once
+_ARCHIVES = {}
+
+
+def open_archive(path: str, members: dict = None) -> Archive:
+    '''
+    Returns the (cached) Archive at path. Archives that changed on disk since they were cached are listed again.
+    '''
+    stat = os.stat(path)
+    archive = _ARCHIVES.get(path)
+    if archive is None or archive.signature != (stat.st_size, stat.st_mtime_ns):
+        if archive is not None:
+            archive.close()
+        archive = _ARCHIVES[path] = Archive(path, members)
+    elif members:
+        archive.add_members(members)
+    return archive
+
+
+def open_member(path: str) -> MemberFile:
+    archive, member = split_archive_path(path)
+    return open_archive(archive).open(member)
+
+
+def read_order(paths: list) -> list:
+    '''
+    Returns the indices of paths in the order to read them in: the members of each compressed tarball in
+    their order in the archive, after the other paths in their given order
+    '''
+    def key(index):
+        archive, member = split_archive_path(paths[index])
+        if member is not None:
+            try:
+                archive = open_archive(archive)
+                if archive.is_compressed:
+                    return 1, archive.path, archive.read_key(member)
+            except (OSError, KeyError, tarfile.TarError):  # reported when the member is read
+                pass
+        return 0, "", index
+    return sorted(range(len(paths)), key=key)
+
+
+def member_signature(path: str):
+    '''
+    Returns the (size, modification time in ns) of a file or archive member. Members share the modification
+    time of their archive.
+    '''
+    archive, member = split_archive_path(path)
+    if member is None:
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+    archive = open_archive(archive)
+    return archive.member(member).size, archive.signature[1]
+
+
+def walk_archive(path: str, sniff_preamble: bool = False):
+    '''
+    Yields the <archive>!/<member> path of every DICOM file in the archive, in name order.
+    Hidden files and directories are skipped like in walk_dicoms. If the archive can not be listed, its own
+    path is yielded instead, so that the crawler reports it with the files that could not be crawled.
+    '''
+    try:
+        archive = open_archive(path)
+        names = sorted(archive.members)
+    except (OSError, tarfile.TarError, zipfile.BadZipFile):
+        yield path
+        return
+    names = [name for name in names if not any(part.startswith('.') or part == '__MACOSX' for part in name.split('/'))]
+    sniffed = set()
+    if sniff_preamble:
+        for name in sorted((name for name in names if not name.endswith('.dcm')), key=archive.read_key):
+            with archive.open(name) as f:
+                if f.read(132)[128:] == b"DICM":
+                    sniffed.add(name)
+    for name in names:
+        if name.endswith('.dcm') or name in sniffed:
+            yield f"{path}{ARCHIVE_SEP}{name}"
+
+
+def list_archive_dir(path: str) -> list:
+    '''
+    Returns the member paths of the DICOM files directly inside a folder of an archive (<archive>!/<folder>)
+    '''
+    archive, folder = split_archive_path(path)
+    return [f"{archive}{ARCHIVE_SEP}{name}" for name in open_archive(archive).listdir(folder) if name.endswith('.dcm')]
+
+
+def read_dataset(path: str, **kwargs):
+    '''
+    dcmread for both plain paths and archive member paths
+    '''
+    if not is_archive_path(path):
+        return dcmread(path, **kwargs)
+    with open_member(path) as f:
+        return dcmread(f, **kwargs)
+
+
+def read_archive_series(file_names: list) -> sitk.Image:
+    '''
+    Assembles a DICOM series (or one multi-frame file, e.g. RTDOSE) into a SimpleITK image, decoding the
+    slices with pydicom straight from the archive members instead of extracting them for GDCM.
+
+    Like GDCM, the slices are sorted along the slice normal and the rescale slope/intercept is applied.
+    The pixels keep their stored type if the rescale is the identity, are stored as the smallest signed
+    integer type that fits if it is integral and as float32 otherwise.
+    '''
+    datasets = [None] * len(file_names)
+    for index in read_order(file_names):
+        datasets[index] = read_dataset(file_names[index], force=True)
+    orientation = [float(value) for value in getattr(datasets[0], 'ImageOrientationPatient', [1, 0, 0, 0, 1, 0])]
+    normal = np.cross(orientation[:3], orientation[3:])
+    has_positions = len(datasets) > 1 and all(hasattr(ds, 'ImagePositionPatient') for ds in datasets)
+    if has_positions:
+        datasets.sort(key=lambda ds: float(np.dot(normal, [float(value) for value in ds.ImagePositionPatient])))
+
+    slopes, intercepts, slices = [], [], []
+    for ds in datasets:
+        pixels = ds.pixel_array
+        if pixels.ndim == 2:
+            pixels = pixels[np.newaxis]
+        slices.append(pixels)
+        slopes.append(float(getattr(ds, 'RescaleSlope', 1)))
+        intercepts.append(float(getattr(ds, 'RescaleIntercept', 0)))
+
+    if all(slope == 1 for slope in slopes) and all(intercept == 0 for intercept in intercepts):
+        array = np.concatenate(slices)
+    else:
+        array = np.concatenate([pixels * slope + intercept for pixels, slope, intercept in zip(slices, slopes, intercepts)])
+        if all(float(value).is_integer() for value in slopes + intercepts):
+            dtype = np.int16 if array.min() >= np.iinfo(np.int16).min and array.max() <= np.iinfo(np.int16).max else np.int32
+            array = array.astype(dtype)
+        else:
+            array = array.astype(np.float32)
+
+    first = datasets[0]
+    origin = [float(value) for value in getattr(first, 'ImagePositionPatient', [0, 0, 0])]
+    spacing_row, spacing_column = [float(value) for value in getattr(first, 'PixelSpacing', [1, 1])]
+    if has_positions:
+        second = [float(value) for value in datasets[1].ImagePositionPatient]
+        spacing_slice = abs(float(np.dot(normal, np.subtract(second, origin))))
+    elif len(getattr(first, 'GridFrameOffsetVector', [])) > 1:
+        offsets = [float(value) for value in first.GridFrameOffsetVector]
+        spacing_slice = abs(offsets[1] - offsets[0])
+        normal = normal if offsets[1] >= offsets[0] else -normal
+    else:
+        spacing_slice = float(getattr(first, 'SliceThickness', 1) or 1)
+
+    image = sitk.GetImageFromArray(array)
+    image.SetOrigin(origin)
+    image.SetSpacing([spacing_column, spacing_row, spacing_slice or 1.])
+    image.SetDirection([orientation[0], orientation[3], normal[0],
+                        orientation[1], orientation[4], normal[1],
+                        orientation[2], orientation[5], normal[2]])
+    return image
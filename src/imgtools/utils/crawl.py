@@ -1,194 +1,1087 @@
 from argparse import ArgumentParser
+import bisect
+import io
 import os
 import pathlib
 import glob
 import json
+import math
+import re
+import struct
+import time
+import zlib
+import numpy as np
 import pandas as pd
 from pydicom import dcmread
+from pydicom.errors import InvalidDicomError
 from tqdm import tqdm
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, effective_n_jobs
 
+from .archive import is_archive, split_archive_path, open_archive, open_member, member_signature, read_order, walk_archive
+from .crawl_tree import write_tree
+from .header_cache import DEFAULT_MAX_BYTES, HeaderCache, get_header_cache
 
-def crawl_one(folder):
-    folder_path = pathlib.Path(folder)
-    database = {}
-    for path, _, _ in os.walk(folder):
-        # find dicoms
-        dicoms = glob.glob(pathlib.Path(path, "**", "*.dcm").as_posix(), recursive=True)
-        # print('\n', folder, dicoms)
-        # instance (slice) information
-        for dcm in dicoms:
+
+# bump whenever the fields returned by crawl_instance change, so stale manifests are ignored
+MANIFEST_VERSION = 3
+
+# the only tags crawl_instance looks at; everything else (ContourData, DVHSequence, ...) is skipped while parsing
+CRAWL_TAGS = ['SpecificCharacterSet', 'PatientID', 'StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID', 'Modality',
+              'StudyDescription', 'SeriesDescription', 'AcquisitionNumber', 'FrameOfReferenceUID',
+              'ImageOrientationPatient', 'AnatomicalOrientationType',
+              'ReferencedFrameOfReferenceSequence', 'ReferencedSeriesSequence', 'ReferencedStructureSetSequence',
+              'ReferencedImageSequence', 'ReferencedRTPlanSequence',
+              'RepetitionTime', 'EchoTime', 'ScanningSequence', 'MagneticFieldStrength', 'ImagedNucleus',
+              'ImagePositionPatient', 'InstanceNumber', 'SliceThickness', 'Rows', 'Columns',
+              'StructureSetROISequence']
+
+
+# columns of the crawl DataFrame/CSV, one row per subseries
+CRAWL_COLUMNS = ['patient_ID', 'study', 'study_description', 
+                 'series', 'series_description', 'subseries', 'modality', 
+                 'instances', 'instance_uid', 
+                 'reference_ct', 'reference_rs', 'reference_pl', 'reference_frame', 'folder',
+                 'orientation', 'orientation_type', 'MR_repetition_time', 'MR_echo_time', 
+                 'MR_scan_sequence', 'MR_magnetic_field_strength', 'MR_imaged_nucleus', 'file_path']
+
+# crawl DataFrame column -> key of the subseries entry in the crawled database
+_SUBSERIES_COLUMNS = {'instance_uid': 'instance_uid',
+                      'modality': 'modality',
+                      'reference_ct': 'reference_ct',
+                      'reference_rs': 'reference_rs',
+                      'reference_pl': 'reference_pl',
+                      'reference_frame': 'reference_frame',
+                      'folder': 'folder',
+                      'orientation': 'orientation',
+                      'orientation_type': 'orientation_type',
+                      'MR_repetition_time': 'repetition_time',
+                      'MR_echo_time': 'echo_time',
+                      'MR_scan_sequence': 'scan_sequence',
+                      'MR_magnetic_field_strength': 'mag_field_strength',
+                      'MR_imaged_nucleus': 'imaged_nucleus',
+                      'file_path': 'fname'}
+
+CATEGORICAL_COLUMNS = ['modality', 'study_description', 'series_description']
+
+# columns of the ROI catalog DataFrame/CSV, one row per ROI of every crawled RTSTRUCT
+ROI_COLUMNS = ['patient_ID', 'study', 'series', 'subseries', 'instance_uid', 'roi_number', 'roi_name', 'contours', 'points', 'file_path']
+
+# upper edges (in ms) of the bins of the per-modality parse time histograms, the last bin holds everything slower
+PARSE_TIME_BINS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+# number of example paths kept per error category and number of folders listed in the crawl report
+ERROR_SAMPLES = 5
+SLOWEST_FOLDERS = 10
+
+
+class _CountingFile(io.FileIO):
+    """Read-only file that keeps track of the number of bytes actually read from it."""
+    def __init__(self, path):
+        super().__init__(path, 'rb')
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def _has_preamble(path):
+    """Whether the file starts with the 128 byte preamble followed by the DICM prefix."""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(132)[128:] == b"DICM"
+    except OSError:
+        return False
+
+
+_UNDEFINED_LENGTH = 0xFFFFFFFF
+_ITEM = 0xFFFEE000
+_DELIMITERS = (0xFFFEE00D, 0xFFFEE0DD)  # item, sequence
+_LONG_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+_ROI_CONTOUR_SEQUENCE = 0x30060039
+
+
+def _read_element_header(f, implicit, endian):
+    """Reads the tag, VR and value length of the next data element (or item/delimiter), None at the end of the file."""
+    header = f.read(8)
+    if len(header) < 8:
+        return None
+    group, element = struct.unpack(f"{endian}HH", header[:4])
+    tag = (group << 16) | element
+    if implicit or group == 0xFFFE:
+        return tag, None, struct.unpack(f"{endian}L", header[4:])[0]
+    vr = header[4:6]
+    if vr in _LONG_VRS:
+        return tag, vr, struct.unpack(f"{endian}L", f.read(4))[0]
+    return tag, vr, struct.unpack(f"{endian}H", header[6:])[0]
+
+
+def _read_items(f, length, implicit, endian, read_item):
+    """Calls read_item(f, item length) for every item of the sequence value at the current position."""
+    end = None if length == _UNDEFINED_LENGTH else f.tell() + length
+    results = []
+    while end is None or f.tell() < end:
+        header = _read_element_header(f, implicit, endian)
+        if header is None or header[0] != _ITEM:  # sequence delimiter
+            break
+        results.append(read_item(f, header[2]))
+    return results
+
+
+def _read_elements(f, length, implicit, endian, read_value=None, stop_after=None):
+    """Walks the data elements of a dataset or item, seeking over the values that are not read.
+
+    read_value(f, tag, vr, length) is called for every element, and returns
+    False for values that it did not read. Values of undefined length
+    (sequences and encapsulated data) are walked item by item, without
+    reading them. Stops after the element with tag stop_after.
+    """
+    end = None if length == _UNDEFINED_LENGTH else f.tell() + length
+    while end is None or f.tell() < end:
+        header = _read_element_header(f, implicit, endian)
+        if header is None or header[0] in _DELIMITERS:
+            break
+        tag, vr, value_length = header
+        if read_value is None or read_value(f, tag, vr, value_length) is False:
+            if value_length == _UNDEFINED_LENGTH:
+                _read_items(f, value_length, implicit, endian, lambda f, item_length: _read_elements(f, item_length, implicit, endian))
+            else:
+                f.seek(value_length, io.SEEK_CUR)
+        if stop_after is not None and tag >= stop_after:
+            break
+
+
+def read_contour_counts(f, implicit: bool = False, little_endian: bool = True) -> dict:
+    """Counts the contours and contour points of every ROI of an RTSTRUCT without reading the ContourData.
+
+    Only the element headers of the ROIContourSequence and the
+    NumberOfContourPoints values are read, everything else is skipped over.
+
+    Parameters
+    ----------
+    f
+        RTSTRUCT file opened in binary mode.
+
+    implicit, little_endian, optional
+        Encoding of the dataset (from the transfer syntax of the file).
+
+    Returns
+    -------
+    Dictionary {ReferencedROINumber: (number of contours, number of points)}.
+    """
+    endian = '<' if little_endian else '>'
+    f.seek(0)
+    if f.read(132)[128:] != b"DICM":
+        f.seek(0)
+    # the file meta information is always explicit VR little endian
+    while True:
+        position = f.tell()
+        header = _read_element_header(f, False, '<')
+        if header is None or header[0] >> 16 != 0x0002:
+            f.seek(position)
+            break
+        f.seek(header[2], io.SEEK_CUR)
+
+    counts = {}
+
+    def read_contour(f, length):
+        points = {}
+
+        def read_value(f, tag, vr, value_length):
+            if tag == 0x30060046:  # NumberOfContourPoints
+                value = f.read(value_length)
+                points['points'] = int(value.strip(b'\x00 ') or 0)
+                return True
+            return False
+
+        _read_elements(f, length, implicit, endian, read_value)
+        return points.get('points', 0)
+
+    def read_roi(f, length):
+        roi = {'number': None, 'points': []}
+
+        def read_value(f, tag, vr, value_length):
+            if tag == 0x30060084:  # ReferencedROINumber
+                value = f.read(value_length)
+                roi['number'] = int(value.strip(b'\x00 '))
+                return True
+            if tag == 0x30060040:  # ContourSequence
+                roi['points'] = _read_items(f, value_length, implicit, endian, read_contour)
+                return True
+            return False
+
+        _read_elements(f, length, implicit, endian, read_value)
+        if roi['number'] is not None:
+            counts[roi['number']] = (len(roi['points']), sum(roi['points']))
+
+    def read_value(f, tag, vr, value_length):
+        if tag == _ROI_CONTOUR_SEQUENCE:
+            _read_items(f, value_length, implicit, endian, read_roi)
+            return True
+        return False
+
+    _read_elements(f, _UNDEFINED_LENGTH, implicit, endian, read_value, stop_after=_ROI_CONTOUR_SEQUENCE)
+    return counts
+
+
+def roi_catalog(meta, f=None) -> list:
+    """Returns the ROIs of an RTSTRUCT, [{"number", "name", "contours", "points"}], in StructureSetROISequence order.
+
+    The contours are counted from the ROIContourSequence of `meta` if it was
+    read, otherwise from the file `f` with read_contour_counts.
+    """
+    if 'ROIContourSequence' in meta:
+        counts = {}
+        for roi_contour in meta.ROIContourSequence:
+            contours = roi_contour.get('ContourSequence', [])
+            counts[int(roi_contour.ReferencedROINumber)] = (len(contours), sum(int(contour.get('NumberOfContourPoints', 0)) for contour in contours))
+    elif f is not None:
+        counts = read_contour_counts(f, meta.is_implicit_VR, meta.is_little_endian)
+    else:
+        counts = {}
+    rois = []
+    for roi in meta.get('StructureSetROISequence', []):
+        number = int(roi.ROINumber)
+        contours, points = counts.get(number, (0, 0))
+        rois.append({'number': number, 'name': str(roi.get('ROIName', '')), 'contours': contours, 'points': points})
+    return rois
+
+
+def walk_dicoms(top, sniff_preamble: bool = False, archives: bool = False):
+    """Yields the path of every DICOM file under `top` exactly once.
+
+    The tree is listed with a single os.scandir per directory, in name order,
+    with the files of a directory before those of its subdirectories. Hidden
+    files and directories are skipped. Symbolic links to directories are
+    followed, but every directory is only listed once.
+
+    Parameters
+    ----------
+    top
+        Directory (or archive, if `archives` is True) to walk.
+
+    sniff_preamble, optional
+        Whether to also yield files without the .dcm extension whose first
+        132 bytes contain the DICOM preamble and "DICM" prefix.
+
+    archives, optional
+        Whether to also yield the DICOM files inside .zip/.tar archives, as
+        <archive>!/<member> paths (see walk_archive).
+    """
+    visited = set()
+    stack = [top]
+    while stack:
+        path = stack.pop()
+        if archives and is_archive(path) and os.path.isfile(path):
+            yield from walk_archive(path, sniff_preamble)
+            continue
+        try:
+            stat = os.stat(path)
+            if (stat.st_dev, stat.st_ino) in visited:
+                continue
+            visited.add((stat.st_dev, stat.st_ino))
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            continue
+
+        subdirs = []
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
             try:
-                dcm_path  = pathlib.Path(dcm)
-                # parent    = dcm_path.parent#.as_posix()
-                fname     = dcm_path.name
-                rel_path  = dcm_path.relative_to(folder_path.parent.parent)                                        # rel_path of dicom from folder
-                rel_posix = rel_path.parent.as_posix()     # folder name + until parent folder of dicom
-
-                meta      = dcmread(dcm, force=True, stop_before_pixels=True)
-                patient   = str(meta.PatientID)
-                study     = str(meta.StudyInstanceUID)
-                series    = str(meta.SeriesInstanceUID)
-                instance  = str(meta.SOPInstanceUID)
-
-                reference_ct, reference_rs, reference_pl,  = "", "", ""
-                tr, te, tesla, scan_seq, elem = "", "", "", "", ""
-                try:
-                    orientation = str(meta.ImageOrientationPatient)  # (0020, 0037)
-                except:
-                    orientation = ""
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+                elif entry.name.endswith('.dcm'):
+                    yield entry.path
+                elif archives and is_archive(entry.name) and entry.is_file():
+                    yield from walk_archive(entry.path, sniff_preamble)
+                elif sniff_preamble and entry.is_file() and _has_preamble(entry.path):
+                    yield entry.path
+            except OSError:
+                continue
+        stack.extend(reversed(subdirs))
 
-                try:
-                    orientation_type = str(meta.AnatomicalOrientationType)  # (0010, 2210)
-                except:
-                    orientation_type = ""
-
-                try:  # RTSTRUCT
-                    reference_ct = str(meta.ReferencedFrameOfReferenceSequence[0].RTReferencedStudySequence[0].RTReferencedSeriesSequence[0].SeriesInstanceUID)
-                except: 
-                    try: # SEGMENTATION
-                        reference_ct = str(meta.ReferencedSeriesSequence[0].SeriesInstanceUID)
-                    except:
-                        try:  # RTDOSE
-                            reference_rs = str(meta.ReferencedStructureSetSequence[0].ReferencedSOPInstanceUID)
-                        except:
-                            pass
-                        try:
-                            reference_ct = str(meta.ReferencedImageSequence[0].ReferencedSOPInstanceUID)
-                        except:
-                            pass
-                        try:
-                            reference_pl = str(meta.ReferencedRTPlanSequence[0].ReferencedSOPInstanceUID)
-                        except:
-                            pass
-                
-                # MRI Tags
-                try:
-                    tr = float(meta.RepetitionTime)
-                except:
-                    pass
-                try:
-                    te = float(meta.EchoTime)
-                except:
-                    pass
-                try:
-                    scan_seq = str(meta.ScanningSequence)
-                except:
-                    pass
-                try:
-                    tesla = float(meta.MagneticFieldStrength)
-                except:
-                    pass
-                try:
-                    elem = str(meta.ImagedNucleus)
-                except:
-                    pass
-                
-                # Frame of Reference UIDs
-                try:
-                    reference_frame = str(meta.FrameOfReferenceUID)
-                except:
-                    try:
-                        reference_frame = str(meta.ReferencedFrameOfReferenceSequence[0].FrameOfReferenceUID)
-                    except:
-                        reference_frame = ""
-        
-                try:
-                    study_description = str(meta.StudyDescription)
-                except:
-                    study_description = ""
 
-                try:
-                    series_description = str(meta.SeriesDescription)
-                except:
-                    series_description = ""
+def crawl_instance(dcm, root, fast_header: bool = True, stats=None, cache=None):
+    """Reads the header of one DICOM file and returns the crawler record for it.
 
-                try:
-                    subseries = str(meta.AcquisitionNumber)
-                except:
-                    subseries = "default"
-
-                if patient not in database:
-                    database[patient] = {}
-                if study not in database[patient]:
-                    database[patient][study] = {'description': study_description}
-                if series not in database[patient][study]:
-                    rel_crawl_path = rel_posix
-                    if meta.Modality == 'RTSTRUCT':
-                        rel_crawl_path = os.path.join(rel_crawl_path, fname)
-                    
-                    database[patient][study][series] = {'description': series_description}
-                if subseries not in database[patient][study][series]:
-                    database[patient][study][series][subseries] = {'instances': {},
-                                                                   'instance_uid': instance,
-                                                                   'modality': meta.Modality,
-                                                                   'reference_ct': reference_ct,
-                                                                   'reference_rs': reference_rs,
-                                                                   'reference_pl': reference_pl,
-                                                                   'reference_frame': reference_frame,
-                                                                   'folder': rel_crawl_path,
-                                                                   'orientation': orientation,
-                                                                   'orientation_type': orientation_type,
-                                                                   'repetition_time':tr,
-                                                                   'echo_time':te,
-                                                                   'scan_sequence': scan_seq,
-                                                                   'mag_field_strength': tesla,
-                                                                   'imaged_nucleus': elem,
-                                                                   'fname': rel_path.as_posix()  # temporary until we switch to json-based loading
-                                                                   }
-                database[patient][study][series][subseries]['instances'][instance] = rel_path.as_posix()
-            except Exception as e:
-                print(folder, e)
+    Parameters
+    ----------
+    dcm
+        Path to the DICOM file, or <archive>!/<member> for files inside
+        archives.
+
+    root
+        Directory the relative paths stored in the record are computed from
+        (one level above the dataset directory).
+
+    fast_header, optional
+        Whether to only decode the tags listed in CRAWL_TAGS. The values of all
+        other elements are skipped over instead of being read, which avoids
+        parsing e.g. the ContourData of RTSTRUCTs or the DVHs of RTDOSEs.
+
+    stats, optional
+        Dictionary updated in place with the number of files, bytes read and
+        total file size per modality.
+
+    cache, optional
+        HeaderCache to look the header up in before reading the file. Files
+        inside archives are always read.
+
+    Returns
+    -------
+    Dictionary with the patient/study/series/instance UIDs, the references to
+    other DICOMs and the modality specific tags extracted by the crawler,
+    including the ROIs of RTSTRUCTs (see roi_catalog).
+    """
+    dcm_path  = pathlib.Path(dcm)
+    fname     = dcm_path.name
+    rel_path  = dcm_path.relative_to(root)      # rel_path of dicom from folder
+    rel_posix = rel_path.parent.as_posix()      # folder name + until parent folder of dicom
+
+    # members of archives are read in place, without extracting them
+    archive, member = split_archive_path(dcm)
+    specific_tags = CRAWL_TAGS if fast_header else None
+    meta, bytes_read = None, 0
+    if cache is not None and member is None:
+        meta = cache.get(dcm, specific_tags)
+    if meta is None:
+        with _CountingFile(dcm) if member is None else open_member(dcm) as f:
+            meta = dcmread(f, force=True, stop_before_pixels=True, specific_tags=specific_tags)
+            bytes_read = f.bytes_read
+        if cache is not None and member is None:
+            cache.put(dcm, meta, specific_tags)
+    patient   = str(meta.PatientID)
+    study     = str(meta.StudyInstanceUID)
+    series    = str(meta.SeriesInstanceUID)
+    instance  = str(meta.SOPInstanceUID)
+    modality  = str(meta.Modality)
+
+    # ROI catalog of RTSTRUCTs; the contours are counted without reading their ContourData
+    rois = None
+    if modality == 'RTSTRUCT':
+        if 'ROIContourSequence' in meta:
+            rois = roi_catalog(meta)
+        else:
+            with _CountingFile(dcm) if member is None else open_member(dcm) as f:
+                rois = roi_catalog(meta, f)
+                bytes_read += f.bytes_read
+
+    if stats is not None:
+        modality_stats = stats.setdefault(modality, {'files': 0, 'bytes_read': 0, 'file_bytes': 0})
+        modality_stats['files'] += 1
+        modality_stats['bytes_read'] += bytes_read
+        modality_stats['file_bytes'] += os.path.getsize(dcm) if member is None else open_archive(archive).member(member).size
+
+    reference_ct, reference_rs, reference_pl,  = "", "", ""
+    tr, te, tesla, scan_seq, elem = "", "", "", "", ""
+    try:
+        orientation = str(meta.ImageOrientationPatient)  # (0020, 0037)
+    except:
+        orientation = ""
+
+    try:
+        orientation_type = str(meta.AnatomicalOrientationType)  # (0010, 2210)
+    except:
+        orientation_type = ""
+
+    try:  # RTSTRUCT
+        reference_ct = str(meta.ReferencedFrameOfReferenceSequence[0].RTReferencedStudySequence[0].RTReferencedSeriesSequence[0].SeriesInstanceUID)
+    except: 
+        try: # SEGMENTATION
+            reference_ct = str(meta.ReferencedSeriesSequence[0].SeriesInstanceUID)
+        except:
+            try:  # RTDOSE
+                reference_rs = str(meta.ReferencedStructureSetSequence[0].ReferencedSOPInstanceUID)
+            except:
+                pass
+            try:
+                reference_ct = str(meta.ReferencedImageSequence[0].ReferencedSOPInstanceUID)
+            except:
+                pass
+            try:
+                reference_pl = str(meta.ReferencedRTPlanSequence[0].ReferencedSOPInstanceUID)
+            except:
                 pass
     
+    # MRI Tags
+    try:
+        tr = float(meta.RepetitionTime)
+    except:
+        pass
+    try:
+        te = float(meta.EchoTime)
+    except:
+        pass
+    try:
+        scan_seq = str(meta.ScanningSequence)
+    except:
+        pass
+    try:
+        tesla = float(meta.MagneticFieldStrength)
+    except:
+        pass
+    try:
+        elem = str(meta.ImagedNucleus)
+    except:
+        pass
+    
+    # Frame of Reference UIDs
+    try:
+        reference_frame = str(meta.FrameOfReferenceUID)
+    except:
+        try:
+            reference_frame = str(meta.ReferencedFrameOfReferenceSequence[0].FrameOfReferenceUID)
+        except:
+            reference_frame = ""
+
+    try:
+        study_description = str(meta.StudyDescription)
+    except:
+        study_description = ""
+
+    try:
+        series_description = str(meta.SeriesDescription)
+    except:
+        series_description = ""
+
+    try:
+        subseries = str(meta.AcquisitionNumber)
+    except:
+        subseries = "default"
+
+    # geometry of the instance, so that series can be sorted and assembled without reading the files again
+    geometry = {'position': "", 'instance_number': "", 'slice_thickness': "", 'rows': "", 'columns': "", 'transfer_syntax': ""}
+    try:
+        geometry['position'] = [float(value) for value in meta.ImagePositionPatient]  # (0020, 0032)
+    except:
+        pass
+    try:
+        geometry['instance_number'] = int(meta.InstanceNumber)
+    except:
+        pass
+    try:
+        geometry['slice_thickness'] = float(meta.SliceThickness)
+    except:
+        pass
+    try:
+        geometry['rows'] = int(meta.Rows)
+        geometry['columns'] = int(meta.Columns)
+    except:
+        pass
+    try:
+        geometry['transfer_syntax'] = str(meta.file_meta.TransferSyntaxUID)
+    except:
+        pass
+
+    rel_crawl_path = rel_posix
+    if modality == 'RTSTRUCT':
+        rel_crawl_path = os.path.join(rel_crawl_path, fname)
+
+    return {'patient': patient,
+            'study': study,
+            'study_description': study_description,
+            'series': series,
+            'series_description': series_description,
+            'subseries': subseries,
+            'instance': instance,
+            'modality': modality,
+            'reference_ct': reference_ct,
+            'reference_rs': reference_rs,
+            'reference_pl': reference_pl,
+            'reference_frame': reference_frame,
+            'folder': rel_crawl_path,
+            'orientation': orientation,
+            'orientation_type': orientation_type,
+            'repetition_time': tr,
+            'echo_time': te,
+            'scan_sequence': scan_seq,
+            'mag_field_strength': tesla,
+            'imaged_nucleus': elem,
+            'fname': rel_path.as_posix(),
+            'geometry': geometry,
+            'rois': rois}
+
+
+def add_instance(database, record):
+    """Inserts one crawler record into the nested patient/study/series/subseries database."""
+    patient, study, series, subseries = record['patient'], record['study'], record['series'], record['subseries']
+    if patient not in database:
+        database[patient] = {}
+    if study not in database[patient]:
+        database[patient][study] = {'description': record['study_description']}
+    if series not in database[patient][study]:
+        database[patient][study][series] = {'description': record['series_description']}
+    if subseries not in database[patient][study][series]:
+        database[patient][study][series][subseries] = {'instances': {},
+                                                       'instance_uid': record['instance'],
+                                                       'modality': record['modality'],
+                                                       'reference_ct': record['reference_ct'],
+                                                       'reference_rs': record['reference_rs'],
+                                                       'reference_pl': record['reference_pl'],
+                                                       'reference_frame': record['reference_frame'],
+                                                       'folder': record['folder'],
+                                                       'orientation': record['orientation'],
+                                                       'orientation_type': record['orientation_type'],
+                                                       'repetition_time': record['repetition_time'],
+                                                       'echo_time': record['echo_time'],
+                                                       'scan_sequence': record['scan_sequence'],
+                                                       'mag_field_strength': record['mag_field_strength'],
+                                                       'imaged_nucleus': record['imaged_nucleus'],
+                                                       'fname': record['fname'],  # temporary until we switch to json-based loading
+                                                       'geometry': {}
+                                                       }
+        if record.get('rois') is not None:
+            database[patient][study][series][subseries]['rois'] = record['rois']
+    database[patient][study][series][subseries]['instances'][record['instance']] = record['fname']
+    database[patient][study][series][subseries]['geometry'][record['instance']] = record['geometry']
     return database
 
 
-def to_df(database_dict):
-    df = pd.DataFrame()
-    for pat in database_dict:
-        for study in database_dict[pat]:
-            for series in database_dict[pat][study]:
-                if series != 'description':  # skip description key in dict
-                    for subseries in database_dict[pat][study][series]:
-                        if subseries != 'description':  # skip description key in dict
-                            columns = ['patient_ID', 'study', 'study_description', 
-                                       'series', 'series_description', 'subseries', 'modality', 
-                                       'instances', 'instance_uid', 
-                                       'reference_ct', 'reference_rs', 'reference_pl', 'reference_frame', 'folder',
-                                       'orientation', 'orientation_type', 'MR_repetition_time', 'MR_echo_time', 
-                                       'MR_scan_sequence', 'MR_magnetic_field_strength', 'MR_imaged_nucleus', 'file_path']
-                            values = [pat, study, database_dict[pat][study]['description'], 
-                                      series, database_dict[pat][study][series]['description'], 
-                                      subseries, database_dict[pat][study][series][subseries]['modality'], 
-                                      len(database_dict[pat][study][series][subseries]['instances']), database_dict[pat][study][series][subseries]['instance_uid'], 
-                                      database_dict[pat][study][series][subseries]['reference_ct'], database_dict[pat][study][series][subseries]['reference_rs'], 
-                                      database_dict[pat][study][series][subseries]['reference_pl'], database_dict[pat][study][series][subseries]['reference_frame'], database_dict[pat][study][series][subseries]['folder'],
-                                      database_dict[pat][study][series][subseries]['orientation'], database_dict[pat][study][series][subseries]['orientation_type'],
-                                      database_dict[pat][study][series][subseries]['repetition_time'], database_dict[pat][study][series][subseries]['echo_time'],
-                                      database_dict[pat][study][series][subseries]['scan_sequence'], database_dict[pat][study][series][subseries]['mag_field_strength'], database_dict[pat][study][series][subseries]['imaged_nucleus'],
-                                      database_dict[pat][study][series][subseries]['fname']
-                                      ]
-
-                            df_add = pd.DataFrame([values], columns=columns)
-                            df = pd.concat([df, df_add], ignore_index=True)
+def _slice_order(subseries):
+    """Returns the instances, orientation and positions of a crawled subseries, sorted like sorted_instances."""
+    instances = list(subseries['instances'])
+    geometry  = [subseries.get('geometry', {}).get(instance, {}) for instance in instances]
+
+    orientation = [float(value) for value in re.findall(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?", subseries.get('orientation', ""))]
+    positions   = [instance.get('position', "") for instance in geometry]
+    numbers     = [instance.get('instance_number', "") for instance in geometry]
+    if len(orientation) == 6 and all(isinstance(position, list) and len(position) == 3 for position in positions):
+        normal = np.cross(orientation[:3], orientation[3:])
+        keys   = [float(np.dot(normal, position)) for position in positions]
+    elif all(isinstance(number, int) for number in numbers):
+        keys = numbers
+    else:
+        keys = [0] * len(instances)
+
+    order = sorted(range(len(instances)), key=lambda i: (keys[i], subseries['instances'][instances[i]]))
+    return [instances[i] for i in order], orientation, [positions[i] for i in order]
+
+
+def sorted_instances(subseries, root=None):
+    """Returns the files of a crawled subseries in slice order, without reading them.
+
+    Like GDCM, the slices are sorted by the distance of their
+    ImagePositionPatient along the slice normal (from ImageOrientationPatient).
+    If the positions are not known, they are sorted by InstanceNumber and
+    otherwise by file name.
+
+    Parameters
+    ----------
+    subseries
+        Subseries entry of the crawled database, e.g. db[patient][study][series][subseries].
+
+    root, optional
+        Directory the crawled paths are relative to (one level above the
+        dataset directory). If given, the returned paths are joined to it.
+    """
+    files = [subseries['instances'][instance] for instance in _slice_order(subseries)[0]]
+    if root is not None:
+        files = [pathlib.Path(root, file).as_posix() for file in files]
+    return files
+
+
+def sorted_geometry(subseries):
+    """Returns the ImageOrientationPatient of a crawled subseries and the
+    ImagePositionPatient of its files in the slice order of sorted_instances,
+    without reading them, or None if they are not all known.
+
+    Parameters
+    ----------
+    subseries
+        Subseries entry of the crawled database, e.g. db[patient][study][series][subseries].
+    """
+    _, orientation, positions = _slice_order(subseries)
+    if len(orientation) != 6 or not all(isinstance(position, list) and len(position) == 3 for position in positions):
+        return None
+    return orientation, positions
+
+
+def _error_category(e):
+    """Groups the exceptions raised while crawling a file for the crawl report."""
+    if isinstance(e, InvalidDicomError):
+        return 'invalid_dicom'
+    if isinstance(e, (AttributeError, KeyError)):
+        return 'missing_tag'
+    if isinstance(e, OSError):
+        return 'io_error'
+    return type(e).__name__
+
+
+def _new_profile():
+    return {'parse_times': {}, 'folders': {}, 'errors': {}, 'header_cache': {'hits': 0, 'misses': 0}}
+
+
+# header caches opened in this process, by path
+_HEADER_CACHES = {}
+
+
+def _open_header_cache(path, max_bytes):
+    if path not in _HEADER_CACHES:
+        _HEADER_CACHES[path] = HeaderCache(path, max_bytes)
+    return _HEADER_CACHES[path]
+
+
+def _add_error(profile, category, path, message):
+    errors = profile['errors'].setdefault(category, {'count': 0, 'samples': []})
+    errors['count'] += 1
+    if len(errors['samples']) < ERROR_SAMPLES:
+        errors['samples'].append({'path': path, 'error': message})
+
+
+def _crawl_files(files, root, manifest=None, fast_header=True, archives=None, header_cache=None):
+    """Crawls a list of files, re-using the manifest records of files that did not change.
+
+    `archives` holds the member index ({archive path: {member: ArchiveMember}})
+    of the archive members in `files`, so that the archives do not have to be
+    listed again in every worker process. `header_cache` is the (path,
+    max_bytes) of the HeaderCache to use, if any.
+
+    Returns
+    -------
+    The list of crawler records in the order of `files`, the manifest entries
+    ({relative path: {"size", "mtime_ns", "record"[, "error"]}}) of every file
+    found, the per-modality header read statistics of the files that were read, the
+    throughput of this call ({"pid", "files", "bytes", "seconds"}) and its
+    profile ({"parse_times", "folders", "errors"}, see crawl_report).
+    """
+    if manifest is None:
+        manifest = {}
+    for archive, members in (archives or {}).items():
+        open_archive(archive, members)
+    cache = _open_header_cache(*header_cache) if header_cache is not None else None
+    hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    start = time.perf_counter()
+    crawled, stats, profile = [None] * len(files), {}, _new_profile()
+    n_bytes = 0
+    # the members of compressed tarballs are read in archive order, the results are kept in the order of files
+    for index in read_order(files):
+        dcm = files[index]
+        try:
+            rel_path = pathlib.Path(dcm).relative_to(root).as_posix()
+            size, mtime_ns = member_signature(dcm)
+            cached   = manifest.get(rel_path)
+            unlisted_archive = is_archive(dcm) and split_archive_path(dcm)[1] is None
+            if cached is not None and cached['size'] == size and cached['mtime_ns'] == mtime_ns:
+                entry = cached
+                if cached.get('error') is not None:  # failed in the previous crawl and did not change since
+                    _add_error(profile, *cached['error'])
+            else:
+                n_bytes += size
+                entry = {'size': size, 'mtime_ns': mtime_ns, 'record': None}
+                parse_start = time.perf_counter()
+                try:
+                    if unlisted_archive:  # yielded by walk_archive if it could not be listed
+                        open_archive(dcm)
+                    entry['record'] = crawl_instance(dcm, root, fast_header=fast_header, stats=stats, cache=cache)
+                except Exception as e:
+                    entry['error'] = ['archive' if unlisted_archive else _error_category(e), rel_path, str(e)]
+                    _add_error(profile, *entry['error'])
+                seconds = time.perf_counter() - parse_start
+
+                folder = profile['folders'].setdefault(pathlib.PurePosixPath(rel_path).parent.as_posix(), {'files': 0, 'seconds': 0.})
+                folder['files'] += 1
+                folder['seconds'] += seconds
+                if entry['record'] is not None:
+                    times = profile['parse_times'].setdefault(entry['record']['modality'],
+                                                              {'files': 0, 'seconds': 0., 'max_seconds': 0.,
+                                                               'histogram': [0] * (len(PARSE_TIME_BINS_MS) + 1)})
+                    times['files'] += 1
+                    times['seconds'] += seconds
+                    times['max_seconds'] = max(times['max_seconds'], seconds)
+                    times['histogram'][bisect.bisect_left(PARSE_TIME_BINS_MS, seconds * 1000)] += 1
+            crawled[index] = rel_path, entry
+        except Exception as e:
+            _add_error(profile, _error_category(e), str(dcm), str(e))
+    crawled = [item for item in crawled if item is not None]
+    entries = dict(crawled)
+    records = [entry['record'] for _, entry in crawled if entry['record'] is not None]
+    worker = {'pid': os.getpid(), 'files': len(files), 'bytes': n_bytes, 'seconds': time.perf_counter() - start}
+    if cache is not None:
+        profile['header_cache'] = {'hits': cache.hits - hits, 'misses': cache.misses - misses}
+    return records, entries, stats, worker, profile
+
+
+def crawl_one(folder, fast_header: bool = True, sniff_preamble: bool = False, archives: bool = False, header_cache=None):
+    files = list(walk_dicoms(folder, sniff_preamble, archives))
+    records, _, _, _, _ = _crawl_files(files, pathlib.Path(folder).parent.parent, fast_header=fast_header,
+                                       header_cache=_header_cache_args(header_cache))
+    database = {}
+    for record in records:
+        add_instance(database, record)
+    return database
+
+
+def _crawl_chunk(index, files, root, manifest, fast_header, archives=None, header_cache=None):
+    return (index, *_crawl_files(files, root, manifest, fast_header, archives, header_cache))
+
+
+def _header_cache_args(header_cache):
+    """(path, max_bytes) of the header cache to send to the workers: the given HeaderCache or path, or the enabled one."""
+    if header_cache is None:
+        header_cache = get_header_cache()
+    if header_cache is None:
+        return None
+    if isinstance(header_cache, HeaderCache):
+        return header_cache.path, header_cache.max_bytes
+    return header_cache, DEFAULT_MAX_BYTES
+
+
+def _chunk(files, n_workers, chunk_size=None):
+    """Splits the file list into contiguous chunks, several per worker so that idle workers can pick up the rest."""
+    if chunk_size is None:
+        chunk_size = min(256, max(1, math.ceil(len(files) / (8 * n_workers))))
+    return [files[i:i + chunk_size] for i in range(0, len(files), chunk_size)]
+
+
+def worker_report(workers):
+    """Aggregates the throughput of the crawled chunks per worker process."""
+    report = {}
+    for worker in workers:
+        totals = report.setdefault(str(worker['pid']), {'chunks': 0, 'files': 0, 'bytes': 0, 'seconds': 0.})
+        totals['chunks'] += 1
+        for key in ['files', 'bytes', 'seconds']:
+            totals[key] += worker[key]
+    for totals in report.values():
+        totals['files_per_second'] = totals['files'] / totals['seconds'] if totals['seconds'] > 0 else 0.
+        totals['bytes_per_second'] = totals['bytes'] / totals['seconds'] if totals['seconds'] > 0 else 0.
+    return report
+
+
+def merge_profile(total, profile):
+    """Adds the profile of one chunk of files (see _crawl_files) to the total, in place."""
+    for modality, times in profile['parse_times'].items():
+        if modality not in total['parse_times']:
+            total['parse_times'][modality] = {'files': 0, 'seconds': 0., 'max_seconds': 0.,
+                                              'histogram': [0] * (len(PARSE_TIME_BINS_MS) + 1)}
+        total_times = total['parse_times'][modality]
+        total_times['files'] += times['files']
+        total_times['seconds'] += times['seconds']
+        total_times['max_seconds'] = max(total_times['max_seconds'], times['max_seconds'])
+        total_times['histogram'] = [a + b for a, b in zip(total_times['histogram'], times['histogram'])]
+    for folder, times in profile['folders'].items():
+        total_times = total['folders'].setdefault(folder, {'files': 0, 'seconds': 0.})
+        total_times['files'] += times['files']
+        total_times['seconds'] += times['seconds']
+    for category, errors in profile['errors'].items():
+        total_errors = total['errors'].setdefault(category, {'count': 0, 'samples': []})
+        total_errors['count'] += errors['count']
+        total_errors['samples'] = (total_errors['samples'] + errors['samples'])[:ERROR_SAMPLES]
+    for key in ['hits', 'misses']:
+        total['header_cache'][key] += profile['header_cache'][key]
+    return total
+
+
+def crawl_report(stats, workers, profile, seconds):
+    """Builds the crawl report saved as imgtools_<dataset>_report.json.
+
+    Parameters
+    ----------
+    stats
+        Per-modality header read statistics (see crawl_instance).
+
+    workers
+        Throughput of every crawled chunk (see _crawl_files).
+
+    profile
+        Merged parse times, folder times and errors of all chunks.
+
+    seconds
+        Wall time of the crawl.
+
+    Returns
+    -------
+    Dictionary with the overall throughput ("files", "seconds",
+    "files_per_second", "bytes_per_second"), the header bytes read per
+    modality ("header_bytes"), the throughput per worker process
+    ("workers"), the parse time count/total/max and histogram per modality
+    ("parse_times", with bins of PARSE_TIME_BINS_MS), the folders that took
+    the longest to parse ("slowest_folders") and the number of files that
+    could not be crawled per error category, with example paths ("errors"),
+    and the hits and misses of the header cache ("header_cache").
+    """
+    n_files = sum(worker['files'] for worker in workers)
+    n_bytes = sum(worker['bytes'] for worker in workers)
+    parse_times = {}
+    for modality in sorted(profile['parse_times']):
+        times = dict(profile['parse_times'][modality])
+        times['mean_seconds'] = times['seconds'] / times['files'] if times['files'] > 0 else 0.
+        times['histogram'] = {'bins_ms': PARSE_TIME_BINS_MS, 'counts': times['histogram']}
+        parse_times[modality] = times
+    folders = sorted(profile['folders'].items(), key=lambda item: (-item[1]['seconds'], item[0]))[:SLOWEST_FOLDERS]
+    lookups = profile['header_cache']['hits'] + profile['header_cache']['misses']
+    return {'files': n_files,
+            'seconds': seconds,
+            'files_per_second': n_files / seconds if seconds > 0 else 0.,
+            'bytes_per_second': n_bytes / seconds if seconds > 0 else 0.,
+            'header_bytes': header_report(stats),
+            'workers': worker_report(workers),
+            'parse_times': parse_times,
+            'slowest_folders': [{'folder': folder, **times} for folder, times in folders],
+            'errors': {category: profile['errors'][category] for category in sorted(profile['errors'])},
+            'header_cache': {**profile['header_cache'],
+                             'hit_rate': profile['header_cache']['hits'] / lookups if lookups > 0 else 0.}}
+
+
+def print_report(report):
+    """Prints the summary of a crawl report (see crawl_report), as the command line crawler does."""
+    for modality, modality_stats in report['header_bytes'].items():
+        print(f"{modality}: read {modality_stats['bytes_read']} of {modality_stats['file_bytes']} bytes "
+              f"from {modality_stats['files']} files ({modality_stats['bytes_saved']:.1%} skipped)")
+    for pid, worker in report['workers'].items():
+        print(f"worker {pid}: {worker['files']} files in {worker['chunks']} chunks, "
+              f"{worker['files_per_second']:.1f} files/s, {worker['bytes_per_second'] / 1e6:.1f} MB/s")
+    if report['header_cache']['hits'] + report['header_cache']['misses'] > 0:
+        print(f"header cache: {report['header_cache']['hits']} hits, {report['header_cache']['misses']} misses "
+              f"({report['header_cache']['hit_rate']:.1%} hit rate)")
+    for category, errors in report['errors'].items():
+        print(f"{errors['count']} files could not be crawled ({category}), e.g. {errors['samples'][0]['path']}: "
+              f"{errors['samples'][0]['error']}")
+
+
+def load_manifest(manifest_path):
+    """Loads the per-file crawl manifest, returning an empty manifest if it is missing or outdated."""
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return manifest['files']
+
+
+def save_manifest(manifest_path, entries):
+    with open(manifest_path, 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'files': entries}, f)
+
+
+def header_report(stats):
+    """Summarizes the per-modality header read statistics, including the fraction of bytes not read."""
+    report = {}
+    for modality in sorted(stats):
+        modality_stats = dict(stats[modality])
+        if modality_stats['file_bytes'] > 0:
+            modality_stats['bytes_saved'] = 1 - modality_stats['bytes_read'] / modality_stats['file_bytes']
+        else:
+            modality_stats['bytes_saved'] = 0.
+        report[modality] = modality_stats
+    return report
+
+
+def to_df(database_dict, categorical: bool = False):
+    """Flattens the crawled database into a DataFrame with one row per subseries.
+
+    Parameters
+    ----------
+    database_dict
+        Nested patient/study/series/subseries dictionary returned by crawl.
+
+    categorical, optional
+        Whether to store the columns with few distinct values (modality, study
+        and series descriptions) with a categorical dtype. Does not change the
+        CSV written from the DataFrame.
+    """
+    columns = {column: [] for column in CRAWL_COLUMNS}
+    for pat, studies in database_dict.items():
+        for study, study_dict in studies.items():
+            for series, series_dict in study_dict.items():
+                if series == 'description':  # skip description key in dict
+                    continue
+                for subseries, subseries_dict in series_dict.items():
+                    if subseries == 'description':  # skip description key in dict
+                        continue
+                    columns['patient_ID'].append(pat)
+                    columns['study'].append(study)
+                    columns['study_description'].append(study_dict['description'])
+                    columns['series'].append(series)
+                    columns['series_description'].append(series_dict['description'])
+                    columns['subseries'].append(subseries)
+                    columns['instances'].append(len(subseries_dict['instances']))
+                    for column, key in _SUBSERIES_COLUMNS.items():
+                        columns[column].append(subseries_dict[key])
+
+    if len(columns['patient_ID']) == 0:
+        return pd.DataFrame()
+
+    df = pd.DataFrame(columns, columns=CRAWL_COLUMNS)
+    if categorical:
+        for column in CATEGORICAL_COLUMNS:
+            df[column] = df[column].astype('category')
     return df
 
 
+def to_roi_df(database_dict):
+    """Flattens the ROI catalog of the crawled RTSTRUCTs into a DataFrame with one row per ROI.
+
+    Parameters
+    ----------
+    database_dict
+        Nested patient/study/series/subseries dictionary returned by crawl.
+    """
+    columns = {column: [] for column in ROI_COLUMNS}
+    for pat, studies in database_dict.items():
+        for study, study_dict in studies.items():
+            for series, series_dict in study_dict.items():
+                if series == 'description':
+                    continue
+                for subseries, subseries_dict in series_dict.items():
+                    if subseries == 'description':
+                        continue
+                    for roi in subseries_dict.get('rois', []):
+                        columns['patient_ID'].append(pat)
+                        columns['study'].append(study)
+                        columns['series'].append(series)
+                        columns['subseries'].append(subseries)
+                        columns['instance_uid'].append(subseries_dict['instance_uid'])
+                        columns['roi_number'].append(roi['number'])
+                        columns['roi_name'].append(roi['name'])
+                        columns['contours'].append(roi['contours'])
+                        columns['points'].append(roi['points'])
+                        columns['file_path'].append(subseries_dict['fname'])
+    return pd.DataFrame(columns, columns=ROI_COLUMNS)
+
+
+def roi_feasibility(rois, roi_names):
+    """Which patients have ROIs matching the given names/regexes, computed from the ROI catalog alone.
+
+    ROI names match a pattern like in StructureSet.to_segmentation (full,
+    case-insensitive match), and only ROIs with at least one contour count,
+    since StructureSet skips the others.
+
+    Parameters
+    ----------
+    rois
+        ROI catalog DataFrame (see to_roi_df) or path to the
+        imgtools_<dataset>_rois.csv written by crawl.
+
+    roi_names
+        Patterns to look for, as in roi_names.yaml: a dictionary of
+        {label: pattern or list of patterns}, a list of patterns or a pattern.
+
+    Returns
+    -------
+    Boolean DataFrame with one row per patient with an RTSTRUCT and one column
+    per label (or pattern), plus a "feasible" column which is True if all
+    labels were found.
+    """
+    if isinstance(rois, str):
+        rois = pd.read_csv(rois, index_col=0, dtype={'patient_ID': str, 'roi_name': str}, keep_default_na=False)
+    if isinstance(roi_names, str):
+        roi_names = [roi_names]
+    if not isinstance(roi_names, dict):
+        roi_names = {pattern if isinstance(pattern, str) else '|'.join(pattern): pattern for pattern in roi_names}
+
+    rois = rois[rois['contours'] > 0]
+    names = pd.Series(rois['roi_name'].astype(str).unique())
+    patients = pd.Index(rois['patient_ID'].astype(str).unique(), name='patient_ID')
+    feasibility = pd.DataFrame(index=patients)
+    for label, patterns in roi_names.items():
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        regex = re.compile('|'.join(f"(?:{pattern})" for pattern in patterns), flags=re.IGNORECASE)
+        matching = set(names[[regex.fullmatch(name) is not None for name in names]])
+        found = rois.loc[rois['roi_name'].astype(str).isin(matching), 'patient_ID'].astype(str).unique()
+        feasibility[label] = patients.isin(found)
+    feasibility['feasible'] = feasibility.all(axis=1)
+    return feasibility
+
+
 def crawl(top, 
-          n_jobs: int = -1):
+          n_jobs: int = -1,
+          incremental: bool = True,
+          fast_header: bool = True,
+          chunk_size: int = None,
+          sniff_preamble: bool = False,
+          sqlite_index: bool = False,
+          export_json: bool = True,
+          archives: bool = False,
+          return_report: bool = False,
+          shard: tuple = None,
+          header_cache=None):
+    """Crawls the dataset and saves the index in the .imgtools folder next to it.
+
+    Parameters
+    ----------
+    top
+        Top-level directory of the dataset.
+
+    n_jobs, optional
+        Number of parallel processes used to crawl the files.
+
+    incremental, optional
+        Whether to re-use the per-file manifest of the previous crawl, so that
+        only new or changed files (by size and modification time) are read.
+        Files that were deleted since the last crawl are dropped. If False,
+        every file is read again.
+
+    fast_header, optional
+        Whether to only decode the tags the crawler uses (see crawl_instance).
+        The bytes read per modality are saved in imgtools_<dataset>_report.json.
+
+    chunk_size, optional
+        Number of files per task. The files of all folders are split into
+        chunks which the worker processes pick up as soon as they are free, so
+        that one large patient folder does not keep a single worker busy while
+        the others are idle. Defaults to about 8 chunks per worker, at most 256
+        files each.
+
+    sniff_preamble, optional
+        Whether to also crawl files without the .dcm extension that start with
+        the DICOM preamble (see walk_dicoms).
+
+    sqlite_index, optional
+        Whether to also save the crawl as an indexed SQLite database
+        (imgtools_<dataset>.db, see CrawlIndex), which can be queried by
+        patient/study/series/SOP UID without loading the full crawl.
+
+    export_json, optional
+        Whether to also save the crawl tree as JSON (imgtools_<dataset>.json).
+        The tree is always saved in the compact binary format
+        (imgtools_<dataset>.tree, see CrawlTree), from which single patients
+        can be loaded without decoding the whole file.
+
+    archives, optional
+        Whether to also crawl the DICOM files inside .zip/.tar archives,
+        without extracting them. Only the headers are read from the archives;
+        the files are saved as <archive>!/<member> paths, which the loaders
+        read straight from the archive.
+
+    return_report, optional
+        Whether to also return the crawl report (see crawl_report), which is
+        always saved as imgtools_<dataset>_report.json.
+
+    shard, optional
+        (shard index, shard count) to only crawl the top-level folders
+        assigned to this shard by shard_of, e.g. on one of several nodes
+        sharing the filesystem. The partial crawl is saved as
+        imgtools_<dataset>_shard_<index>_of_<count>.json instead of the
+        standard outputs, which merge_shards writes once all shards are done.
+
+    header_cache, optional
+        HeaderCache (or the path to one) that the headers are looked up in
+        before the files are read. Defaults to the cache enabled with
+        enable_header_cache, if any.
+
+    Returns
+    -------
+    The crawled database as a nested patient/study/series/subseries dictionary
+    (of this shard only, in shard mode), and the crawl report if
+    return_report is True.
+    """
+    start = time.perf_counter()
     # top is the input directory in the argument parser from autotest.py
-    database_list = []
-    folders = glob.glob(pathlib.Path(top, "*").as_posix())
-    
-    database_list = Parallel(n_jobs=n_jobs)(delayed(crawl_one)(pathlib.Path(top, folder).as_posix()) for folder in tqdm(folders))
+    folders = sorted(glob.glob(pathlib.Path(top, "*").as_posix()))
+    if shard is not None:
+        shard_index, shard_count = shard
+        if not 0 <= shard_index < shard_count:
+            raise ValueError(f"Invalid shard {shard_index} of {shard_count}.")
+        folders = [folder for folder in folders if shard_of(os.path.basename(folder), shard_count) == shard_index]
 
-    # convert list to dictionary
-    database_dict = {}
-    for db in database_list:
-        for key in db:
-            database_dict[key] = db[key]
-    
     # save one level above imaging folders
     parent, dataset  = os.path.split(top)
 
@@ -199,17 +1092,198 @@ def crawl(top,
             os.makedirs(parent_imgtools)
         except:
             pass
-    
+
+    manifest_path = pathlib.Path(parent_imgtools, f'imgtools_{dataset}_manifest.json').as_posix()
+    manifest = load_manifest(manifest_path) if incremental else {}
+
+    root  = pathlib.Path(top).parent
+    files = [dcm for folder in folders for dcm in walk_dicoms(folder, sniff_preamble, archives)]
+
+    # the members of compressed tarballs are crawled in archive order (going back in the decompressed
+    # stream decompresses it again from the start), their entries are merged back in file order
+    read_files = [files[i] for i in read_order(files)]
+
+    # only send each chunk the manifest entries of its own files
+    n_workers = effective_n_jobs(n_jobs)
+    chunks    = _chunk(read_files, n_workers, chunk_size)
+    tasks     = []
+    header_cache = _header_cache_args(header_cache)
+    for i, chunk in enumerate(chunks):
+        chunk_manifest, chunk_archives = {}, {}
+        for dcm in chunk:
+            rel_path = pathlib.Path(dcm).relative_to(root).as_posix()
+            if rel_path in manifest:
+                chunk_manifest[rel_path] = manifest[rel_path]
+            archive, member = split_archive_path(dcm)
+            if member is not None:  # the offsets of the members, listed while walking the dataset
+                chunk_archives.setdefault(archive, {})[member] = open_archive(archive).member(member)
+        tasks.append(delayed(_crawl_chunk)(i, chunk, root, chunk_manifest, fast_header, chunk_archives, header_cache))
+
+    # chunks are handed out to the workers as they become free and come back in completion order,
+    # sorting them by index makes the merged database independent of the scheduling
+    results = Parallel(n_jobs=n_jobs, batch_size=1, return_as="generator_unordered")(tasks)
+    results = sorted(tqdm(results, total=len(chunks)), key=lambda result: result[0])
+
+    # merge the manifest entries (which hold the records) of all chunks, in file order
+    entries, stats, workers, profile = {}, {}, [], _new_profile()
+    for _, _, chunk_entries, chunk_stats, worker, chunk_profile in results:
+        entries.update(chunk_entries)
+        workers.append(worker)
+        merge_profile(profile, chunk_profile)
+        merge_stats(stats, chunk_stats)
+    if read_files != files:
+        file_order = (pathlib.Path(dcm).relative_to(root).as_posix() for dcm in files)
+        entries = {rel_path: entries[rel_path] for rel_path in file_order if rel_path in entries}
+
+    if shard is not None:
+        shard_path = pathlib.Path(parent_imgtools, f'imgtools_{dataset}_shard_{shard_index}_of_{shard_count}.json').as_posix()
+        save_shard(shard_path, shard, entries, stats, workers, profile, time.perf_counter() - start)
+        database_dict = _database(entries)
+        if return_report:
+            return database_dict, crawl_report(stats, workers, profile, time.perf_counter() - start)
+        return database_dict
+
+    database_dict, report = _save_crawl(top, entries, stats, workers, profile, time.perf_counter() - start,
+                                        export_json=export_json, sqlite_index=sqlite_index)
+    if return_report:
+        return database_dict, report
+    return database_dict
+
+
+def shard_of(folder_name, shard_count):
+    """Shard a top-level folder of the dataset is crawled in.
+
+    Uses CRC32 of the folder name, which (unlike hash()) is the same on every
+    node and Python process.
+    """
+    return zlib.crc32(folder_name.encode('utf-8')) % shard_count
+
+
+def save_shard(shard_path, shard, entries, stats, workers, profile, seconds):
+    """Saves the partial crawl of one shard, written to a temporary file first so merge_shards never sees a partial file."""
+    with open(f"{shard_path}.tmp", 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'shard': list(shard), 'files': entries, 'stats': stats,
+                   'workers': workers, 'profile': profile, 'seconds': seconds}, f)
+    os.replace(f"{shard_path}.tmp", shard_path)
+
+
+def merge_shards(top,
+                 shard_count: int = None,
+                 export_json: bool = True,
+                 sqlite_index: bool = False,
+                 return_report: bool = False):
+    """Merges the partial crawls of crawl(top, shard=(i, n)) into the standard crawl outputs.
+
+    The files of every top-level folder are crawled by exactly one shard, in
+    the same order as by a single crawl. Concatenating the shards folder by
+    folder, in folder name order, gives the same manifest and therefore
+    byte-identical JSON/CSV/tree outputs as crawl(top).
+
+    Parameters
+    ----------
+    top
+        Top-level directory of the dataset.
+
+    shard_count, optional
+        Number of shards the dataset was crawled in. Defaults to the count
+        found in the .imgtools folder.
+
+    export_json, sqlite_index, return_report, optional
+        As in crawl.
+
+    Returns
+    -------
+    The crawled database, and the crawl report if return_report is True.
+    """
+    parent, dataset = os.path.split(top)
+    parent_imgtools = pathlib.Path(parent, ".imgtools").as_posix()
+    pattern = re.compile(rf"imgtools_{re.escape(dataset)}_shard_(\d+)_of_(\d+)\.json")
+    found = {}
+    for name in os.listdir(parent_imgtools) if os.path.isdir(parent_imgtools) else []:
+        match = pattern.fullmatch(name)
+        if match is not None:
+            found.setdefault(int(match.group(2)), {})[int(match.group(1))] = pathlib.Path(parent_imgtools, name).as_posix()
+    if shard_count is None:
+        if len(found) != 1:
+            raise ValueError(f"Expected the shards of one crawl in {parent_imgtools}, found shard counts {sorted(found)}.")
+        shard_count = next(iter(found))
+    missing = [index for index in range(shard_count) if index not in found.get(shard_count, {})]
+    if missing:
+        raise FileNotFoundError(f"Shards {missing} of {shard_count} of {dataset} were not crawled yet.")
+
+    # group the files by top-level folder; each folder is in exactly one shard, in crawl order
+    folders, stats, workers, profile, seconds = {}, {}, [], _new_profile(), 0.
+    for index in range(shard_count):
+        with open(found[shard_count][index], 'r') as f:
+            partial = json.load(f)
+        if partial.get('version') != MANIFEST_VERSION:
+            raise ValueError(f"{found[shard_count][index]} was written by another version of the crawler.")
+        for rel_path, entry in partial['files'].items():
+            folders.setdefault(rel_path.split('/')[1], {})[rel_path] = entry
+        merge_stats(stats, partial['stats'])
+        merge_profile(profile, partial['profile'])
+        workers.extend(partial['workers'])
+        seconds = max(seconds, partial['seconds'])
+
+    # same order as the sorted folder paths of crawl, the archives at the top level are named <archive>!
+    entries = {}
+    for folder in sorted(folders, key=lambda folder: folder[:-1] if folder.endswith('!') else folder):
+        entries.update(folders[folder])
+
+    database_dict, report = _save_crawl(top, entries, stats, workers, profile, seconds,
+                                        export_json=export_json, sqlite_index=sqlite_index)
+    if return_report:
+        return database_dict, report
+    return database_dict
+
+
+def merge_stats(total, stats):
+    """Adds per-modality header read statistics (see crawl_instance) to the total, in place."""
+    for modality, modality_stats in stats.items():
+        modality_total = total.setdefault(modality, {'files': 0, 'bytes_read': 0, 'file_bytes': 0})
+        for key in modality_total:
+            modality_total[key] += modality_stats[key]
+    return total
+
+
+def _database(entries):
+    database_dict = {}
+    for entry in entries.values():
+        if entry['record'] is not None:
+            add_instance(database_dict, entry['record'])
+    return database_dict
+
+
+def _save_crawl(top, entries, stats, workers, profile, seconds, export_json=True, sqlite_index=False):
+    """Builds the database from the manifest entries and saves the crawl outputs in the .imgtools folder."""
+    parent, dataset = os.path.split(top)
+    parent_imgtools = pathlib.Path(parent, ".imgtools").as_posix()
+    database_dict   = _database(entries)
+
+    write_tree(pathlib.Path(parent_imgtools, f'imgtools_{dataset}.tree').as_posix(), database_dict)
+
     # save as json
-    with open(pathlib.Path(parent_imgtools, f'imgtools_{dataset}.json').as_posix(), 'w') as f:
-        json.dump(database_dict, f, indent=4)
+    if export_json:
+        with open(pathlib.Path(parent_imgtools, f'imgtools_{dataset}.json').as_posix(), 'w') as f:
+            json.dump(database_dict, f, indent=4)
     
     # save as dataframe
     df = to_df(database_dict)
     df_path = pathlib.Path(parent_imgtools, f'imgtools_{dataset}.csv').as_posix()
     df.to_csv(df_path)
+    to_roi_df(database_dict).to_csv(pathlib.Path(parent_imgtools, f'imgtools_{dataset}_rois.csv').as_posix())
+
+    if sqlite_index:
+        from .crawl_index import CrawlIndex
+        CrawlIndex.build(pathlib.Path(parent_imgtools, f'imgtools_{dataset}.db').as_posix(), database_dict)
+
+    save_manifest(pathlib.Path(parent_imgtools, f'imgtools_{dataset}_manifest.json').as_posix(), entries)
+
+    report = crawl_report(stats, workers, profile, seconds)
+    with open(pathlib.Path(parent_imgtools, f'imgtools_{dataset}_report.json').as_posix(), 'w') as f:
+        json.dump(report, f, indent=4)
     
-    return database_dict
+    return database_dict, report
 
 
 if __name__ == "__main__":
@@ -221,7 +1295,71 @@ if __name__ == "__main__":
                         type=int,
                         default=16,
                         help="Number of parallel processes for multiprocessing.")
+    parser.add_argument("--full",
+                        action="store_true",
+                        help="Re-read every file instead of only the ones changed since the last crawl.")
+    parser.add_argument("--sniff_preamble",
+                        action="store_true",
+                        help="Also crawl files without the .dcm extension that start with the DICOM preamble.")
+    parser.add_argument("--sqlite_index",
+                        action="store_true",
+                        help="Also save the crawl as an indexed SQLite database.")
+    parser.add_argument("--no_json",
+                        action="store_true",
+                        help="Only save the crawl tree in the binary format, not as JSON.")
+    parser.add_argument("--archives",
+                        action="store_true",
+                        help="Also crawl the DICOM files inside .zip/.tar archives, without extracting them.")
+    parser.add_argument("--full_header",
+                        action="store_true",
+                        help="Decode every header tag instead of only the ones used by the crawler.")
+
+    parser.add_argument("--shard_index",
+                        type=int,
+                        default=None,
+                        help="Only crawl the top-level folders of this shard (requires --shard_count).")
+    parser.add_argument("--shard_count",
+                        type=int,
+                        default=None,
+                        help="Number of shards the dataset is crawled in, e.g. one per node.")
+    parser.add_argument("--merge_shards",
+                        action="store_true",
+                        help="Merge the crawled shards into the standard crawl outputs.")
+
+    parser.add_argument("--header_cache",
+                        type=str,
+                        default=None,
+                        help="Path to a persistent header cache shared by all crawls (e.g. ~/.cache/imgtools/dicom_headers.db).")
+    parser.add_argument("--watch",
+                        action="store_true",
+                        help="Keep the crawl and the edge table (imgtools_<dataset>_edges.csv) up to date as files arrive.")
+    parser.add_argument("--poll_interval",
+                        type=float,
+                        default=2.,
+                        help="Seconds between two updates in watch mode.")
 
     args = parser.parse_args()
-    db = crawl(args.directory, n_jobs=args.n_jobs)
-    print("# patients:", len(db))
+    if args.merge_shards and args.header_cache is not None:
+        parser.error("--header_cache has no effect with --merge_shards, the shards are merged without reading any file.")
+    if args.watch:
+        from .crawl_watch import watch
+        parent, dataset = os.path.split(args.directory.rstrip('/'))
+        watch(args.directory, pathlib.Path(parent, ".imgtools", f"imgtools_{dataset}_edges.csv").as_posix(),
+              poll_interval=args.poll_interval, fast_header=not args.full_header, sniff_preamble=args.sniff_preamble,
+              archives=args.archives, export_json=not args.no_json, header_cache=args.header_cache, n_jobs=args.n_jobs,
+              callback=lambda database, patients: print(f"Updated patients: {', '.join(sorted(patients))}"))
+    elif args.merge_shards:
+        db, report = merge_shards(args.directory, shard_count=args.shard_count,
+                                  sqlite_index=args.sqlite_index, export_json=not args.no_json, return_report=True)
+        print_report(report)
+        print("# patients:", len(db))
+    else:
+        if (args.shard_index is None) != (args.shard_count is None):
+            parser.error("--shard_index and --shard_count have to be given together.")
+        db, report = crawl(args.directory, n_jobs=args.n_jobs, incremental=not args.full, fast_header=not args.full_header,
+                           sniff_preamble=args.sniff_preamble, sqlite_index=args.sqlite_index,
+                           export_json=not args.no_json, archives=args.archives,
+                           shard=None if args.shard_index is None else (args.shard_index, args.shard_count),
+                           header_cache=args.header_cache, return_report=True)
+        print_report(report)
+        print("# patients:", len(db))
@@ -0,0 +1,210 @@
+import os
+import json
+import sqlite3
+from collections.abc import Mapping
+
+import pandas as pd
+
+from .crawl import CRAWL_COLUMNS, ROI_COLUMNS, _SUBSERIES_COLUMNS, to_df, to_roi_df
+
+
+# crawl columns that are looked up by value, each gets its own index
+INDEXED_COLUMNS = ['patient_ID', 'study', 'series', 'instance_uid',
+                   'reference_ct', 'reference_rs', 'reference_pl', 'reference_frame']
+
+# per-instance geometry recorded by the crawler, see crawl_instance
+_GEOMETRY_KEYS = ['position', 'instance_number', 'slice_thickness', 'rows', 'columns', 'transfer_syntax']
+
+
+class CrawlIndex:
+    '''
+    SQLite version of the crawler output (imgtools_<dataset>.db). It holds three tables:
+    1) subseries: one row per subseries with the same columns as the crawl CSV
+    2) instances: one row per SOP instance with its patient/study/series/subseries, file path and geometry
+    3) rois: one row per ROI of every RTSTRUCT, with the same columns as the ROI catalog CSV
+
+    The tables are indexed on the UID and reference columns, so that queries such as "which series references X"
+    or "the files of patient Y" do not need to load the full crawl.
+    '''
+    def __init__(self, path: str) -> None:
+        '''
+        Parameters
+        ----------
+        path
+            Path to the SQLite file written by CrawlIndex.build (or crawl with sqlite_index=True)
+        '''
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No crawl index found at {path}.")
+        self.path = path
+        self._conn = None
+
+    @property
+    def conn(self):
+        # connections can not be pickled/shared between processes, open one lazily in each of them
+        if self._conn is None:
+            self._conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        return self._conn
+
+    def __getstate__(self):
+        return {'path': self.path, '_conn': None}
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    @classmethod
+    def build(cls, path: str, database_dict: dict) -> 'CrawlIndex':
+        '''
+        Writes the crawled database to a new SQLite index at path, replacing any existing one.
+        '''
+        if os.path.exists(path):
+            os.remove(path)
+
+        df = to_df(database_dict)
+        rois = to_roi_df(database_dict)
+        instances = []
+        for patient, studies in database_dict.items():
+            for study, study_dict in studies.items():
+                for series, series_dict in study_dict.items():
+                    if series == 'description':
+                        continue
+                    for subseries, subseries_dict in series_dict.items():
+                        if subseries == 'description':
+                            continue
+                        for instance, file_path in subseries_dict['instances'].items():
+                            geometry = subseries_dict.get('geometry', {}).get(instance, {})
+                            position = geometry.get('position', "")
+                            instances.append((patient, study, series, subseries, instance, file_path,
+                                              json.dumps(position) if position != "" else "",
+                                              *(geometry.get(key, "") for key in _GEOMETRY_KEYS[1:])))
+
+        columns = ", ".join(f'"{column}"' for column in CRAWL_COLUMNS)
+        with sqlite3.connect(path) as conn:
+            conn.execute(f"CREATE TABLE subseries ({columns})")
+            conn.execute(f"CREATE TABLE instances (patient_ID, study, series, subseries, instance_uid, file_path, {', '.join(_GEOMETRY_KEYS)})")
+            if len(df) > 0:
+                placeholders = ", ".join("?" for _ in CRAWL_COLUMNS)
+                conn.executemany(f"INSERT INTO subseries VALUES ({placeholders})",
+                                 df[CRAWL_COLUMNS].itertuples(index=False, name=None))
+            conn.executemany(f"INSERT INTO instances VALUES ({', '.join('?' for _ in range(6 + len(_GEOMETRY_KEYS)))})", instances)
+            conn.execute(f"CREATE TABLE rois ({', '.join(ROI_COLUMNS)})")
+            conn.executemany(f"INSERT INTO rois VALUES ({', '.join('?' for _ in ROI_COLUMNS)})",
+                             rois[ROI_COLUMNS].itertuples(index=False, name=None))
+            for column in INDEXED_COLUMNS:
+                conn.execute(f'CREATE INDEX subseries_{column} ON subseries ("{column}")')
+            for column in ['patient_ID', 'series', 'instance_uid']:
+                conn.execute(f'CREATE INDEX instances_{column} ON instances ("{column}")')
+            for column in ['patient_ID', 'roi_name']:
+                conn.execute(f'CREATE INDEX rois_{column} ON rois ("{column}")')
+        conn.close()
+        return cls(path)
+
+    def _query(self, table: str, where: str = "", params=()) -> pd.DataFrame:
+        return pd.read_sql_query(f"SELECT * FROM {table} {where} ORDER BY rowid", self.conn, params=params)
+
+    def to_df(self) -> pd.DataFrame:
+        '''
+        Returns the full crawl DataFrame, identical to the one saved as imgtools_<dataset>.csv
+        '''
+        df = self._query("subseries")
+        if len(df) == 0:
+            return pd.DataFrame()
+        return df
+
+    def query(self, **filters) -> pd.DataFrame:
+        '''
+        Returns the subseries rows whose columns equal the given values, e.g. query(patient_ID="HN-CHUS-052", modality="CT")
+        '''
+        unknown = set(filters) - set(CRAWL_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown crawl columns {sorted(unknown)}, expected any of {CRAWL_COLUMNS}.")
+        where = " AND ".join(f'"{column}" = ?' for column in filters)
+        return self._query("subseries", f"WHERE {where}" if where else "", tuple(filters.values()))
+
+    def series_referencing(self, uid: str) -> pd.DataFrame:
+        '''
+        Returns the subseries rows referencing uid (a series or SOP instance UID) through any of the reference_* columns
+        '''
+        return self._query("subseries", "WHERE reference_ct = ? OR reference_rs = ? OR reference_pl = ?", (uid, uid, uid))
+
+    def instance(self, instance_uid: str) -> pd.DataFrame:
+        '''
+        Returns the patient/study/series/subseries and file path of the given SOPInstanceUID
+        '''
+        return self._query("instances", "WHERE instance_uid = ?", (instance_uid,))
+
+    def rois(self, **filters) -> pd.DataFrame:
+        '''
+        Returns the rows of the ROI catalog whose columns equal the given values, e.g. rois(patient_ID="HN-CHUS-052")
+        '''
+        unknown = set(filters) - set(ROI_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown ROI columns {sorted(unknown)}, expected any of {ROI_COLUMNS}.")
+        where = " AND ".join(f'"{column}" = ?' for column in filters)
+        return self._query("rois", f"WHERE {where}" if where else "", tuple(filters.values()))
+
+    def patients(self):
+        return [row[0] for row in self.conn.execute("SELECT patient_ID FROM subseries GROUP BY patient_ID ORDER BY MIN(rowid)")]
+
+    def patient_tree(self, patient_id: str) -> dict:
+        '''
+        Returns the crawled database of one patient, i.e. the same as crawl(...)[patient_id]
+        '''
+        subseries = self._query("subseries", "WHERE patient_ID = ?", (patient_id,))
+        if len(subseries) == 0:
+            raise KeyError(patient_id)
+        instances = self._query("instances", "WHERE patient_ID = ?", (patient_id,))
+
+        tree = {}
+        for row in subseries.itertuples(index=False):
+            row = row._asdict()
+            study = tree.setdefault(row['study'], {'description': row['study_description']})
+            series = study.setdefault(row['series'], {'description': row['series_description']})
+            entry = {'instances': {}}
+            entry.update({key: row[column] for column, key in _SUBSERIES_COLUMNS.items()})
+            entry['geometry'] = {}
+            series[row['subseries']] = entry
+        for row in instances.itertuples(index=False):
+            entry = tree[row.study][row.series][row.subseries]
+            entry['instances'][row.instance_uid] = row.file_path
+            geometry = {key: getattr(row, key) for key in _GEOMETRY_KEYS}
+            if geometry['position'] != "":
+                geometry['position'] = json.loads(geometry['position'])
+            entry['geometry'][row.instance_uid] = geometry
+        for row in self.rois(patient_ID=patient_id).itertuples(index=False):
+            entry = tree[row.study][row.series][row.subseries]
+            entry.setdefault('rois', []).append({'number': row.roi_number, 'name': row.roi_name,
+                                                 'contours': row.contours, 'points': row.points})
+        return tree
+
+    def tree(self) -> 'CrawlIndexTree':
+        '''
+        Returns a read-only mapping of patient ID -> patient_tree(patient ID), decoded on access
+        '''
+        return CrawlIndexTree(self)
+
+
+class CrawlIndexTree(Mapping):
+    '''
+    Lazy drop-in for the crawl JSON tree, only the accessed patients are loaded from the index.
+    '''
+    def __init__(self, index: CrawlIndex) -> None:
+        self.index = index
+        self._patients = None
+
+    def __getitem__(self, patient_id):
+        return self.index.patient_tree(patient_id)
+
+    def __iter__(self):
+        if self._patients is None:
+            self._patients = self.index.patients()
+        return iter(self._patients)
+
+    def __len__(self):
+        if self._patients is None:
+            self._patients = self.index.patients()
+        return len(self._patients)
+
+    def __contains__(self, patient_id):
+        return self.index.conn.execute("SELECT 1 FROM subseries WHERE patient_ID = ? LIMIT 1", (patient_id,)).fetchone() is not None
@@ -0,0 +1,146 @@
+import os
+import json
+import mmap
+import struct
+import zlib
+from collections.abc import Mapping
+
+
+# file layout: MAGIC | one zlib-compressed JSON record per patient | offset table | footer
+# where the offset table is the zlib-compressed JSON {patient: [offset, length]} and the footer
+# holds the offset and length of the table (2 x uint64, little endian) followed by MAGIC again
+MAGIC = b"IMGTREE1"
+_FOOTER = struct.Struct("<QQ")
+
+
+def write_tree(path: str, database_dict: dict) -> None:
+    '''
+    Writes the crawled database in the compact binary tree format read by CrawlTree.
+    The file is written next to path first and then moved in place, so readers never see a partial file.
+    '''
+    tmp_path = f"{path}.tmp"
+    offsets = {}
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        for patient, patient_dict in database_dict.items():
+            record = zlib.compress(json.dumps(patient_dict, separators=(',', ':')).encode('utf-8'))
+            offsets[patient] = [f.tell(), len(record)]
+            f.write(record)
+        table = zlib.compress(json.dumps(offsets, separators=(',', ':')).encode('utf-8'))
+        table_offset = f.tell()
+        f.write(table)
+        f.write(_FOOTER.pack(table_offset, len(table)))
+        f.write(MAGIC)
+    os.replace(tmp_path, path)
+
+
+def update_tree(path: str, patients: dict) -> None:
+    '''
+    Replaces the records of some patients in a file written with write_tree, e.g. after new files of these patients
+    were crawled, without encoding the other patients again. patients maps the patient IDs to their crawled database,
+    or to None for the patients to remove; the patients keep their place in the tree, new ones are added at the end.
+
+    The new records and offset table are appended to the file, so readers that mapped it before keep reading the
+    previous version. The file is written again with write_tree once less than half of it is still in use.
+    '''
+    tree = CrawlTree(path)
+    offsets = dict(tree.offsets)
+    file_size = len(tree._open())
+    tree.close()
+
+    records = []
+    for patient, patient_dict in patients.items():
+        if patient_dict is None:
+            offsets.pop(patient, None)
+        else:
+            records.append((patient, zlib.compress(json.dumps(patient_dict, separators=(',', ':')).encode('utf-8'))))
+    live = (sum(length for patient, (_, length) in offsets.items() if patient not in patients)
+            + sum(len(record) for _, record in records))
+    if 2 * live < file_size:
+        tree = CrawlTree(path)
+        database_dict = {patient: patients[patient] if patient in patients else tree[patient] for patient in offsets}
+        tree.close()
+        database_dict.update((patient, patient_dict) for patient, patient_dict in patients.items() if patient_dict is not None)
+        write_tree(path, database_dict)
+        return
+
+    with open(path, 'ab') as f:
+        for patient, record in records:
+            offsets[patient] = [f.tell(), len(record)]
+            f.write(record)
+        table = zlib.compress(json.dumps(offsets, separators=(',', ':')).encode('utf-8'))
+        table_offset = f.tell()
+        # one write, so that the footer at the end of the file is complete once it is there
+        f.write(table + _FOOTER.pack(table_offset, len(table)) + MAGIC)
+
+
+class CrawlTree(Mapping):
+    '''
+    Read-only mapping of patient ID -> crawled database of that patient, backed by a file written with write_tree.
+    Only the offset table is decoded when the file is opened, the patients are decoded from the memory-mapped
+    file when they are accessed, so looking up one patient does not load the whole crawl.
+    '''
+    def __init__(self, path: str) -> None:
+        '''
+        Parameters
+        ----------
+        path
+            Path to the imgtools_<dataset>.tree file saved by the crawler
+        '''
+        self.path = path
+        self._file = None
+        self._mmap = None
+        self._offsets = None
+
+    def _open(self):
+        if self._mmap is None:
+            self._file = open(self.path, 'rb')
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            footer_start = len(self._mmap) - _FOOTER.size - len(MAGIC)
+            if self._mmap[:len(MAGIC)] != MAGIC or self._mmap[footer_start + _FOOTER.size:] != MAGIC:
+                self.close()
+                raise ValueError(f"{self.path} is not a crawl tree file.")
+            table_offset, table_length = _FOOTER.unpack(self._mmap[footer_start:footer_start + _FOOTER.size])
+            self._offsets = json.loads(zlib.decompress(self._mmap[table_offset:table_offset + table_length]))
+        return self._mmap
+
+    @property
+    def offsets(self):
+        self._open()
+        return self._offsets
+
+    def __getitem__(self, patient_id):
+        offset, length = self.offsets[patient_id]
+        return json.loads(zlib.decompress(self._open()[offset:offset + length]))
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, patient_id):
+        return patient_id in self.offsets
+
+    def __getstate__(self):
+        # memory maps can not be pickled, each process maps the file again on first access
+        return {'path': self.path, '_file': None, '_mmap': None, '_offsets': None}
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+        self._file, self._mmap, self._offsets = None, None, None
+
+    def to_dict(self) -> dict:
+        '''
+        Decodes every patient, i.e. returns the same dictionary as the crawl JSON
+        '''
+        return {patient: self[patient] for patient in self}
+
+    def export_json(self, json_path: str) -> None:
+        '''
+        Writes the crawl JSON (imgtools_<dataset>.json) from the tree
+        '''
+        with open(json_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4)
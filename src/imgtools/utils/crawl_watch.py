@@ -0,0 +1,360 @@
+import os
+import pathlib
+import glob
+import threading
+import time
+import warnings
+from typing import Callable, Optional
+
+from .archive import split_archive_path, member_signature
+from .crawl import (crawl, walk_dicoms, load_manifest, merge_profile, merge_stats, to_df, _crawl_files, _database,
+                    _header_cache_args, _new_profile, _save_crawl)
+from .crawl_tree import CrawlTree, update_tree
+
+
+def walk_order(rel_path: str):
+    '''
+    Sort key that puts the relative paths of crawled files (<dataset>/<...>) in the order crawl finds them:
+    the top-level entries sorted by name, then in every directory the files before the subdirectories,
+    both sorted by name (see walk_dicoms), and the members of an archive sorted by name.
+    '''
+    path, member = split_archive_path(rel_path)
+    parts = path.split('/')[1:]
+    key = [(parts[0],)] + [(1, part) for part in parts[1:-1]]
+    if len(parts) > 1:
+        key.append((0, parts[-1]))
+    if member is not None:
+        key.append((2, member))
+    return key
+
+
+class CrawlWatcher:
+    '''
+    Keeps the crawl of a dataset (and optionally its DataGraph edge table) up to date while files are added to,
+    changed in or removed from the dataset directory, e.g. by a PACS export.
+
+    Only the changed files are read, only the crawl tree records of the patients they belong to are written again
+    and only their edges are formed again (in memory), so an update takes time in the size of the change rather than
+    of the dataset. The crawl outputs that hold the whole dataset (JSON, CSV, manifest, report) and the edge table
+    are written every save_interval seconds and when the watcher stops (see flush), after which they are the same as
+    those of a new crawl of the dataset.
+
+    Changes are picked up from filesystem events if watchdog (inotify on Linux) is installed, otherwise the
+    dataset is scanned for changed files (by size and modification time) every poll_interval seconds. Changes are
+    handled once they settled for debounce seconds, so that the files of a series arriving together are read in
+    one batch.
+    '''
+    def __init__(self,
+                 top: str,
+                 edge_path: Optional[str] = None,
+                 poll_interval: float = 2.,
+                 use_events: bool = True,
+                 fast_header: bool = True,
+                 sniff_preamble: bool = False,
+                 archives: bool = False,
+                 export_json: bool = True,
+                 header_cache=None,
+                 n_jobs: int = -1,
+                 debounce: float = 1.,
+                 save_interval: float = 30.,
+                 callback: Optional[Callable] = None) -> None:
+        '''
+        Parameters
+        ----------
+        top
+            Top-level directory of the dataset.
+
+        edge_path, optional
+            Edge table of the DataGraph to keep up to date, e.g. .imgtools/imgtools_<dataset>_edges.csv.
+            If None, only the crawl is updated.
+
+        poll_interval, optional
+            Seconds between two updates. Events arriving in between are handled together.
+
+        use_events, optional
+            Whether to use filesystem events if watchdog is installed, instead of scanning the dataset.
+
+        fast_header, sniff_preamble, archives, export_json, header_cache, optional
+            As in crawl.
+
+        n_jobs, optional
+            Number of processes of the first crawl, as in crawl.
+
+        debounce, optional
+            Seconds without new filesystem events (or, when scanning, since the changed files were last modified)
+            before the changes are read. Changes are read at the latest save_interval seconds after they were seen.
+
+        save_interval, optional
+            Seconds between two writes of the crawl outputs that hold the whole dataset and of the edge table.
+
+        callback, optional
+            Called with the crawled database (a CrawlTree) and the set of updated patient IDs after every update.
+        '''
+        self.top = top.rstrip('/')
+        self.root = pathlib.Path(self.top).parent
+        parent, dataset = os.path.split(self.top)
+        self.manifest_path = pathlib.Path(parent, ".imgtools", f'imgtools_{dataset}_manifest.json').as_posix()
+        self.crawl_path = pathlib.Path(parent, ".imgtools", f'imgtools_{dataset}.csv').as_posix()
+        self.tree_path = pathlib.Path(parent, ".imgtools", f'imgtools_{dataset}.tree').as_posix()
+        self.edge_path = edge_path
+        self.poll_interval = poll_interval
+        self.use_events = use_events
+        self.fast_header = fast_header
+        self.sniff_preamble = sniff_preamble
+        self.archives = archives
+        self.export_json = export_json
+        self.header_cache = header_cache
+        self.n_jobs = n_jobs
+        self.debounce = debounce
+        self.save_interval = save_interval
+        self.callback = callback
+
+        self.entries = None
+        self.graph = None
+        self._patient_files = {}
+        self._observer = None
+        self._pending = set()
+        self._first_event, self._last_event = None, None
+        self._deferred_since = None
+        self._lock = threading.Lock()
+        self._reset_batch()
+
+    def _reset_batch(self):
+        # patients changed since the outputs were written, and the statistics of the crawls since then
+        self._dirty = set()
+        self._stats, self._workers, self._profile = {}, [], _new_profile()
+        self._last_save = time.monotonic()
+
+    def start(self) -> dict:
+        '''
+        Crawls the dataset (incrementally, if it was crawled before), forms the edge table and starts listening for
+        filesystem events. Returns the crawled database.
+        '''
+        database_dict = crawl(self.top, n_jobs=self.n_jobs, fast_header=self.fast_header, sniff_preamble=self.sniff_preamble,
+                              export_json=self.export_json, archives=self.archives, header_cache=self.header_cache)
+        self.entries = load_manifest(self.manifest_path)
+        self._patient_files = {}
+        for rel_path, entry in self.entries.items():
+            if entry['record'] is not None:
+                self._patient_files.setdefault(entry['record']['patient'], set()).add(rel_path)
+        if self.edge_path is not None and len(database_dict) > 0:
+            from ..modules.datagraph import DataGraph
+            # formed again if the dataset changed since the edge table was saved
+            self.graph = DataGraph(self.crawl_path, self.edge_path)
+
+        if self.use_events:
+            try:
+                from watchdog.observers import Observer  # type: ignore
+                from watchdog.events import FileSystemEventHandler  # type: ignore
+            except ImportError:
+                warnings.warn("watchdog is not installed, scanning the dataset for changes instead.")
+            else:
+                watcher = self
+
+                class Handler(FileSystemEventHandler):
+                    def on_any_event(self, event):
+                        for path in [event.src_path, getattr(event, "dest_path", "")]:
+                            if path:
+                                watcher.notify(os.fsdecode(path))
+
+                self._observer = Observer()
+                self._observer.schedule(Handler(), self.top, recursive=True)
+                self._observer.start()
+        return database_dict
+
+    def stop(self) -> None:
+        '''
+        Stops listening for filesystem events and writes the outputs that are not up to date yet.
+        '''
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+        if self.entries is not None:
+            self.flush()
+
+    def notify(self, path: str) -> None:
+        '''
+        Records a path that changed, as the filesystem event handler does.
+        '''
+        with self._lock:
+            now = time.monotonic()
+            if not self._pending:
+                self._first_event = now
+            self._last_event = now
+            self._pending.add(path)
+
+    def _changed_directories(self):
+        '''
+        Directories to scan for changes: the ones with filesystem events, or the whole dataset without events
+        '''
+        if self._observer is None:
+            return [self.top]
+        with self._lock:
+            paths, self._pending = self._pending, set()
+        directories = set()
+        for path in paths:
+            path = path.rstrip('/')
+            directories.add(path if os.path.isdir(path) else os.path.dirname(path))
+        # scanning a directory also scans its subdirectories
+        return [directory for directory in sorted(directories)
+                if not any(directory.startswith(f"{other}/") for other in directories)]
+
+    def scan(self, directories=None):
+        '''
+        Compares the files in the given directories (default: the whole dataset) with the current crawl.
+
+        Returns
+        -------
+        The paths of the new or changed files and the relative paths of the removed files.
+        '''
+        if directories is None:
+            directories = [self.top]
+        changed, found, prefixes = [], set(), []
+        for directory in directories:
+            if os.path.abspath(directory) == os.path.abspath(self.top):
+                folders = sorted(glob.glob(pathlib.Path(self.top, "*").as_posix()))
+                prefixes.append(f"{pathlib.Path(self.top).relative_to(self.root).as_posix()}/")
+            else:
+                folders = [directory]
+                prefixes.append(f"{pathlib.Path(directory).relative_to(self.root).as_posix()}/")
+            for folder in folders:
+                for dcm in walk_dicoms(folder, self.sniff_preamble, self.archives):
+                    rel_path = pathlib.Path(dcm).relative_to(self.root).as_posix()
+                    found.add(rel_path)
+                    entry = self.entries.get(rel_path)
+                    try:
+                        size, mtime_ns = member_signature(dcm)
+                    except (OSError, KeyError):  # removed while scanning
+                        continue
+                    if entry is None or entry['size'] != size or entry['mtime_ns'] != mtime_ns:
+                        changed.append(dcm)
+        removed = [rel_path for rel_path in self.entries
+                   if rel_path not in found and any(rel_path.startswith(prefix) for prefix in prefixes)]
+        return changed, removed
+
+    def update(self, changed, removed):
+        '''
+        Crawls the changed files, drops the removed ones, writes the crawl tree records of the affected patients and
+        forms their edges again in memory. Returns the crawled database (a CrawlTree) and the set of updated patient IDs.
+        '''
+        patients = set()
+        for rel_path in removed + [pathlib.Path(dcm).relative_to(self.root).as_posix() for dcm in changed]:
+            entry = self.entries.pop(rel_path, None)
+            if entry is not None and entry['record'] is not None:
+                patients.add(entry['record']['patient'])
+                self._patient_files.get(entry['record']['patient'], set()).discard(rel_path)
+
+        _, entries, stats, worker, profile = _crawl_files(changed, self.root, fast_header=self.fast_header,
+                                                          header_cache=_header_cache_args(self.header_cache))
+        for rel_path, entry in entries.items():
+            if entry['record'] is not None:
+                patients.add(entry['record']['patient'])
+                self._patient_files.setdefault(entry['record']['patient'], set()).add(rel_path)
+        self.entries.update(entries)
+        merge_stats(self._stats, stats)
+        self._workers.append(worker)
+        merge_profile(self._profile, profile)
+        self._dirty |= patients
+
+        # the crawled database of each updated patient, None for the patients without any file left
+        patient_dicts = {}
+        for patient in sorted(patients):
+            files = sorted(self._patient_files.get(patient, ()), key=walk_order)
+            patient_dicts[patient] = _database({rel_path: self.entries[rel_path] for rel_path in files}).get(patient)
+            if patient_dicts[patient] is None:
+                self._patient_files.pop(patient, None)
+        update_tree(self.tree_path, patient_dicts)
+
+        if self.edge_path is not None and len(patients) > 0:
+            if self.graph is None:
+                self.flush()  # the edge table is formed from the crawl CSV
+            else:
+                patient_database = {patient: patient_dict for patient, patient_dict in patient_dicts.items() if patient_dict is not None}
+                self.graph.update_patients(patients, df_patients=to_df(patient_database), save=False)
+        database = CrawlTree(self.tree_path)
+        if self.callback is not None:
+            self.callback(database, patients)
+        return database, patients
+
+    def flush(self) -> None:
+        '''
+        Writes the crawl outputs that hold the whole dataset and the edge table, if patients changed since they were
+        last written. They are then the same as those of a new crawl of the dataset.
+        '''
+        if len(self._dirty) == 0:
+            return
+        self.entries = dict(sorted(self.entries.items(), key=lambda item: walk_order(item[0])))
+        database_dict, _ = _save_crawl(self.top, self.entries, self._stats, self._workers, self._profile,
+                                       sum(worker['seconds'] for worker in self._workers), export_json=self.export_json)
+        if self.edge_path is not None:
+            if self.graph is not None:
+                self.graph.update_patients(self._dirty)
+            elif len(database_dict) > 0:
+                from ..modules.datagraph import DataGraph
+                self.graph = DataGraph(self.crawl_path, self.edge_path)
+        self._reset_batch()
+
+    def _settled(self, changed) -> bool:
+        '''
+        Whether the changes can be read: no filesystem event (or, when scanning, modification of a changed file)
+        for debounce seconds, or changes waiting for save_interval seconds already
+        '''
+        now = time.monotonic()
+        if self._observer is not None:
+            with self._lock:
+                if not self._pending:
+                    return True
+                return now - self._last_event >= self.debounce or now - self._first_event >= self.save_interval
+        if not changed:
+            return True
+        modified = []
+        for dcm in changed:
+            try:
+                modified.append(member_signature(dcm)[1] / 1e9)
+            except (OSError, KeyError):  # removed since the scan, read again with the next one
+                return False
+        if time.time() - max(modified) >= self.debounce:
+            return True
+        if self._deferred_since is None:
+            self._deferred_since = now
+        return now - self._deferred_since >= self.save_interval
+
+    def poll(self):
+        '''
+        Looks for changes once and updates the crawl if there were any that settled (see debounce). Writes the outputs
+        that hold the whole dataset if they were last written save_interval seconds ago. Returns the set of updated
+        patient IDs.
+        '''
+        patients = set()
+        if self._observer is None or self._settled(None):
+            directories = self._changed_directories()
+            if len(directories) > 0:
+                changed, removed = self.scan(directories)
+                # files still being written are read with a later scan, together with the other changes
+                if (len(changed) > 0 or len(removed) > 0) and (self._observer is not None or self._settled(changed)):
+                    self._deferred_since = None
+                    _, patients = self.update(changed, removed)
+        if time.monotonic() - self._last_save >= self.save_interval:
+            self.flush()
+        return patients
+
+    def run(self, stop: Optional[threading.Event] = None) -> None:
+        '''
+        Keeps the crawl up to date until stop is set (or forever).
+        '''
+        if self.entries is None:
+            self.start()
+        try:
+            while stop is None or not stop.is_set():
+                self.poll()
+                time.sleep(self.poll_interval)
+        finally:
+            self.stop()
+
+
+def watch(top: str, edge_path: Optional[str] = None, stop: Optional[threading.Event] = None, **kwargs) -> None:
+    '''
+    Crawls the dataset and keeps the crawl and edge table up to date as files arrive, see CrawlWatcher.
+    '''
+    CrawlWatcher(top, edge_path=edge_path, **kwargs).run(stop)
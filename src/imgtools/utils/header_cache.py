@@ -0,0 +1,200 @@
+import io
+import os
+import pathlib
+import sqlite3
+import time
+import zlib
+from typing import Optional
+
+from pydicom import dcmread
+
+from .archive import is_archive_path, read_dataset
+
+
+DEFAULT_CACHE_PATH = pathlib.Path("~", ".cache", "imgtools", "dicom_headers.db").expanduser().as_posix()
+DEFAULT_MAX_BYTES = 1 << 30
+
+# the cache is checked against its size bound every this many insertions
+_EVICT_EVERY = 256
+
+
+class HeaderCache:
+    '''
+    Persistent SQLite cache of DICOM headers (everything before the pixel data), shared by all datasets and runs.
+
+    Entries are keyed on the (device, inode, size, modification time) of the file, so the same physical file
+    reached through different paths (symlink farms, hard links, other dataset views) is only parsed once, and
+    files that change are parsed again. The headers are stored re-encoded as DICOM, so a cached header reads
+    back exactly like the file. Once the cache grows over max_bytes, the least recently used entries are evicted.
+    '''
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        '''
+        Parameters
+        ----------
+        path
+            Path to the SQLite file of the cache, created if it does not exist
+
+        max_bytes
+            Size bound of the (compressed) cached headers
+        '''
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._puts = 0
+        self._conn = None
+
+    @property
+    def conn(self):
+        # connections can not be pickled/shared between processes, open one lazily in each of them
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS headers (device, inode, size, mtime_ns, tags, header BLOB, nbytes, last_used, "
+                               "PRIMARY KEY (device, inode, size, mtime_ns, tags))")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS headers_last_used ON headers (last_used)")
+        return self._conn
+
+    def __getstate__(self):
+        return {**self.__dict__, '_conn': None}
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    @staticmethod
+    def _key(path, specific_tags):
+        stat = os.stat(path)
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, ",".join(sorted(str(tag) for tag in specific_tags or []))
+
+    def get(self, path: str, specific_tags: Optional[list] = None):
+        '''
+        Returns the cached header of path, read with the given specific_tags (a cached full header also
+        serves any specific_tags), or None if it is not cached.
+        '''
+        device, inode, size, mtime_ns, tags = self._key(path, specific_tags)
+        try:
+            row = self.conn.execute("SELECT header, tags FROM headers WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ? "
+                                    "AND tags IN (?, '') ORDER BY tags DESC LIMIT 1", (device, inode, size, mtime_ns, tags)).fetchone()
+            if row is not None:
+                self.conn.execute("UPDATE headers SET last_used = ? WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ? AND tags = ?",
+                                  (time.time(), device, inode, size, mtime_ns, row[1]))
+        except sqlite3.OperationalError:  # e.g. locked by another process for too long, the cache is best effort
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return dcmread(io.BytesIO(zlib.decompress(row[0])), force=True)
+
+    def put(self, path: str, header, specific_tags: Optional[list] = None) -> None:
+        '''
+        Caches the header of path, as read with the given specific_tags
+        '''
+        try:
+            buffer = io.BytesIO()
+            header.save_as(buffer, write_like_original=True)
+        except Exception:  # headers that can not be encoded again are not cached
+            return
+        blob = zlib.compress(buffer.getvalue())
+        try:
+            self.conn.execute("INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                              (*self._key(path, specific_tags), blob, len(blob), time.time()))
+        except sqlite3.OperationalError:
+            return
+        self._puts += 1
+        if self._puts % _EVICT_EVERY == 0:
+            self.evict()
+
+    def read(self, path: str, specific_tags: Optional[list] = None):
+        '''
+        Returns the header (without pixel data) of path from the cache, reading and caching it on a miss
+        '''
+        header = self.get(path, specific_tags)
+        if header is None:
+            header = dcmread(path, force=True, stop_before_pixels=True, specific_tags=specific_tags)
+            self.put(path, header, specific_tags)
+        return header
+
+    def evict(self) -> int:
+        '''
+        Evicts the least recently used entries until the cache is 10% below max_bytes. Returns the number of evicted entries.
+        '''
+        try:
+            total = self.conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM headers").fetchone()[0]
+            if total <= self.max_bytes:
+                return 0
+            evicted = 0
+            target = 0.9 * self.max_bytes
+            for rowid, nbytes in self.conn.execute("SELECT rowid, nbytes FROM headers ORDER BY last_used").fetchall():
+                if total <= target:
+                    break
+                self.conn.execute("DELETE FROM headers WHERE rowid = ?", (rowid,))
+                total -= nbytes
+                evicted += 1
+        except sqlite3.OperationalError:
+            return 0
+        self.evictions += evicted
+        return evicted
+
+    def clear(self) -> None:
+        self.conn.execute("DELETE FROM headers")
+
+    def stats(self) -> dict:
+        '''
+        Hits, misses and evictions of this process, and the number of entries and bytes in the cache
+        '''
+        entries, nbytes = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM headers").fetchone()
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups > 0 else 0.,
+                'evictions': self.evictions,
+                'entries': entries,
+                'bytes': nbytes}
+
+
+# opt-in cache used by read_header; enabling it also sets the environment variables so that worker processes
+# started afterwards use the same cache
+_HEADER_CACHE = None
+
+
+def enable_header_cache(path: str = DEFAULT_CACHE_PATH, max_bytes: int = DEFAULT_MAX_BYTES) -> HeaderCache:
+    global _HEADER_CACHE
+    os.environ["IMGTOOLS_HEADER_CACHE"] = path
+    os.environ["IMGTOOLS_HEADER_CACHE_MAX_BYTES"] = str(max_bytes)
+    _HEADER_CACHE = HeaderCache(path, max_bytes)
+    return _HEADER_CACHE
+
+
+def disable_header_cache() -> None:
+    global _HEADER_CACHE
+    os.environ.pop("IMGTOOLS_HEADER_CACHE", None)
+    os.environ.pop("IMGTOOLS_HEADER_CACHE_MAX_BYTES", None)
+    if _HEADER_CACHE is not None:
+        _HEADER_CACHE.close()
+    _HEADER_CACHE = None
+
+
+def get_header_cache() -> Optional[HeaderCache]:
+    '''
+    Returns the enabled header cache, or None if it is not enabled
+    '''
+    global _HEADER_CACHE
+    path = os.environ.get("IMGTOOLS_HEADER_CACHE")
+    if _HEADER_CACHE is None and path:
+        _HEADER_CACHE = HeaderCache(path, int(os.environ.get("IMGTOOLS_HEADER_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)))
+    return _HEADER_CACHE
+
+
+def read_header(path: str, specific_tags: Optional[list] = None):
+    '''
+    Reads the header (without pixel data) of a DICOM file or archive member, through the header cache if it is enabled
+    '''
+    cache = get_header_cache()
+    if cache is not None and not is_archive_path(path):
+        return cache.read(path, specific_tags)
+    return read_dataset(path, force=True, stop_before_pixels=True, specific_tags=specific_tags)
@@ -0,0 +1,227 @@
+"""Benchmark of the DataGraph edge table, crawl loading, component extraction, study selection and graph view against the previous pd.merge/str/.iloc/regex implementations.
+
+Usage: python tests/benchmarks/bench_datagraph.py [--studies 1000 10000 100000] [--query CT,RTSTRUCT,RTDOSE]
+"""
+from argparse import ArgumentParser
+import pathlib
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+from imgtools.modules import DataGraph, GraphEngine, GRAPH_COLUMNS, GRAPH_VIEW_LEVELS, graph_view, regex_to_masks, write_graph_view
+from imgtools.utils.crawl import CRAWL_COLUMNS
+
+
+def form_edges_merge(df):
+    """Previous implementation: one pd.merge per edge type over the full crawl, then drop the duplicated columns."""
+    plan = df[df["modality"] == "RTPLAN"]
+    dose = df[df["modality"] == "RTDOSE"]
+    struct = df[df["modality"] == "RTSTRUCT"]
+    ct = df[df["modality"] == "CT"]
+    mr = df[df["modality"] == "MR"]
+    pet = df[df["modality"] == "PT"]
+
+    df_list = []
+    for edge in range(7):
+        if edge == 0:
+            df_combined = pd.concat([pd.merge(struct, dose, left_on="instance_uid", right_on="reference_rs"),
+                                     pd.merge(struct, dose, left_on="series", right_on="reference_rs")])
+            df_combined = df_combined.drop_duplicates(subset=["instance_uid_x"])
+        elif edge == 1:
+            df_combined = pd.merge(ct, dose, left_on="series", right_on="reference_ct")
+        elif edge == 2:
+            df_combined = pd.concat([pd.merge(ct, struct, left_on="series", right_on="reference_ct"),
+                                     pd.merge(mr, struct, left_on="series", right_on="reference_ct")])
+        elif edge == 3:
+            df_combined = pd.merge(pet, struct, left_on="series", right_on="reference_ct")
+        elif edge == 4:
+            df_combined = pd.merge(ct, pet, left_on="study", right_on="study")
+        elif edge == 5:
+            df_combined = pd.merge(plan, dose, left_on="instance_uid", right_on="reference_pl")
+        else:
+            df_combined = pd.merge(struct, plan, left_on="instance_uid", right_on="reference_rs")
+        df_combined["edge_type"] = edge
+        df_list.append(df_combined)
+
+    df_edges = pd.concat(df_list, axis=0, ignore_index=True)
+    df_edges.loc[df_edges.study_x.isna(), "study_x"] = df_edges.loc[df_edges.study_x.isna(), "study"]
+    df_edges.drop(columns=["study_y", "patient_ID_y", "series_description_y", "study_description_y", "study"], inplace=True)
+    return df_edges
+
+
+def form_edges_engine(df):
+    engine = GraphEngine(df)
+    return engine.materialize(engine.edges(), drop=["study_y", "patient_ID_y", "series_description_y", "study_description_y"])
+
+
+def get_df_loop(self, df_edges_processed, rel_studyids, remove_less_comp=True):
+    """Previous DataGraph._get_df: a .loc per study and an .iloc per edge."""
+    self.final_dict = []
+    final_df = []
+    mods_wanted = set(self.mods)
+    for study in rel_studyids:
+        df_temp = df_edges_processed.loc[df_edges_processed.study_x == study]
+        CT_locs = df_temp.loc[df_temp.modality_x.isin(['CT', 'MR'])]
+        CT_series = CT_locs.series_x.unique()
+        A, save_folder_comp = [], []
+        for ct in CT_series:
+            df_connections = CT_locs.loc[CT_locs.series_x == ct]
+            row = df_connections.iloc[0]
+            modality = row.modality_x
+            temp = {"study": study, ct: {"modality": modality, "folder": row.folder_x}}
+            folder_save = {"study": study, 'patient_ID': row.patient_ID_x,
+                           f'series_{modality}': row.series_x, f'folder_{modality}': row.folder_x}
+            for k in range(len(df_connections)):
+                row_y = df_connections.iloc[k]
+                temp[row.series_y] = {"modality": row_y.modality_y, "folder": row_y.folder_y, "conn_to": modality}
+                key, key_series = self._check_save(folder_save, row_y.modality_y, modality)
+                folder_save[key_series] = row_y.series_y
+                folder_save[key] = row_y.folder_y
+            A.append(temp)
+            save_folder_comp.append(folder_save)
+
+        rest_locs = df_temp.loc[~df_temp.modality_x.isin(['CT', 'MR']), ["series_x", "modality_x", "folder_x", "series_y", "modality_y", "folder_y"]]
+        for j in range(len(rest_locs)):
+            edge = rest_locs.iloc[j]
+            for k in range(len(CT_series)):
+                A[k][edge['series_y']] = {"modality": edge['modality_y'], "folder": edge['folder_y'], "conn_to": edge['modality_x']}
+                modality_origin = "CT" if edge['modality_y'] == "RTDOSE" else edge['modality_x']
+                key, key_series = self._check_save(save_folder_comp[k], edge['modality_y'], modality_origin)
+                save_folder_comp[k][key_series] = edge['series_y']
+                save_folder_comp[k][key] = edge['folder_y']
+
+        if remove_less_comp:
+            keep = [j for j in range(len(CT_series))
+                    if mods_wanted.issubset({key.split("_")[1] for key in save_folder_comp[j] if key.split("_")[0] == "folder"})]
+            save_folder_comp = [save_folder_comp[j] for j in keep]
+            A = [A[j] for j in keep]
+        self.final_dict.extend(A)
+        final_df.extend(save_folder_comp)
+    return pd.DataFrame(final_df)
+
+
+def synthetic_crawl(n_studies):
+    """Crawl with a CT, a PT, an RTSTRUCT on the CT, an RTPLAN and an RTDOSE on the RTSTRUCT and plan per study."""
+    rows = []
+    for i in range(n_studies):
+        patient, study = f"patient_{i // 2}", f"1.2.3.{i}"
+        series = {modality: f"1.2.4.{i}.{j}" for j, modality in enumerate(["CT", "PT", "RTSTRUCT", "RTPLAN", "RTDOSE"])}
+        references = {"RTSTRUCT": {'reference_ct': series["CT"]},
+                      "RTPLAN": {'reference_rs': f"{series['RTSTRUCT']}.1"},
+                      "RTDOSE": {'reference_rs': f"{series['RTSTRUCT']}.1", 'reference_pl': f"{series['RTPLAN']}.1"}}
+        for modality, uid in series.items():
+            row = dict.fromkeys(CRAWL_COLUMNS, "nan")
+            row.update({'patient_ID': patient, 'study': study, 'study_description': "CA ORL FDG TEP",
+                        'series': uid, 'series_description': f"{modality} series", 'subseries': "default",
+                        'modality': modality, 'instances': "1", 'instance_uid': f"{uid}.1",
+                        'folder': f"data/{patient}/{uid}", 'file_path': f"data/{patient}/{uid}/0.dcm"})
+            row.update(references.get(modality, {}))
+            rows.append(row)
+    return pd.DataFrame(rows, columns=CRAWL_COLUMNS)
+
+
+def measure(function, df):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(df)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("DataGraph edge table benchmark")
+    parser.add_argument("--studies", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--query", type=str, default="CT,RTSTRUCT,RTDOSE")
+    parser.add_argument("--max_loop", type=int, default=10000,
+                        help="Skip the .iloc component extraction above this number of studies.")
+    args = parser.parse_args()
+
+    print(f"{'rows':>8} {'edges':>8} {'merge (s)':>10} {'engine (s)':>11} {'merge peak (MB)':>16} {'engine peak (MB)':>17}")
+    for n_studies in args.studies:
+        df = synthetic_crawl(n_studies)
+        merged, merge_seconds, merge_peak = measure(form_edges_merge, df)
+        edges, engine_seconds, engine_peak = measure(form_edges_engine, df)
+        pd.testing.assert_frame_equal(edges, merged)
+        print(f"{len(df):>8} {len(edges):>8} {merge_seconds:>10.3f} {engine_seconds:>11.3f} "
+              f"{merge_peak / 1e6:>16.1f} {engine_peak / 1e6:>17.1f}")
+
+    print(f"\n{'studies':>8} {'components':>11} {'loop (s)':>9} {'vectorized (s)':>15} {'speedup':>8}")
+    for n_studies in args.studies:
+        with tempfile.TemporaryDirectory() as tmp:
+            synthetic_crawl(n_studies).to_csv(pathlib.Path(tmp, "crawl.csv"))
+            graph = DataGraph(pathlib.Path(tmp, "crawl.csv").as_posix(), pathlib.Path(tmp, "edges.csv").as_posix())
+
+            start = time.perf_counter()
+            components = graph.parser(args.query)
+            vectorized = time.perf_counter() - start
+
+            if n_studies <= args.max_loop:
+                DataGraph._get_df, get_df = get_df_loop, DataGraph._get_df
+                graph.df_new = None
+                DataGraph.clear_memo()
+                start = time.perf_counter()
+                components_loop = graph.parser(args.query)
+                loop = time.perf_counter() - start
+                DataGraph._get_df = get_df
+                pd.testing.assert_frame_equal(components, components_loop)
+                print(f"{n_studies:>8} {len(components):>11} {loop:>9.3f} {vectorized:>15.3f} {loop / vectorized:>7.0f}x")
+            else:
+                print(f"{n_studies:>8} {len(components):>11} {'-':>9} {vectorized:>15.3f} {'-':>8}")
+
+    print(f"\n{'rows':>8} {'crawl before (B/row)':>21} {'crawl after (B/row)':>20} {'read before (s)':>16} {'read after (s)':>15}")
+    for n_studies in args.studies:
+        with tempfile.TemporaryDirectory() as tmp:
+            path_crawl = pathlib.Path(tmp, "crawl.csv").as_posix()
+            synthetic_crawl(n_studies).to_csv(path_crawl)
+
+            # previously: all the columns, each cast to Python strings
+            start = time.perf_counter()
+            before = pd.read_csv(path_crawl, index_col=0)
+            for col in before:
+                before[col] = before[col].astype(str)
+            before_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            after = DataGraph._read_crawl(path_crawl, GRAPH_COLUMNS)
+            after_seconds = time.perf_counter() - start
+            print(f"{len(before):>8} {before.memory_usage(deep=True).sum() / len(before):>21.0f} "
+                  f"{after.memory_usage(deep=True).sum() / len(after):>20.0f} {before_seconds:>16.3f} {after_seconds:>15.3f}")
+
+    print(f"\n{'studies':>8} {'regex (ms)':>11} {'index (ms)':>11} {'count (ms)':>11}")
+    for n_studies in args.studies:
+        with tempfile.TemporaryDirectory() as tmp:
+            synthetic_crawl(n_studies).to_csv(pathlib.Path(tmp, "crawl.csv"))
+            graph = DataGraph(pathlib.Path(tmp, "crawl.csv").as_posix(), pathlib.Path(tmp, "edges.csv").as_posix())
+            regex = '((?=.*1)|(?=.*0)|(?=.*5)(?=.*6))(?=.*2)'
+
+            start = time.perf_counter()
+            graph._form_agg()
+            expected = graph.df_new.loc[graph.df_new.edge_type.str.contains(regex), "study_x"].unique()
+            regex_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            selected = graph.study_index.select(regex_to_masks(regex))
+            index_seconds = time.perf_counter() - start
+            assert list(selected) == list(expected)
+
+            start = time.perf_counter()
+            graph.count(args.query)
+            count_seconds = time.perf_counter() - start
+            print(f"{n_studies:>8} {regex_seconds * 1e3:>11.2f} {index_seconds * 1e3:>11.2f} {count_seconds * 1e3:>11.2f}")
+
+    print(f"\n{'edges':>8} {'level':>8} {'nodes':>14} {'view (s)':>9} {'write (s)':>10}")
+    for n_studies in args.studies:
+        edges = form_edges_engine(synthetic_crawl(n_studies))
+        for level in GRAPH_VIEW_LEVELS:
+            start = time.perf_counter()
+            view = graph_view(edges, level=level)
+            view_seconds = time.perf_counter() - start
+            with tempfile.TemporaryDirectory() as tmp:
+                start = time.perf_counter()
+                write_graph_view(view, pathlib.Path(tmp, "view.html").as_posix())
+                write_seconds = time.perf_counter() - start
+            print(f"{len(edges):>8} {level:>8} {view['nodes_shown']:>6}/{view['nodes_total']:<7} {view_seconds:>9.3f} {write_seconds:>10.3f}")
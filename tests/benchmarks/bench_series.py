@@ -0,0 +1,122 @@
+"""Benchmark of the threaded DICOM series reader against one GDCM ImageSeriesReader, on uncompressed and JPEG 2000 series,
+and of the load time and memory of read_dicom_series with and without the tags of every slice.
+
+Usage: python tests/benchmarks/bench_series.py [--slices 300] [--size 512] [--threads 1 2 4 8]
+"""
+from argparse import ArgumentParser
+import multiprocessing
+import pathlib
+import resource
+import tempfile
+import time
+
+import numpy as np
+import SimpleITK as sitk
+from pydicom import dcmread
+from pydicom.uid import generate_uid
+
+from imgtools.io import SeriesMetadata, read_dicom_series, read_dicom_series_threaded, read_dicom_series_with_metadata
+
+
+def write_series(folder, n_slices, size, compressor=None, private_tags=0):
+    """Writes a synthetic CT series with one file per slice through GDCM, optionally compressed and with private tags;
+    returns the files in slice order."""
+    pathlib.Path(folder).mkdir(parents=True)
+    rng = np.random.default_rng(0)
+    series = generate_uid()
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    if compressor:
+        writer.SetUseCompression(True)
+        writer.SetCompressor(compressor)
+
+    file_names = []
+    for i in range(n_slices):
+        # smooth anatomy-like values, so the JPEG 2000 slices compress like real ones
+        pixels = (np.add.outer(np.sin(np.linspace(0, 3, size)), np.cos(np.linspace(0, 3, size))) * 500 + i
+                  + rng.integers(0, 20, (size, size))).astype(np.int16)
+        image = sitk.GetImageFromArray(pixels[np.newaxis])
+        image.SetSpacing([0.9, 0.9, 2.5])
+        image.SetOrigin([0., 0., 2.5 * i])
+        for tag, value in [("0008|0060", "CT"), ("0020|000e", series), ("0008|0018", generate_uid()),
+                           ("0020|0013", str(i + 1)), ("0020|0032", f"0\\0\\{2.5 * i}"),
+                           ("0020|0037", "1\\0\\0\\0\\1\\0"), ("0028|1052", "-1024"), ("0028|1053", "1")]:
+            image.SetMetaData(tag, value)
+        file_names.append(pathlib.Path(folder, f"{i}.dcm").as_posix())
+        writer.SetFileName(file_names[-1])
+        writer.Execute(image)
+        if private_tags:
+            # vendor private tags, as scanners write them (GDCM does not write private tags without a dictionary)
+            ds = dcmread(file_names[-1])
+            block = ds.private_block(0x0009, "BENCHMARK", create=True)
+            for element in range(private_tags):
+                block.add_new(element, "LO", f"private value {i} {element}")
+            ds.save_as(file_names[-1])
+    return file_names
+
+
+def best_of(function, repeats=3):
+    """Minimum wall time of repeats calls, and the last result."""
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+    return min(seconds), result
+
+
+def rss():
+    """Resident set size of the process in MB."""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 1e6
+
+
+def load(mode, file_names, queue):
+    """Loads the series in a fresh process, and reports the load time and the RSS it holds on to."""
+    read_dicom_series(None, file_names=file_names[:2])  # libraries are loaded before the baseline
+    SeriesMetadata(file_names=file_names[1:]).tags
+    baseline = rss()
+    start = time.perf_counter()
+    if mode == "slice tags":
+        image, tags = read_dicom_series_with_metadata(None, file_names=file_names)
+    else:
+        image = read_dicom_series(None, file_names=file_names)
+        if mode == "lazy tags":
+            tags = SeriesMetadata(file_names=file_names)["SeriesInstanceUID"]
+    queue.put((time.perf_counter() - start, rss() - baseline))
+
+
+def measure_load(mode, file_names):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=load, args=(mode, file_names, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("Threaded DICOM series reader benchmark")
+    parser.add_argument("--slices", type=int, default=300)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    print(f"{'series':>10} {'reader':>14} {'time (s)':>9} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, compressor in [("raw", None), ("jpeg2000", "JPEG2000")]:
+            file_names = write_series(pathlib.Path(tmp, name), args.slices, args.size, compressor)
+            gdcm_seconds, gdcm_image = best_of(lambda: read_dicom_series(None, file_names=file_names))
+            print(f"{name:>10} {'gdcm':>14} {gdcm_seconds:>9.3f} {1.:>8.2f}")
+            for n_threads in args.threads:
+                seconds, image = best_of(lambda: read_dicom_series_threaded(file_names, n_threads=n_threads))
+                assert np.array_equal(sitk.GetArrayViewFromImage(image), sitk.GetArrayViewFromImage(gdcm_image))
+                assert np.allclose(image.GetSpacing(), gdcm_image.GetSpacing()) and np.allclose(image.GetOrigin(), gdcm_image.GetOrigin())
+                print(f"{name:>10} {f'{n_threads} threads':>14} {seconds:>9.3f} {gdcm_seconds / seconds:>8.2f}")
+
+        print(f"\n{'reader':>14} {'time (s)':>9} {'RSS growth (MB)':>16}")
+        file_names = write_series(pathlib.Path(tmp, "tags"), args.slices, args.size, private_tags=64)
+        for mode in ["slice tags", "no tags", "lazy tags"]:
+            seconds, growth = min(measure_load(mode, file_names) for _ in range(3))
+            print(f"{mode:>14} {seconds:>9.3f} {growth:>16.1f}")
@@ -0,0 +1,100 @@
+"""Benchmark of the crawl DataFrame builder against the previous per-row pd.concat implementation.
+
+Usage: python tests/benchmarks/bench_to_df.py [--series 300 3000 30000]
+"""
+from argparse import ArgumentParser
+import time
+
+import pandas as pd
+
+from imgtools.utils.crawl import to_df
+
+
+def to_df_concat(database_dict):
+    """Previous implementation: one single-row DataFrame + pd.concat per subseries."""
+    df = pd.DataFrame()
+    for pat in database_dict:
+        for study in database_dict[pat]:
+            for series in database_dict[pat][study]:
+                if series != 'description':
+                    for subseries in database_dict[pat][study][series]:
+                        if subseries != 'description':
+                            entry = database_dict[pat][study][series][subseries]
+                            columns = ['patient_ID', 'study', 'study_description', 
+                                       'series', 'series_description', 'subseries', 'modality', 
+                                       'instances', 'instance_uid', 
+                                       'reference_ct', 'reference_rs', 'reference_pl', 'reference_frame', 'folder',
+                                       'orientation', 'orientation_type', 'MR_repetition_time', 'MR_echo_time', 
+                                       'MR_scan_sequence', 'MR_magnetic_field_strength', 'MR_imaged_nucleus', 'file_path']
+                            values = [pat, study, database_dict[pat][study]['description'], 
+                                      series, database_dict[pat][study][series]['description'], 
+                                      subseries, entry['modality'], 
+                                      len(entry['instances']), entry['instance_uid'], 
+                                      entry['reference_ct'], entry['reference_rs'], 
+                                      entry['reference_pl'], entry['reference_frame'], entry['folder'],
+                                      entry['orientation'], entry['orientation_type'],
+                                      entry['repetition_time'], entry['echo_time'],
+                                      entry['scan_sequence'], entry['mag_field_strength'], entry['imaged_nucleus'],
+                                      entry['fname']]
+                            df_add = pd.DataFrame([values], columns=columns)
+                            df = pd.concat([df, df_add], ignore_index=True)
+    return df
+
+
+def synthetic_database(n_series, series_per_study=4):
+    """Database with CT/RTSTRUCT/RTDOSE/MR series, 4 series per study and 2 studies per patient."""
+    modalities = ['CT', 'RTSTRUCT', 'RTDOSE', 'MR']
+    database = {}
+    for i in range(n_series):
+        patient, study = f"patient_{i // (2 * series_per_study)}", f"1.2.3.{i // series_per_study}"
+        modality = modalities[i % len(modalities)]
+        mr = modality == 'MR'
+        series = database.setdefault(patient, {}).setdefault(study, {'description': 'CA ORL FDG TEP'})
+        series[f"1.2.4.{i}"] = {'description': f"{modality} series",
+                                '1': {'instances': {f"1.2.5.{i}.{j}": f"data/{patient}/{i}/{j}.dcm" for j in range(3)},
+                                      'instance_uid': f"1.2.5.{i}.0",
+                                      'modality': modality,
+                                      'reference_ct': f"1.2.4.{i - 1}" if modality == 'RTSTRUCT' else "",
+                                      'reference_rs': f"1.2.5.{i - 1}.0" if modality == 'RTDOSE' else "",
+                                      'reference_pl': "",
+                                      'reference_frame': f"1.2.6.{i // series_per_study}",
+                                      'folder': f"data/{patient}/{i}",
+                                      'orientation': "[1, 0, 0, 0, 1, 0]",
+                                      'orientation_type': "",
+                                      'repetition_time': 2000.0 if mr else "",
+                                      'echo_time': 12.5 if mr else "",
+                                      'scan_sequence': "SE" if mr else "",
+                                      'mag_field_strength': 1.5 if mr else "",
+                                      'imaged_nucleus': "1H" if mr else "",
+                                      'fname': f"data/{patient}/{i}/0.dcm"}}
+    return database
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("to_df benchmark")
+    parser.add_argument("--series", type=int, nargs="+", default=[300, 3000, 30000])
+    parser.add_argument("--max_concat", type=int, default=3000,
+                        help="Skip the pd.concat implementation above this number of series.")
+    args = parser.parse_args()
+
+    print(f"{'series':>8} {'concat (s)':>12} {'columnar (s)':>13} {'categorical (s)':>16} {'speedup':>8}")
+    for n_series in args.series:
+        database = synthetic_database(n_series)
+
+        start = time.perf_counter()
+        df = to_df(database)
+        columnar = time.perf_counter() - start
+
+        start = time.perf_counter()
+        df_categorical = to_df(database, categorical=True)
+        categorical = time.perf_counter() - start
+        assert df_categorical.to_csv() == df.to_csv()
+
+        if n_series <= args.max_concat:
+            start = time.perf_counter()
+            df_concat = to_df_concat(database)
+            concat = time.perf_counter() - start
+            assert df_concat.to_csv() == df.to_csv(), "CSV output differs from the pd.concat implementation"
+            print(f"{n_series:>8} {concat:>12.3f} {columnar:>13.3f} {categorical:>16.3f} {concat / columnar:>7.0f}x")
+        else:
+            print(f"{n_series:>8} {'-':>12} {columnar:>13.3f} {categorical:>16.3f} {'-':>8}")
@@ -0,0 +1,813 @@
+import os
+import gzip
+import json
+import importlib
+import io
+import pathlib
+import pickle
+import shutil
+import tarfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+import SimpleITK as sitk
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom import dcmread
+from pydicom.uid import ExplicitVRBigEndian, ExplicitVRLittleEndian, ImplicitVRLittleEndian, generate_uid
+
+from imgtools.modules import DataGraph
+from imgtools.io import (ImageCSVLoader, SeriesMetadata, read_dicom_auto, read_dicom_rtstruct, read_dicom_scan, read_dicom_series,
+                         read_dicom_series_threaded, read_dicom_series_with_metadata)
+from imgtools.utils.crawl import (crawl, crawl_one, merge_shards, read_contour_counts, roi_feasibility, shard_of,
+                                  sorted_geometry, sorted_instances, to_df, walk_dicoms)
+from imgtools.utils import archive as archive_module
+from imgtools.utils.crawl_index import CrawlIndex
+from imgtools.utils.crawl_tree import CrawlTree, update_tree
+from imgtools.utils.crawl_watch import CrawlWatcher
+from imgtools.utils.header_cache import HeaderCache, disable_header_cache, enable_header_cache, read_header
+
+
+SOP_CLASSES = {"CT": "1.2.840.10008.5.1.4.1.1.2",
+               "PT": "1.2.840.10008.5.1.4.1.1.128",
+               "RTSTRUCT": "1.2.840.10008.5.1.4.1.1.481.3",
+               "RTDOSE": "1.2.840.10008.5.1.4.1.1.481.2"}
+
+
+def write_dicom(path, modality, patient, study, series, instance=None, **tags):
+    """Writes a minimal DICOM file and returns its SOPInstanceUID."""
+    instance = instance or generate_uid()
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = SOP_CLASSES[modality]
+    file_meta.MediaStorageSOPInstanceUID = instance
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SOPClassUID = SOP_CLASSES[modality]
+    ds.SOPInstanceUID = instance
+    ds.PatientID = patient
+    ds.StudyInstanceUID = study
+    ds.SeriesInstanceUID = series
+    ds.Modality = modality
+    ds.StudyDescription = "study"
+    ds.SeriesDescription = f"{modality} series"
+    for key, value in tags.items():
+        setattr(ds, key, value)
+
+    pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+    ds.save_as(str(path), write_like_original=False)
+    return instance
+
+
+def write_image_series(folder, modality, patient, study, n_slices=4, series=None, frame=None, size=8,
+                       orientation=(1.0, 0.0, 0.0, 0.0, 1.0, 0.0)):
+    """Writes an axial image series with one file per slice; returns the SeriesInstanceUID."""
+    series = series or generate_uid()
+    frame = frame or generate_uid()
+    for i in range(n_slices):
+        write_dicom(pathlib.Path(folder, f"{i}.dcm"), modality, patient, study, series,
+                    FrameOfReferenceUID=frame,
+                    InstanceNumber=i + 1,
+                    AcquisitionNumber=1,
+                    ImagePositionPatient=[0.0, 0.0, 2.0 * i],
+                    ImageOrientationPatient=list(orientation),
+                    PixelSpacing=[1.0, 1.0],
+                    SliceThickness=2.0,
+                    Rows=size,
+                    Columns=size,
+                    SamplesPerPixel=1,
+                    PhotometricInterpretation="MONOCHROME2",
+                    BitsAllocated=16,
+                    BitsStored=16,
+                    HighBit=15,
+                    PixelRepresentation=1,
+                    RescaleIntercept=0,
+                    RescaleSlope=1,
+                    PixelData=np.full((size, size), i, dtype=np.int16).tobytes())
+    return series
+
+
+def write_rtstruct(path, patient, study, ref_series, roi_names=("GTV", "Larynx")):
+    """Writes an RTSTRUCT referencing `ref_series`; returns its SOPInstanceUID."""
+    ref_series_item = Dataset()
+    ref_series_item.SeriesInstanceUID = ref_series
+    ref_study_item = Dataset()
+    ref_study_item.RTReferencedSeriesSequence = Sequence([ref_series_item])
+    ref_frame_item = Dataset()
+    ref_frame_item.FrameOfReferenceUID = generate_uid()
+    ref_frame_item.RTReferencedStudySequence = Sequence([ref_study_item])
+
+    rois, contours = [], []
+    for number, name in enumerate(roi_names, start=1):
+        roi = Dataset()
+        roi.ROINumber = number
+        roi.ROIName = name
+        rois.append(roi)
+        contour = Dataset()
+        contour.NumberOfContourPoints = 32
+        contour.ContourData = [value for angle in np.linspace(0, 2 * np.pi, 32, endpoint=False)
+                               for value in (10 * np.cos(angle), 10 * np.sin(angle), 0.0)]
+        roi_contour = Dataset()
+        roi_contour.ReferencedROINumber = number
+        roi_contour.ContourSequence = Sequence([contour] * number)
+        contours.append(roi_contour)
+
+    return write_dicom(path, "RTSTRUCT", patient, study, generate_uid(),
+                       ReferencedFrameOfReferenceSequence=Sequence([ref_frame_item]),
+                       StructureSetROISequence=Sequence(rois),
+                       ROIContourSequence=Sequence(contours))
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    """Two patients: CT + RTSTRUCT + RTDOSE, and CT + PT in the same study."""
+    top = pathlib.Path(tmp_path, "data", "synthetic")
+
+    study = generate_uid()
+    ct = write_image_series(pathlib.Path(top, "P1", "study", "CT"), "CT", "P1", study)
+    rs = write_rtstruct(pathlib.Path(top, "P1", "study", "RTSTRUCT", "rs.dcm"), "P1", study, ct)
+    ref_rs = Dataset()
+    ref_rs.ReferencedSOPInstanceUID = rs
+    write_dicom(pathlib.Path(top, "P1", "study", "RTDOSE", "dose.dcm"), "RTDOSE", "P1", study, generate_uid(),
+                ReferencedStructureSetSequence=Sequence([ref_rs]))
+
+    study = generate_uid()
+    write_image_series(pathlib.Path(top, "P2", "study", "CT"), "CT", "P2", study)
+    write_image_series(pathlib.Path(top, "P2", "study", "PT", "nested"), "PT", "P2", study, n_slices=2)
+
+    return top.as_posix()
+
+
+def read_outputs(top):
+    parent, dataset_name = os.path.split(top)
+    imgtools = pathlib.Path(parent, ".imgtools")
+    with open(imgtools / f"imgtools_{dataset_name}.json") as f:
+        tree = f.read()
+    with open(imgtools / f"imgtools_{dataset_name}.csv") as f:
+        table = f.read()
+    return tree, table
+
+
+def test_crawl(dataset):
+    db = crawl(dataset, n_jobs=1)
+    assert sorted(db) == ["P1", "P2"]
+
+    modalities = {}
+    for patient in db.values():
+        for study in patient.values():
+            for series_uid, series in study.items():
+                if series_uid == "description":
+                    continue
+                for subseries_uid, subseries in series.items():
+                    if subseries_uid != "description":
+                        modalities[subseries["modality"]] = len(subseries["instances"])
+    assert modalities == {"CT": 4, "RTSTRUCT": 1, "RTDOSE": 1, "PT": 2}
+
+    df = to_df(db)
+    assert sorted(df.instances) == [1, 1, 2, 4, 4]
+    df_categorical = to_df(db, categorical=True)
+    assert df_categorical.modality.dtype == "category"
+    assert df_categorical.to_csv() == df.to_csv()
+
+    # the crawl of a single folder gives the same patient subtree
+    assert crawl_one(pathlib.Path(dataset, "P1").as_posix())["P1"] == db["P1"]
+
+
+def test_incremental_crawl(dataset, monkeypatch):
+    crawl(dataset, n_jobs=1)
+
+    # new patient, modified file and deleted file
+    study = generate_uid()
+    write_image_series(pathlib.Path(dataset, "P3", "study", "CT"), "CT", "P3", study, n_slices=2)
+    os.remove(pathlib.Path(dataset, "P2", "study", "PT", "nested", "1.dcm"))
+    write_dicom(pathlib.Path(dataset, "P1", "study", "RTDOSE", "dose.dcm"), "RTDOSE", "P1", generate_uid(), generate_uid())
+
+    read = []
+    # imgtools.utils.crawl the module is shadowed by the crawl function re-exported in imgtools.utils
+    crawl_module = importlib.import_module("imgtools.utils.crawl")
+    crawl_instance = crawl_module.crawl_instance
+
+    def counting_crawl_instance(dcm, root, **kwargs):
+        read.append(pathlib.Path(dcm).name)
+        return crawl_instance(dcm, root, **kwargs)
+
+    monkeypatch.setattr(crawl_module, "crawl_instance", counting_crawl_instance)
+    crawl(dataset, n_jobs=1)
+    incremental = read_outputs(dataset)
+    assert sorted(read) == ["0.dcm", "1.dcm", "dose.dcm"]
+
+    # matches a full crawl exactly
+    monkeypatch.undo()
+    crawl(dataset, n_jobs=1, incremental=False)
+    assert incremental == read_outputs(dataset)
+
+    parent, dataset_name = os.path.split(dataset)
+    with open(pathlib.Path(parent, ".imgtools", f"imgtools_{dataset_name}_manifest.json")) as f:
+        manifest = json.load(f)["files"]
+    assert len(manifest) == 4 + 1 + 1 + 4 + 1 + 2
+    assert all(entry["record"] is not None for entry in manifest.values())
+
+
+def test_fast_header(dataset):
+    parent, dataset_name = os.path.split(dataset)
+    crawl(dataset, n_jobs=1, incremental=False, fast_header=False)
+    full = read_outputs(dataset)
+    with open(pathlib.Path(parent, ".imgtools", f"imgtools_{dataset_name}_report.json")) as f:
+        full_report = json.load(f)["header_bytes"]
+
+    crawl(dataset, n_jobs=1, incremental=False, fast_header=True)
+    assert read_outputs(dataset) == full
+    with open(pathlib.Path(parent, ".imgtools", f"imgtools_{dataset_name}_report.json")) as f:
+        fast_report = json.load(f)["header_bytes"]
+
+    assert sorted(fast_report) == ["CT", "PT", "RTDOSE", "RTSTRUCT"]
+    assert fast_report["RTSTRUCT"]["bytes_read"] < full_report["RTSTRUCT"]["bytes_read"]
+    assert fast_report["RTSTRUCT"]["file_bytes"] == full_report["RTSTRUCT"]["file_bytes"]
+
+
+def test_parallel_crawl(dataset):
+    parent, dataset_name = os.path.split(dataset)
+    crawl(dataset, n_jobs=1, incremental=False)
+    serial = read_outputs(dataset)
+
+    # one file per chunk, so that the chunks of a folder are spread over the workers
+    crawl(dataset, n_jobs=2, incremental=False, chunk_size=1)
+    assert read_outputs(dataset) == serial
+
+    with open(pathlib.Path(parent, ".imgtools", f"imgtools_{dataset_name}_report.json")) as f:
+        workers = json.load(f)["workers"]
+    assert sum(worker["files"] for worker in workers.values()) == 12
+    assert sum(worker["chunks"] for worker in workers.values()) == 12
+
+
+def test_walk_dicoms(dataset, monkeypatch):
+    # deeply nested series, a symlink loop and an extension-less DICOM
+    study = generate_uid()
+    deep = pathlib.Path(dataset, "P4", "a", "b", "c")
+    write_image_series(deep, "CT", "P4", study, n_slices=3)
+    os.symlink(pathlib.Path(dataset, "P4"), pathlib.Path(deep, "loop"))
+    os.rename(pathlib.Path(deep, "2.dcm"), pathlib.Path(deep, "IM0002"))
+    pathlib.Path(deep, "notes.txt").write_text("not a dicom")
+
+    found = list(walk_dicoms(pathlib.Path(dataset, "P4").as_posix()))
+    assert [pathlib.Path(path).name for path in found] == ["0.dcm", "1.dcm"]
+    found = list(walk_dicoms(pathlib.Path(dataset, "P4").as_posix(), sniff_preamble=True))
+    assert [pathlib.Path(path).name for path in found] == ["0.dcm", "1.dcm", "IM0002"]
+
+    # every file is parsed exactly once and counted once in its subseries
+    read = []
+    crawl_module = importlib.import_module("imgtools.utils.crawl")
+    crawl_instance = crawl_module.crawl_instance
+
+    def counting_crawl_instance(dcm, root, **kwargs):
+        read.append(dcm)
+        return crawl_instance(dcm, root, **kwargs)
+
+    monkeypatch.setattr(crawl_module, "crawl_instance", counting_crawl_instance)
+    db = crawl(dataset, n_jobs=1, incremental=False, sniff_preamble=True)
+    assert len(read) == len(set(read)) == 12 + 3
+    series = [series for uid, series in db["P4"][study].items() if uid != "description"]
+    subseries = series[0]["1"]
+    assert len(subseries["instances"]) == 3
+
+
+@pytest.mark.filterwarnings("error::FutureWarning")
+def test_sqlite_index(dataset):
+    parent, dataset_name = os.path.split(dataset)
+    imgtools = pathlib.Path(parent, ".imgtools")
+    db = crawl(dataset, n_jobs=1, sqlite_index=True)
+
+    index = CrawlIndex(pathlib.Path(imgtools, f"imgtools_{dataset_name}.db").as_posix())
+    assert index.to_df().to_csv() == to_df(db).to_csv()
+    assert index.patient_tree("P1") == db["P1"]
+    tree = pickle.loads(pickle.dumps(index)).tree()
+    assert list(tree) == ["P1", "P2"] and "P2" in tree and "P5" not in tree
+    assert tree["P2"] == db["P2"]
+    with pytest.raises(KeyError):
+        tree["P5"]
+
+    ct = index.query(patient_ID="P1", modality="CT")
+    assert len(ct) == 1
+    rtstruct = index.series_referencing(ct.series[0])
+    assert list(rtstruct.modality) == ["RTSTRUCT"]
+    assert list(index.series_referencing(rtstruct.instance_uid[0]).modality) == ["RTDOSE"]
+    instance = index.instance(rtstruct.instance_uid[0])
+    assert instance.file_path[0] == f"{dataset_name}/P1/study/RTSTRUCT/rs.dcm"
+    assert list(index.rois(patient_ID="P1").roi_name) == ["GTV", "Larynx"]
+
+    # the graph formed from the index is the same as the one formed from the csv
+    edges_csv = DataGraph(pathlib.Path(imgtools, f"imgtools_{dataset_name}.csv").as_posix(),
+                          pathlib.Path(imgtools, "edges_csv.csv").as_posix()).df_edges
+    edges_db = DataGraph(index.path, pathlib.Path(imgtools, "edges_db.csv").as_posix()).df_edges
+    assert len(edges_csv) == 3
+    pd.testing.assert_frame_equal(edges_db, edges_csv)
+
+
+def test_crawl_tree(dataset):
+    parent, dataset_name = os.path.split(dataset)
+    imgtools = pathlib.Path(parent, ".imgtools")
+    db = crawl(dataset, n_jobs=1)
+    json_text, _ = read_outputs(dataset)
+
+    tree = CrawlTree(pathlib.Path(imgtools, f"imgtools_{dataset_name}.tree").as_posix())
+    assert list(tree) == ["P1", "P2"] and len(tree) == 2 and "P5" not in tree
+    assert tree["P1"] == db["P1"]
+    assert pickle.loads(pickle.dumps(tree)).to_dict() == db
+    with pytest.raises(KeyError):
+        tree["P5"]
+
+    tree.export_json(pathlib.Path(imgtools, "export.json").as_posix())
+    with open(pathlib.Path(imgtools, "export.json")) as f:
+        assert f.read() == json_text
+
+    # without export_json only the binary tree is saved
+    os.remove(pathlib.Path(imgtools, f"imgtools_{dataset_name}.json"))
+    crawl(dataset, n_jobs=1, export_json=False)
+    assert not os.path.exists(pathlib.Path(imgtools, f"imgtools_{dataset_name}.json"))
+    assert CrawlTree(pathlib.Path(imgtools, f"imgtools_{dataset_name}.tree").as_posix()).to_dict() == db
+
+    with pytest.raises(ValueError):
+        CrawlTree(pathlib.Path(imgtools, f"imgtools_{dataset_name}.csv").as_posix()).offsets
+
+    # patients are replaced, removed and added in place; readers of the previous version keep reading it
+    tree_path = pathlib.Path(imgtools, f"imgtools_{dataset_name}.tree").as_posix()
+    previous = CrawlTree(tree_path)
+    assert previous["P2"] == db["P2"]
+    update_tree(tree_path, {"P1": db["P2"], "P2": None, "P3": db["P1"]})
+    assert CrawlTree(tree_path).to_dict() == {"P1": db["P2"], "P3": db["P1"]}
+    assert previous.to_dict() == db
+    previous.close()
+    size = os.path.getsize(tree_path)
+    for _ in range(10):
+        update_tree(tree_path, {"P1": db["P1"]})
+    assert CrawlTree(tree_path).to_dict() == {"P1": db["P1"], "P3": db["P1"]}
+    assert os.path.getsize(tree_path) < 2 * size  # written again once most of it is not used
+
+
+@pytest.mark.parametrize("fmt", ["tar", "tar.gz", "zip"])
+def test_archive_crawl(dataset, tmp_path, fmt):
+    parent, dataset_name = os.path.split(dataset)
+    db = crawl(dataset, n_jobs=1)
+
+    # the same dataset, packed into one archive
+    packed = pathlib.Path(tmp_path, "packed", dataset_name)
+    packed.mkdir(parents=True)
+    archive = pathlib.Path(packed, f"cohort.{fmt}")
+    if fmt == "zip":
+        with zipfile.ZipFile(archive, "w") as zf:
+            for path in sorted(pathlib.Path(dataset).rglob("*.dcm")):
+                zf.write(path, path.relative_to(dataset).as_posix())
+    else:
+        with tarfile.open(archive, "w:gz" if fmt == "tar.gz" else "w") as tf:
+            tf.add(dataset, arcname=".")
+
+    db_archive = crawl(packed.as_posix(), n_jobs=2, chunk_size=1, archives=True)
+    expected = json.dumps(db).replace(f'"{dataset_name}/', f'"{dataset_name}/cohort.{fmt}!/')
+    assert json.dumps(db_archive) == expected
+    assert crawl(packed.as_posix(), n_jobs=1) == {}  # archives are only crawled on request
+
+    # archives that can not be listed are reported with the files that could not be crawled
+    pathlib.Path(packed, f"broken.{fmt}").write_bytes(b"not an archive" * 64)
+    db_broken, report = crawl(packed.as_posix(), n_jobs=1, archives=True, return_report=True)
+    assert json.dumps(db_broken) == expected
+    assert report["errors"]["archive"]["count"] == 1
+    assert report["errors"]["archive"]["samples"][0]["path"] == f"{dataset_name}/broken.{fmt}"
+    os.remove(pathlib.Path(packed, f"broken.{fmt}"))
+
+    # series are decoded straight from the archive, the same as GDCM reads the extracted files
+    def subseries(database, patient, modality):
+        for study in database[patient].values():
+            for uid, series in study.items():
+                if uid != "description" and series.get("1", {}).get("modality") == modality:
+                    return series["1"]
+
+    for patient, modality in [("P1", "CT"), ("P2", "PT")]:
+        files = sorted_instances(subseries(db_archive, patient, modality), pathlib.Path(tmp_path, "packed").as_posix())
+        image = read_dicom_series(None, file_names=files)
+        gdcm_image = read_dicom_series(pathlib.Path(tmp_path, "data", subseries(db, patient, modality)["folder"]).as_posix())
+        assert np.array_equal(sitk.GetArrayFromImage(image), sitk.GetArrayFromImage(gdcm_image))
+        assert image.GetOrigin() == gdcm_image.GetOrigin()
+        assert image.GetSpacing() == gdcm_image.GetSpacing()
+        assert image.GetDirection() == gdcm_image.GetDirection()
+
+    rtstruct = read_dicom_auto(f"{packed.as_posix()}/cohort.{fmt}!/P1/study/RTSTRUCT/rs.dcm")
+    assert rtstruct.roi_names == ["GTV", "Larynx"]
+
+
+def test_compressed_tar_read_order(tmp_path, monkeypatch):
+    top = pathlib.Path(tmp_path, "data", "many")
+    write_image_series(pathlib.Path(top, "P1", "study", "CT"), "CT", "P1", generate_uid(), n_slices=120)
+    packed = pathlib.Path(tmp_path, "packed", "many")
+    packed.mkdir(parents=True)
+    with tarfile.open(pathlib.Path(packed, "cohort.tar.gz"), "w:gz") as tf:
+        # archive order is the reverse of name order
+        for path in sorted(pathlib.Path(top).rglob("*.dcm"), reverse=True):
+            tf.add(path, arcname=path.relative_to(top).as_posix())
+
+    # going back in a decompressed stream decompresses it again from the start
+    seeks, rewinds = [], []
+
+    class GzipFile(gzip.GzipFile):
+        def seek(self, offset, whence=0):
+            seeks.append(offset)
+            if whence == 0 and offset < self.tell():
+                rewinds.append(offset)
+            return super().seek(offset, whence)
+
+    monkeypatch.setitem(archive_module._DECOMPRESSORS, ".tar.gz", GzipFile)
+    db = crawl(packed.as_posix(), n_jobs=1, archives=True)
+    assert len(seeks) >= 120 and rewinds == []
+    study = next(iter(db["P1"].values()))
+    series = next(series for uid, series in study.items() if uid != "description")["1"]
+    assert len(series["instances"]) == 120
+    image = read_dicom_series(None, file_names=sorted_instances(series, pathlib.Path(tmp_path, "packed").as_posix()))
+    assert np.array_equal(sitk.GetArrayFromImage(image)[:, 0, 0], np.arange(120))
+    assert len(rewinds) <= 1  # one more pass over the stream
+
+
+@pytest.mark.parametrize("fmt", ["tar", "tar.gz", "zip"])
+def test_concurrent_member_reads(tmp_path, fmt):
+    contents = {f"P{patient}/CT/{i}.dcm": os.urandom(1000 + i) for patient in range(4) for i in range(25)}
+    path = pathlib.Path(tmp_path, f"cohort.{fmt}").as_posix()
+    if fmt == "zip":
+        with zipfile.ZipFile(path, "w") as zf:
+            for i, (name, data) in enumerate(contents.items()):
+                # names as other tools store them, members are compressed or not
+                stored_name = name.replace("/", "\\") if i % 3 == 0 else f"./{name}" if i % 3 == 1 else name
+                zf.writestr(stored_name, data, compress_type=zipfile.ZIP_DEFLATED if i % 2 else zipfile.ZIP_STORED)
+    else:
+        with tarfile.open(path, "w:gz" if fmt == "tar.gz" else "w") as tf:
+            for name, data in contents.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tf.addfile(info, io.BytesIO(data))
+
+    archive = archive_module.open_archive(path)
+    assert sorted(archive.members) == sorted(contents)
+    with open(path, "rb") as f:
+        for name, member in archive.members.items():
+            if not archive.is_compressed and not member.compressed:  # the offset is where the data starts
+                f.seek(member.offset)
+                assert f.read(member.size) == contents[name]
+
+    def read(name):
+        with archive.open(name) as f:
+            return name, f.read()
+
+    names = list(contents) * 4
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        for name, data in pool.map(read, names):
+            assert data == contents[name]
+    archive.close()
+
+
+def test_crawl_report(dataset):
+    parent, dataset_name = os.path.split(dataset)
+    broken = pathlib.Path(dataset, "P2", "study", "broken.dcm")
+    broken.write_bytes(b"not a dicom file")
+
+    db, report = crawl(dataset, n_jobs=2, chunk_size=1, return_report=True)
+    with open(pathlib.Path(parent, ".imgtools", f"imgtools_{dataset_name}_report.json")) as f:
+        assert json.load(f) == json.loads(json.dumps(report))
+
+    assert report["files"] == 13
+    assert sum(worker["files"] for worker in report["workers"].values()) == 13
+    assert {modality: times["files"] for modality, times in report["parse_times"].items()} == \
+        {"CT": 8, "PT": 2, "RTDOSE": 1, "RTSTRUCT": 1}
+    assert all(sum(times["histogram"]["counts"]) == times["files"] for times in report["parse_times"].values())
+    folders = report["slowest_folders"]
+    assert len(folders) == 6 and sum(folder["files"] for folder in folders) == 13
+    assert [folder["seconds"] for folder in folders] == sorted((folder["seconds"] for folder in folders), reverse=True)
+
+    # the broken file is reported, also when it is not read again by the incremental crawl
+    for _ in range(2):
+        assert sum(errors["count"] for errors in report["errors"].values()) == 1
+        [errors] = report["errors"].values()
+        assert errors["samples"][0]["path"] == f"{dataset_name}/P2/study/broken.dcm"
+        assert crawl(dataset, n_jobs=1) == db
+        _, report = crawl(dataset, n_jobs=1, return_report=True)
+    assert report["parse_times"] == {}
+
+
+def test_sharded_crawl(dataset):
+    parent, dataset_name = os.path.split(dataset)
+    imgtools = pathlib.Path(parent, ".imgtools")
+    write_image_series(pathlib.Path(dataset, "P3", "study", "CT"), "CT", "P3", generate_uid())
+    assert sorted(shard_of(folder, 3) for folder in ["P1", "P2", "P3"]) == [0, 1, 2]
+
+    db = crawl(dataset, n_jobs=1)
+    single = read_outputs(dataset)
+    single_tree = pathlib.Path(imgtools, f"imgtools_{dataset_name}.tree").read_bytes()
+    single_manifest = pathlib.Path(imgtools, f"imgtools_{dataset_name}_manifest.json").read_text()
+    for name in os.listdir(imgtools):
+        os.remove(pathlib.Path(imgtools, name))
+
+    # the shards finish in any order, each only crawls its own folders
+    for index in [2, 0]:
+        shard_db = crawl(dataset, n_jobs=2, chunk_size=1, shard=(index, 3))
+        assert list(shard_db) == [folder for folder in ["P1", "P2", "P3"] if shard_of(folder, 3) == index]
+    assert not os.path.exists(pathlib.Path(imgtools, f"imgtools_{dataset_name}.csv"))
+    with pytest.raises(FileNotFoundError):
+        merge_shards(dataset)
+    crawl(dataset, n_jobs=1, shard=(1, 3))
+
+    assert merge_shards(dataset) == db
+    assert read_outputs(dataset) == single
+    assert pathlib.Path(imgtools, f"imgtools_{dataset_name}.tree").read_bytes() == single_tree
+    assert pathlib.Path(imgtools, f"imgtools_{dataset_name}_manifest.json").read_text() == single_manifest
+
+
+def test_crawl_watcher(dataset, tmp_path):
+    parent, dataset_name = os.path.split(dataset)
+    imgtools = pathlib.Path(parent, ".imgtools")
+    edge_path = pathlib.Path(imgtools, f"imgtools_{dataset_name}_edges.csv").as_posix()
+    cache_path = pathlib.Path(tmp_path, "cache", "headers.db").as_posix()
+    updates = []
+    watcher = CrawlWatcher(dataset, edge_path, use_events=False, header_cache=cache_path, n_jobs=2, debounce=3600,
+                           save_interval=3600, callback=lambda db, patients: updates.append(patients))
+    watcher.start()
+    assert watcher.poll() == set()
+    assert HeaderCache(cache_path).stats()["entries"] == 12
+    started = read_outputs(dataset)
+
+    def full_crawl():
+        """Outputs and edges of a new crawl, without the state of the watcher"""
+        watched = read_outputs(dataset), pd.read_csv(edge_path)
+        crawl(dataset, n_jobs=1, incremental=False)
+        full_edge_path = pathlib.Path(imgtools, "edges_full.csv").as_posix()
+        DataGraph(pathlib.Path(imgtools, f"imgtools_{dataset_name}.csv").as_posix(), full_edge_path)
+        edges = pd.read_csv(full_edge_path)
+        os.remove(full_edge_path)
+        return watched, (read_outputs(dataset), edges)
+
+    # a new patient with an RTSTRUCT for a CT series that arrives later, and a removed PT series
+    study = generate_uid()
+    ct = generate_uid()
+    write_rtstruct(pathlib.Path(dataset, "P0", "study", "RTSTRUCT", "rs.dcm"), "P0", study, ct)
+    shutil.rmtree(pathlib.Path(dataset, "P2", "study", "PT"))
+    # the new file was just written, it is only read once it was not modified for debounce seconds
+    assert watcher.poll() == set()
+    watcher.debounce = 0
+    assert watcher.poll() == {"P0", "P2"}
+    write_image_series(pathlib.Path(dataset, "P0", "study", "CT"), "CT", "P0", study, series=ct)
+    assert watcher.poll() == {"P0"}
+    assert updates == [{"P0", "P2"}, {"P0"}]
+    # the changed files were read through the header cache as well
+    assert HeaderCache(cache_path).stats()["entries"] == 17
+
+    # only the tree records of the updated patients and the edges in memory are up to date until the outputs are saved
+    assert read_outputs(dataset) == started
+    tree = CrawlTree(pathlib.Path(imgtools, f"imgtools_{dataset_name}.tree").as_posix())
+    assert sorted(tree) == ["P0", "P1", "P2"]
+    assert len(watcher.graph.df_edges) == 3
+    watcher.stop()
+    assert tree.to_dict() == json.loads(read_outputs(dataset)[0])
+    tree.close()
+
+    (watched, watched_edges), (full, full_edges) = full_crawl()
+    assert watched == full
+    assert len(watched_edges) == len(full_edges) == 3
+    # only the edges of the updated patients were formed again, so the rows are in another order
+    columns = list(full_edges.columns)
+    pd.testing.assert_frame_equal(watched_edges.sort_values(columns, ignore_index=True),
+                                  full_edges.sort_values(columns, ignore_index=True))
+
+
+def test_header_cache(dataset, tmp_path):
+    parent, dataset_name = os.path.split(dataset)
+    cache_path = pathlib.Path(tmp_path, "cache", "headers.db").as_posix()
+    crawl(dataset, n_jobs=1)
+    uncached = read_outputs(dataset)
+
+    _, report = crawl(dataset, n_jobs=2, incremental=False, header_cache=cache_path, return_report=True)
+    assert report["header_cache"]["misses"] == 12 and report["header_cache"]["hits"] == 0
+    _, report = crawl(dataset, n_jobs=1, incremental=False, header_cache=cache_path, return_report=True)
+    assert report["header_cache"]["hits"] == 12 and report["header_cache"]["hit_rate"] == 1.
+    assert read_outputs(dataset) == uncached
+
+    # another view of the same files, through symlinks, and a changed file
+    view = pathlib.Path(tmp_path, "view", dataset_name)
+    view.mkdir(parents=True)
+    for patient in ["P1", "P2"]:
+        os.symlink(pathlib.Path(dataset, patient), pathlib.Path(view, patient))
+    os.utime(pathlib.Path(dataset, "P1", "study", "CT", "0.dcm"), ns=(0, 0))
+    _, report = crawl(view.as_posix(), n_jobs=1, header_cache=cache_path, return_report=True)
+    assert report["header_cache"]["hits"] == 11 and report["header_cache"]["misses"] == 1
+
+    # the readers use the cache once it is enabled
+    try:
+        cache = enable_header_cache(cache_path)
+        rtstruct = read_dicom_auto(pathlib.Path(dataset, "P1", "study", "RTSTRUCT", "rs.dcm").as_posix())
+        assert rtstruct.roi_names == ["GTV", "Larynx"]
+        read_dicom_auto(pathlib.Path(dataset, "P1", "study", "RTSTRUCT", "rs.dcm").as_posix())
+        assert (cache.hits, cache.misses) == (1, 1)
+    finally:
+        disable_header_cache()
+
+    # least recently used entries are evicted beyond the size bound
+    cache = HeaderCache(cache_path, max_bytes=2000)
+    assert cache.stats()["entries"] == 14
+    assert cache.evict() > 0
+    stats = cache.stats()
+    assert stats["bytes"] <= 1800 and stats["evictions"] > 0 and stats["entries"] < 14
+
+
+def test_roi_catalog(dataset):
+    parent, dataset_name = os.path.split(dataset)
+    write_rtstruct(pathlib.Path(dataset, "P2", "study", "RTSTRUCT", "rs.dcm"), "P2", generate_uid(), generate_uid(),
+                   roi_names=("gtv_primary", "Brainstem", "Parotid_L"))
+    crawl(dataset, n_jobs=1)
+
+    rois_path = pathlib.Path(parent, ".imgtools", f"imgtools_{dataset_name}_rois.csv").as_posix()
+    rois = pd.read_csv(rois_path, index_col=0)
+    assert list(rois.roi_name) == ["GTV", "Larynx", "gtv_primary", "Brainstem", "Parotid_L"]
+    assert list(rois.roi_number) == [1, 2, 1, 2, 3]
+    assert list(rois.contours) == [1, 2, 1, 2, 3]
+    assert list(rois.points) == [32, 64, 32, 64, 96]
+    assert rois.file_path[0] == f"{dataset_name}/P1/study/RTSTRUCT/rs.dcm"
+
+    feasibility = roi_feasibility(rois_path, {"GTV": "GTV.*", "BRAINSTEM": ["Brain.?stem", "BS"], "CORD": "Cord"})
+    assert list(feasibility.index) == ["P1", "P2"]
+    assert list(feasibility.GTV) == [True, True]
+    assert list(feasibility.BRAINSTEM) == [False, True]
+    assert not feasibility.CORD.any() and not feasibility.feasible.any()
+    assert list(roi_feasibility(rois, ["GTV", "Larynx"]).feasible) == [True, False]
+
+
+@pytest.mark.parametrize("transfer_syntax", [ExplicitVRLittleEndian, ImplicitVRLittleEndian, ExplicitVRBigEndian])
+def test_read_contour_counts(tmp_path, transfer_syntax):
+    path = pathlib.Path(tmp_path, "rs.dcm")
+    write_rtstruct(path, "P1", generate_uid(), generate_uid(), roi_names=("A", "B", "C"))
+    rtstruct = dcmread(path)
+    rtstruct.file_meta.TransferSyntaxUID = transfer_syntax
+    rtstruct.is_implicit_VR = transfer_syntax.is_implicit_VR
+    rtstruct.is_little_endian = transfer_syntax.is_little_endian
+    rtstruct.ROIContourSequence[2].ContourSequence = Sequence([])  # ROI without contours
+    rtstruct.save_as(path, write_like_original=False)
+
+    with open(path, "rb") as f:
+        counts = read_contour_counts(f, transfer_syntax.is_implicit_VR, transfer_syntax.is_little_endian)
+    assert counts == {1: (1, 32), 2: (2, 64), 3: (0, 0)}
+
+
+@pytest.mark.parametrize("orientation", [(1.0, 0.0, 0.0, 0.0, 1.0, 0.0), (1.0, 0.0, 0.0, 0.0, -1.0, 0.0)])
+def test_sorted_instances(tmp_path, orientation):
+    top = pathlib.Path(tmp_path, "data", "synthetic")
+    folder = pathlib.Path(top, "P1", "study", "CT")
+    write_image_series(folder, "CT", "P1", generate_uid(), n_slices=6, orientation=orientation)
+    # file names that do not follow the slice order
+    for i, name in enumerate([3, 0, 5, 1, 4, 2]):
+        os.rename(pathlib.Path(folder, f"{i}.dcm"), pathlib.Path(folder, f"IM{name}.dcm"))
+
+    db = crawl(top.as_posix(), n_jobs=1)
+    series = [series for uid, series in db["P1"][next(iter(db["P1"]))].items() if uid != "description"][0]
+    files = sorted_instances(series["1"], pathlib.Path(tmp_path, "data").as_posix())
+    assert files == list(sitk.ImageSeriesReader.GetGDCMSeriesFileNames(folder.as_posix()))
+
+    image = read_dicom_series(folder.as_posix(), file_names=files)
+    gdcm_image = read_dicom_series(folder.as_posix())
+    assert np.array_equal(sitk.GetArrayFromImage(image), sitk.GetArrayFromImage(gdcm_image))
+    assert image.GetOrigin() == gdcm_image.GetOrigin()
+
+    # slices decoded in parallel, with the geometry of the crawler or of the slices
+    crawled_orientation, positions = sorted_geometry(series["1"])
+    assert crawled_orientation == list(orientation) and positions[0] == list(gdcm_image.GetOrigin())
+    for subseries in [series["1"], None]:
+        image = read_dicom_series_threaded(files, n_threads=3, subseries=subseries)
+        assert np.array_equal(sitk.GetArrayFromImage(image), sitk.GetArrayFromImage(gdcm_image))
+        assert image.GetPixelID() == gdcm_image.GetPixelID()
+        assert np.allclose(image.GetOrigin(), gdcm_image.GetOrigin()) and np.allclose(image.GetSpacing(), gdcm_image.GetSpacing())
+        assert np.allclose(image.GetDirection(), gdcm_image.GetDirection())
+
+
+def test_indexed_read(dataset, monkeypatch):
+    import imgtools.io.loaders as loaders
+    root = os.path.dirname(dataset)
+    db = crawl(dataset, n_jobs=1)
+
+    for patient, studies in db.items():
+        for study, series in studies.items():
+            for series_uid, subseries in series.items():
+                if series_uid == "description":
+                    continue
+                entry = next(entry for uid, entry in subseries.items() if uid != "description")
+                if entry["modality"] not in ["CT", "PT", "RTSTRUCT"]:  # the RTDOSE has no dose grid
+                    continue
+                folder = pathlib.Path(root, entry["folder"]).as_posix()
+                files = sorted_instances(entry, root)
+                legacy = read_dicom_auto(folder, series_uid, file_names=files)
+
+                # with the modality and files from the crawler, only the header of one file is read
+                headers, scans = [], []
+                monkeypatch.setattr(loaders, "read_header", lambda path, *args: headers.append(path) or read_header(path, *args))
+                monkeypatch.setattr(loaders.glob, "glob", lambda *args, **kwargs: scans.append(args))
+                indexed = read_dicom_auto(folder, series_uid, file_names=files, modality=entry["modality"])
+                monkeypatch.undo()
+                assert headers == files[:1] and scans == []
+                assert indexed.metadata == legacy.metadata
+                if entry["modality"] == "RTSTRUCT":
+                    assert indexed.roi_names == legacy.roi_names
+                elif entry["modality"] == "CT":
+                    assert np.array_equal(sitk.GetArrayFromImage(indexed.image), sitk.GetArrayFromImage(legacy.image))
+                else:
+                    assert np.array_equal(sitk.GetArrayFromImage(indexed), sitk.GetArrayFromImage(legacy))
+
+
+def test_threaded_series_reader(tmp_path):
+    folder = pathlib.Path(tmp_path, "CT")
+    write_image_series(folder, "CT", "P1", generate_uid(), n_slices=6, size=16)
+    files = [pathlib.Path(folder, f"{i}.dcm").as_posix() for i in range(6)]
+    image = read_dicom_series_threaded(files, n_threads=3)
+    gdcm_image = read_dicom_series(None, file_names=files)
+    assert image.GetPixelID() == gdcm_image.GetPixelID()
+    assert np.array_equal(sitk.GetArrayFromImage(image), sitk.GetArrayFromImage(gdcm_image))
+    assert image.GetOrigin() == gdcm_image.GetOrigin() and image.GetSpacing() == gdcm_image.GetSpacing()
+    assert image.GetDirection() == gdcm_image.GetDirection()
+
+    # a slice with another rescale decodes to floats, the values of every slice are kept
+    ds = dcmread(files[2])
+    ds.RescaleSlope = 0.3
+    ds.save_as(files[2])
+    image = read_dicom_series_threaded(files, n_threads=3)
+    assert image.GetPixelID() == sitk.sitkFloat64
+    np.testing.assert_allclose(sitk.GetArrayFromImage(image)[:, 0, 0], [0, 1, 0.6, 3, 4, 5])
+
+
+def test_series_metadata(dataset, monkeypatch):
+    import imgtools.io.loaders as loaders
+    folder = pathlib.Path(dataset, "P1", "study", "CT").as_posix()
+    image = read_dicom_series(folder)
+    image_tags, slices = read_dicom_series_with_metadata(folder)
+    assert np.array_equal(sitk.GetArrayFromImage(image), sitk.GetArrayFromImage(image_tags))
+    assert len(slices) == 4 and [tags["0020|0013"].strip() for tags in slices] == ["1", "2", "3", "4"]
+
+    # the tags of the first slice are only parsed when they are accessed
+    headers = []
+    monkeypatch.setattr(loaders, "read_header", lambda path, *args: headers.append(path) or read_header(path, *args))
+    metadata = SeriesMetadata(folder)
+    assert headers == []
+    assert metadata["0008|0060"] == metadata["Modality"] == "CT"
+    assert metadata["ImagePositionPatient"] == "0.0\\0.0\\0.0"
+    assert len(headers) == 1 and metadata.header.InstanceNumber == 1
+    for key, value in slices[0].items():
+        if key in metadata:
+            assert metadata[key] == value.strip()
+    assert len(headers) == 1
+    with pytest.raises(KeyError):
+        metadata["0009|0010"]
+
+
+def test_auto_input_reads_from_crawl(dataset, monkeypatch):
+    import imgtools.io.loaders as loaders
+    from imgtools.ops import ImageAutoInput
+    shutil.rmtree(pathlib.Path(dataset, "P1", "study", "RTDOSE"))  # it has no dose grid to read
+    auto_input = ImageAutoInput(dataset, "CT,RTSTRUCT", n_jobs=1)
+    assert auto_input._loader.tree is not None
+    legacy = ImageCSVLoader(auto_input.df_combined, colnames=auto_input.column_names,
+                            seriesnames=auto_input.series_names, readers=auto_input.readers)
+
+    scans = []
+    monkeypatch.setattr(loaders.glob, "glob", lambda *args, **kwargs: scans.append(args) or [])
+    subject = auto_input._loader.keys()[0]
+    ct, rtstruct = auto_input(subject)
+    assert scans == []
+    monkeypatch.undo()
+    legacy_ct, legacy_rtstruct = legacy[subject]
+    assert np.array_equal(sitk.GetArrayFromImage(ct.image), sitk.GetArrayFromImage(legacy_ct.image))
+    assert ct.metadata == legacy_ct.metadata
+    assert rtstruct.roi_names == legacy_rtstruct.roi_names == ["GTV", "Larynx"]
+
+    # a modality without a reader gives None, as when it is found by reading the directory
+    row = auto_input.df_combined.loc[subject]
+    files = sorted_instances(auto_input._loader._crawled_subseries(row, row["series_CT"]), os.path.dirname(dataset))
+    assert read_dicom_auto(row["folder_CT"], row["series_CT"], file_names=files, modality="US") is None
+
+
+def test_csv_loader_single_modality_readers(dataset):
+    from imgtools.ops import ImageAutoInput
+    shutil.rmtree(pathlib.Path(dataset, "P1", "study", "RTDOSE"))
+    auto_input = ImageAutoInput(dataset, "CT,RTSTRUCT", n_jobs=1)
+    tree = auto_input._loader.tree
+    subject = auto_input._loader.keys()[0]
+
+    # readers without a modality (or series) argument only get the arguments they accept
+    loader = ImageCSVLoader(auto_input.df_combined, colnames=auto_input.column_names, seriesnames=auto_input.series_names,
+                            readers=[read_dicom_scan, read_dicom_rtstruct], tree=tree, root_directory=os.path.dirname(dataset))
+    ct, rtstruct = loader[subject]
+    legacy_ct = read_dicom_scan(auto_input.df_combined.loc[subject, "folder_CT"])
+    assert np.array_equal(sitk.GetArrayFromImage(ct.image), sitk.GetArrayFromImage(legacy_ct.image))
+    assert rtstruct.roi_names == ["GTV", "Larynx"]
+
+    # one reader is used for every column
+    calls = []
+    loader = ImageCSVLoader(auto_input.df_combined, colnames=auto_input.column_names, seriesnames=auto_input.series_names,
+                            readers=lambda path, series=None, file_names=None: calls.append(file_names) or path,
+                            tree=tree, root_directory=os.path.dirname(dataset))
+    assert tuple(loader[subject]) == tuple(auto_input.df_combined.loc[subject, auto_input.column_names])
+    assert [len(files) for files in calls] == [ct.image.GetSize()[2], 1]
@@ -0,0 +1,374 @@
+import copy
+import json
+import pathlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from imgtools.modules import DataGraph, GraphEngine, regex_to_masks, GRAPH_COLUMNS, GRAPH_VIEW_LEVELS, graph_view, write_graph_view
+from imgtools.utils.crawl import CRAWL_COLUMNS
+
+
+def synthetic_crawl(n_studies, seed=0):
+    """Crawl DataFrame (all columns as strings, like DataGraph uses) with CT/MR/PT/RTSTRUCT/RTDOSE/RTPLAN series.
+
+    References go through every edge type, including RTDOSEs referencing an RTSTRUCT by series or by instance,
+    several RTDOSEs per RTSTRUCT, missing references and references to series that were not crawled.
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+
+    def add(patient, study, modality, series, instance="", **references):
+        rows.append({'patient_ID': patient, 'study': study, 'study_description': "study",
+                     'series': series, 'series_description': f"{modality} series", 'subseries': "default",
+                     'modality': modality, 'instances': 1, 'instance_uid': instance or f"{series}.1",
+                     'reference_ct': references.get('ct', np.nan), 'reference_rs': references.get('rs', np.nan),
+                     'reference_pl': references.get('pl', np.nan), 'reference_frame': np.nan,
+                     'folder': f"{patient}/{study}/{series}", 'file_path': f"{patient}/{study}/{series}/1.dcm"})
+
+    for i in range(n_studies):
+        patient, study = f"P{i // 2}", f"1.2.{i}"
+        images = []
+        for j in range(rng.integers(1, 3)):
+            modality = "MR" if rng.random() < 0.2 else "CT"
+            images.append(f"{study}.{modality}{j}")
+            add(patient, study, modality, images[-1])
+        for j in range(rng.integers(0, 3)):
+            add(patient, study, "PT", f"{study}.PT{j}")
+        for j in range(rng.integers(0, 3)):
+            struct = f"{study}.RS{j}"
+            add(patient, study, "RTSTRUCT", struct, ct=rng.choice(images + [f"{study}.PT0", "1.2.missing"]))
+            for k in range(rng.integers(0, 3)):
+                reference = {'rs': rng.choice([f"{struct}.1", struct])} if rng.random() < 0.7 else {'ct': rng.choice(images)}
+                if rng.random() < 0.3:
+                    plan = f"{study}.PL{j}{k}"
+                    add(patient, study, "RTPLAN", plan, rs=f"{struct}.1")
+                    reference['pl'] = f"{plan}.1"
+                add(patient, study, "RTDOSE", f"{study}.RD{j}{k}", **reference)
+
+    df = pd.DataFrame(rows, columns=CRAWL_COLUMNS)
+    return df.iloc[rng.permutation(len(df))].reset_index(drop=True).astype(str)
+
+
+def merge_edge_table(df):
+    """Edge table formed with pd.merge, as DataGraph did before GraphEngine (from all the columns of df)."""
+    plan = df[df["modality"] == "RTPLAN"]
+    dose = df[df["modality"] == "RTDOSE"]
+    struct = df[df["modality"] == "RTSTRUCT"]
+    ct = df[df["modality"] == "CT"]
+    mr = df[df["modality"] == "MR"]
+    pet = df[df["modality"] == "PT"]
+
+    df_list = []
+    for edge in range(7):
+        if edge == 0:
+            df_combined = pd.concat([pd.merge(struct, dose, left_on="instance_uid", right_on="reference_rs"),
+                                     pd.merge(struct, dose, left_on="series", right_on="reference_rs")])
+            df_combined = df_combined.drop_duplicates(subset=["instance_uid_x"])
+        elif edge == 1:
+            df_combined = pd.merge(ct, dose, left_on="series", right_on="reference_ct")
+        elif edge == 2:
+            df_combined = pd.concat([pd.merge(ct, struct, left_on="series", right_on="reference_ct"),
+                                     pd.merge(mr, struct, left_on="series", right_on="reference_ct")])
+        elif edge == 3:
+            df_combined = pd.merge(pet, struct, left_on="series", right_on="reference_ct")
+        elif edge == 4:
+            df_combined = pd.merge(ct, pet, left_on="study", right_on="study")
+        elif edge == 5:
+            df_combined = pd.merge(plan, dose, left_on="instance_uid", right_on="reference_pl")
+        else:
+            df_combined = pd.merge(struct, plan, left_on="instance_uid", right_on="reference_rs")
+        df_combined["edge_type"] = edge
+        df_list.append(df_combined)
+
+    df_edges = pd.concat(df_list, axis=0, ignore_index=True)
+    df_edges.loc[df_edges.study_x.isna(), "study_x"] = df_edges.loc[df_edges.study_x.isna(), "study"]
+    df_edges.drop(columns=["study_y", "patient_ID_y", "series_description_y", "study_description_y", "study"], inplace=True, errors="ignore")
+    return df_edges
+
+
+@pytest.mark.parametrize("n_studies,seed", [(1, 0), (20, 1), (200, 2)])
+def test_form_edge_table(tmp_path, n_studies, seed):
+    df = synthetic_crawl(n_studies, seed)
+    expected = merge_edge_table(df)
+    assert set(expected.edge_type) >= {0, 2, 4} or n_studies == 1
+
+    crawl_path = tmp_path / "crawl.csv"
+    df.to_csv(crawl_path)
+    graph = DataGraph(crawl_path.as_posix(), (tmp_path / "edges.csv").as_posix(), columns=CRAWL_COLUMNS)
+    pd.testing.assert_frame_equal(graph.df_edges, expected)
+
+    expected.to_csv(tmp_path / "expected.csv", index=False)
+    assert (tmp_path / "edges.csv").read_text() == (tmp_path / "expected.csv").read_text()
+
+    # only the columns the graph needs by default
+    graph = DataGraph(crawl_path.as_posix(), (tmp_path / "edges.csv").as_posix())
+    pd.testing.assert_frame_equal(graph.df_edges, merge_edge_table(df[GRAPH_COLUMNS]))
+    assert all(isinstance(graph.df[column].dtype, pd.CategoricalDtype) for column in GRAPH_COLUMNS)
+
+
+def test_graph_engine():
+    df = synthetic_crawl(50)
+    engine = GraphEngine(df)
+    edges = engine.edges()
+    assert edges.src.dtype == edges.dst.dtype == np.intp and np.all(np.diff(edges.edge_type) >= 0)
+
+    # edges of one type and a few columns only
+    ct_pt = engine.edges([4])
+    table = engine.materialize(ct_pt, columns=["series", "modality"])
+    assert list(table.columns) == ["series_x", "modality_x", "series_y", "modality_y", "edge_type"]
+    assert set(table.modality_x) == {"CT"} and set(table.modality_y) == {"PT"}
+    assert len(table) == ((edges.edge_type == 4).sum())
+
+
+def loop_get_df(self, df_edges_processed, rel_studyids, remove_less_comp=True):
+    """Components as DataGraph._get_df formed them before, with a .loc per study and .iloc per edge."""
+    self.final_dict = []
+    final_df = []
+    mods_wanted = set(self.mods)
+    for study in rel_studyids:
+        df_temp = df_edges_processed.loc[df_edges_processed.study_x == study]
+        CT_locs = df_temp.loc[df_temp.modality_x.isin(['CT', 'MR'])]
+        CT_series = CT_locs.series_x.unique()
+        A, save_folder_comp = [], []
+        for ct in CT_series:
+            df_connections = CT_locs.loc[CT_locs.series_x == ct]
+            row = df_connections.iloc[0]
+            modality = row.modality_x
+            temp = {"study": study, ct: {"modality": modality, "folder": row.folder_x}}
+            folder_save = {"study": study, 'patient_ID': row.patient_ID_x,
+                           f'series_{modality}': row.series_x, f'folder_{modality}': row.folder_x}
+            for k in range(len(df_connections)):
+                row_y = df_connections.iloc[k]
+                temp[row.series_y] = {"modality": row_y.modality_y, "folder": row_y.folder_y, "conn_to": modality}
+                key, key_series = self._check_save(folder_save, row_y.modality_y, modality)
+                folder_save[key_series] = row_y.series_y
+                folder_save[key] = row_y.folder_y
+            A.append(temp)
+            save_folder_comp.append(folder_save)
+
+        rest_locs = df_temp.loc[~df_temp.modality_x.isin(['CT', 'MR']), ["series_x", "modality_x", "folder_x", "series_y", "modality_y", "folder_y"]]
+        for j in range(len(rest_locs)):
+            edge = rest_locs.iloc[j]
+            for k in range(len(CT_series)):
+                A[k][edge['series_y']] = {"modality": edge['modality_y'], "folder": edge['folder_y'], "conn_to": edge['modality_x']}
+                modality_origin = "CT" if edge['modality_y'] == "RTDOSE" else edge['modality_x']
+                key, key_series = self._check_save(save_folder_comp[k], edge['modality_y'], modality_origin)
+                save_folder_comp[k][key_series] = edge['series_y']
+                save_folder_comp[k][key] = edge['folder_y']
+
+        if remove_less_comp:
+            keep = [j for j in range(len(CT_series))
+                    if mods_wanted.issubset({key.split("_")[1] for key in save_folder_comp[j] if key.split("_")[0] == "folder"})]
+            save_folder_comp = [save_folder_comp[j] for j in keep]
+            A = [A[j] for j in keep]
+        self.final_dict.extend(A)
+        final_df.extend(save_folder_comp)
+    return pd.DataFrame(final_df)
+
+
+@pytest.mark.parametrize("query", ["CT,RTSTRUCT", "RTSTRUCT,MR", "CT,RTDOSE", "CT,RTSTRUCT,RTDOSE", "CT,RTSTRUCT,RTDOSE,PT", "CT,RTSTRUCT,PT", "CT,RTDOSE,PT"])
+def test_get_df(tmp_path, monkeypatch, query):
+    df = synthetic_crawl(300, seed=3)
+    df.to_csv(tmp_path / "crawl.csv")
+    graph = DataGraph((tmp_path / "crawl.csv").as_posix(), (tmp_path / "edges.csv").as_posix())
+
+    result = graph.parser(query)
+    components = copy.deepcopy(graph.final_dict) if hasattr(graph, "final_dict") else None
+    assert len(result) > 0
+
+    monkeypatch.setattr(DataGraph, "_get_df", loop_get_df)
+    graph.df_new = None
+    DataGraph.clear_memo()
+    pd.testing.assert_frame_equal(result, graph.parser(query))
+    if components is not None:
+        assert components == graph.final_dict
+
+
+PARSER_REGEXES = ['(((?=.*0)|(?=.*5)(?=.*6))|((?=.*1)(?=.*2)))',
+                  '((?=.*1)|(((?=.*0)|(?=.*5)(?=.*6))(?=.*2)))',
+                  '((?=.*2)|(((?=.*0)|(?=.*5)(?=.*6))(?=.*1)))',
+                  '((?=.*1)|(?=.*0)|(?=.*5)(?=.*6))(?=.*2)',
+                  '((?=.*1)|(?=.*0)|(?=.*5)(?=.*6))(?=.*2)(?=.*3)(?=.*4)',
+                  '(?=.*2)(?=.*3)(?=.*4)',
+                  '(?=.*4)((?=.*1)|((?=.*2)((?=.*0)|(?=.*5)(?=.*6))))']
+
+
+def test_study_index(tmp_path):
+    df = synthetic_crawl(300, seed=4)
+    df.to_csv(tmp_path / "crawl.csv")
+    graph = DataGraph((tmp_path / "crawl.csv").as_posix(), (tmp_path / "edges.csv").as_posix())
+    graph._form_agg()
+
+    # the study index selects the same studies as the regexes over the aggregated edge types
+    for regex in PARSER_REGEXES:
+        expected = graph.df_new.loc[graph.df_new.edge_type.str.contains(regex), "study_x"].unique()
+        np.testing.assert_array_equal(graph.study_index.select(regex_to_masks(regex)), expected)
+    assert regex_to_masks('(?=.*2)((?=.*0)|(?=.*1))') == [0b101, 0b110]
+    with pytest.raises(ValueError):
+        regex_to_masks('(?=.*2).*3')
+
+    # counts as found with pandas
+    studies = df.groupby("study").modality.agg(set)
+    assert graph.count("CT") == sum("CT" in modalities for modalities in studies)
+    assert graph.count("CT,PT") == graph.df_edges.loc[graph.df_edges.edge_type == 4, "study_x"].nunique()
+    with_edges = graph.df_new.set_index("study_x").edge_type.map(lambda types: set(map(int, types)))
+    expected = [study for study, types in with_edges.items()
+                if {2, 3, 4} <= types and {"CT", "RTSTRUCT", "PT"} <= studies[study]]
+    assert graph.count("CT,RTSTRUCT,PT") == len(expected) > 0
+    np.testing.assert_array_equal(graph.studies("CT,RTSTRUCT,PT"), sorted(expected))
+
+    # the edge table loaded from disk gives the same index
+    loaded = DataGraph((tmp_path / "crawl.csv").as_posix(), (tmp_path / "edges.csv").as_posix())
+    np.testing.assert_array_equal(loaded.study_index.edge_bits, graph.study_index.edge_bits)
+
+
+def test_edge_cache(tmp_path, monkeypatch):
+    df = synthetic_crawl(50, seed=6)
+    df.to_csv(tmp_path / "crawl.csv")
+    crawl_path, edge_path = (tmp_path / "crawl.csv").as_posix(), (tmp_path / "edges.csv").as_posix()
+    graph = DataGraph(crawl_path, edge_path)
+    assert (tmp_path / "edges.npz").exists()
+
+    # loaded with the types it was formed with, without forming it again or parsing the CSV
+    with monkeypatch.context() as m:
+        read_csv = pd.read_csv
+        m.setattr(pd, "read_csv", lambda path, *args, **kwargs: read_csv(path, *args, **kwargs) if path == crawl_path else pytest.fail(path))
+        m.setattr(DataGraph, "form_graph", lambda self: pytest.fail("edge table formed again"))
+        loaded = DataGraph(crawl_path, edge_path)
+    pd.testing.assert_frame_equal(loaded.df_edges, graph.df_edges)
+
+    # formed again after the crawl changed
+    synthetic_crawl(60, seed=6).to_csv(tmp_path / "crawl.csv")
+    changed = DataGraph(crawl_path, edge_path)
+    pd.testing.assert_frame_equal(changed.df_edges, merge_edge_table(synthetic_crawl(60, seed=6)[GRAPH_COLUMNS]))
+    pd.testing.assert_frame_equal(DataGraph(crawl_path, edge_path).df_edges, changed.df_edges)
+
+
+def test_update_patients(tmp_path, monkeypatch):
+    df = synthetic_crawl(100, seed=7)
+    df.to_csv(tmp_path / "crawl.csv")
+    graph = DataGraph((tmp_path / "crawl.csv").as_posix(), (tmp_path / "edges.csv").as_posix())
+
+    # P3 removed, P5 lost a series, P50 ... P61 added in between the rows of the other patients
+    added = synthetic_crawl(124, seed=7)
+    added = added.loc[added.patient_ID.isin([f"P{i}" for i in range(50, 62)])]
+    kept = df.loc[(df.patient_ID != "P3") & (df.series != df.loc[df.patient_ID == "P5", "series"].iloc[0])]
+    positions = np.random.default_rng(0).integers(0, len(kept) + 1, len(added))
+    order = np.argsort(np.concatenate([np.arange(len(kept)), positions - 0.5]), kind="stable")
+    new = pd.concat([kept, added]).iloc[order].reset_index(drop=True)
+    new.to_csv(tmp_path / "crawl.csv")
+    changed = ["P3", "P5"] + [f"P{i}" for i in range(50, 62)]
+    with monkeypatch.context() as m:
+        m.setattr(DataGraph, "form_graph", lambda self: pytest.fail("edge table formed again"))
+        graph.update_patients(changed)
+
+    expected = merge_edge_table(new[GRAPH_COLUMNS])
+    pd.testing.assert_frame_equal(graph.df_edges, expected)
+    pd.testing.assert_frame_equal(DataGraph((tmp_path / "crawl.csv").as_posix(), (tmp_path / "edges.csv").as_posix()).df_edges, expected)
+    assert {"P5", "P50", "P61"} <= set(graph.df_edges.patient_ID_x) and "P3" not in set(graph.df_edges.patient_ID_x)
+
+    # rows of other patients in another order
+    new = new.sample(frac=1, random_state=0).reset_index(drop=True)
+    new.to_csv(tmp_path / "crawl.csv")
+    graph.update_patients(["P7"])
+    pd.testing.assert_frame_equal(graph.df_edges, merge_edge_table(new[GRAPH_COLUMNS]))
+
+
+def test_update_patients_in_memory(tmp_path, monkeypatch):
+    df = synthetic_crawl(100, seed=7)
+    df = df.iloc[np.argsort(pd.factorize(df.patient_ID)[0], kind="stable")].reset_index(drop=True)  # grouped by patient, as crawled
+    df.to_csv(tmp_path / "crawl.csv")
+    crawl_path, edge_path = (tmp_path / "crawl.csv").as_posix(), (tmp_path / "edges.csv").as_posix()
+    graph = DataGraph(crawl_path, edge_path)
+    count = graph.count("CT")
+    saved = (tmp_path / "edges.csv").read_text()
+
+    # P3 removed, P5 lost a series, P50 ... P61 added; only their rows are given
+    added = synthetic_crawl(124, seed=7)
+    added = added.loc[added.patient_ID.isin([f"P{i}" for i in range(50, 62)])]
+    kept = df.loc[(df.patient_ID != "P3") & (df.series != df.loc[df.patient_ID == "P5", "series"].iloc[0])]
+    df_patients = pd.concat([kept.loc[kept.patient_ID == "P5"], added])
+    with monkeypatch.context() as m:
+        read_csv = pd.read_csv
+        m.setattr(pd, "read_csv", lambda path, *args, **kwargs: pytest.fail(path) if path == crawl_path else read_csv(path, *args, **kwargs))
+        m.setattr(DataGraph, "form_graph", lambda self: pytest.fail("edge table formed again"))
+        graph.update_patients(["P3", "P5"] + [f"P{i}" for i in range(50, 62)], df_patients=df_patients, save=False)
+
+    # the rows of P5 stay in place, the new patients come after the others
+    new = pd.concat([kept, added]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(graph.df_edges, merge_edge_table(new[GRAPH_COLUMNS]))
+    assert (tmp_path / "edges.csv").read_text() == saved
+    assert graph.count("CT") == new.loc[new.modality == "CT", "study"].nunique() != count
+
+
+def test_parse_queries(tmp_path, monkeypatch):
+    df = synthetic_crawl(300, seed=8)
+    df.to_csv(tmp_path / "crawl.csv")
+    graph = DataGraph((tmp_path / "crawl.csv").as_posix(), (tmp_path / "edges.csv").as_posix())
+    queries = ["CT,RTSTRUCT", "CT,RTDOSE,RTSTRUCT", "PT,CT,RTSTRUCT", "CT,RTSTRUCT,RTDOSE,PT", "CT,RTDOSE", "CT", "CT,RTSTRUCT"]
+
+    DataGraph.clear_memo()
+    expected = {}
+    for query in queries:
+        expected[query] = (graph.parser(query), copy.deepcopy(graph.final_dict))
+        DataGraph.clear_memo()
+
+    # one pass over the components per edge list
+    components = DataGraph._components
+    calls = []
+    monkeypatch.setattr(DataGraph, "_components", lambda self, *args: calls.append(args) or components(self, *args))
+    results = graph.parse_queries(queries)
+    assert list(results) == list(dict.fromkeys(queries)) and len(calls) == 4  # [0, 1, 2], [0, 1, 2, 5, 6], [2, 3, 4], [0, 1, 2, 3, 4]
+    for query in queries:
+        pd.testing.assert_frame_equal(results[query], expected[query][0])
+
+    # memoized for other graphs of the same crawl
+    monkeypatch.setattr(DataGraph, "_components", lambda self, *args: pytest.fail("components formed again"))
+    other = DataGraph((tmp_path / "crawl.csv").as_posix(), (tmp_path / "edges.csv").as_posix())
+    for query in queries:
+        result = other.parser(query)
+        pd.testing.assert_frame_equal(result, expected[query][0])
+        if query != "CT":
+            assert other.final_dict == expected[query][1]
+        result["folder_CT"] = None  # results are copies
+    pd.testing.assert_frame_equal(other.parser("CT,RTSTRUCT"), expected["CT,RTSTRUCT"][0])
+    DataGraph.clear_memo()
+
+
+@pytest.mark.parametrize("level", GRAPH_VIEW_LEVELS)
+def test_graph_view(tmp_path, level):
+    df = synthetic_crawl(200, seed=9)
+    edges = merge_edge_table(df)
+    view = graph_view(edges, level=level, max_nodes=10**6)
+    assert view["nodes_shown"] == view["nodes_total"] and view["edges_shown"] == len(edges)
+    assert sum(edge["value"] for edge in view["edges"]) == len(edges)
+    ids = {node["id"] for node in view["nodes"]}
+    assert all(edge["from"] in ids and edge["to"] in ids for edge in view["edges"])
+    if level == "series":
+        assert view["nodes_total"] == len(set(edges.series_x) | set(edges.series_y))
+    else:
+        group = "study_x" if level == "study" else "patient_ID_x"
+        ends = pd.concat([edges[[group, "modality_x"]].set_axis(["group", "modality"], axis=1),
+                          edges[[group, "modality_y"]].set_axis(["group", "modality"], axis=1)])
+        assert view["nodes_total"] == len(ends.drop_duplicates())
+
+    # whole patients or studies are sampled within the node budget
+    sampled = graph_view(edges, level=level, max_nodes=50, seed=1)
+    assert 0 < sampled["nodes_shown"] <= 50 and sampled["groups_shown"] < sampled["groups_total"]
+    ids = {node["id"] for node in sampled["nodes"]}
+    assert all(edge["from"] in ids and edge["to"] in ids for edge in sampled["edges"])
+    assert sum(edge["value"] for edge in sampled["edges"]) == sampled["edges_shown"]
+    assert sampled == graph_view(edges, level=level, max_nodes=50, seed=1)
+
+    html = write_graph_view(sampled, (tmp_path / "view.html").as_posix())
+    assert json.loads((tmp_path / "view.json").read_text())["nodes_shown"] == sampled["nodes_shown"]
+    page = pathlib.Path(html).read_text(encoding="utf-8")
+    assert "vis.Network" in page
+    # vis-network is embedded, the page does not load anything from the network
+    assert "@version 9.1.2" in page and "<script src=" not in page
+    if level == "study":  # large graphs are viewed at the study level by visualize_graph
+        df.to_csv(tmp_path / "crawl.csv")
+        graph = DataGraph((tmp_path / "crawl.csv").as_posix(), (tmp_path / "edges.csv").as_posix())
+        assert graph.visualize_graph(max_nodes=100) == (tmp_path / "datanet_study.html").as_posix()